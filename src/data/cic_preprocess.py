@@ -1,5 +1,21 @@
 import pandas as pd
 
+# Predefined list of columns to keep
+COLUMNS_TO_KEEP = [
+    "tot_fwd_pkts", "tot_bwd_pkts", "totlen_fwd_pkts", "totlen_bwd_pkts",
+    "fwd_pkt_len_max", "fwd_pkt_len_min", "fwd_pkt_len_mean", "fwd_pkt_len_std",
+    "bwd_pkt_len_max", "bwd_pkt_len_min", "bwd_pkt_len_mean", "bwd_pkt_len_std",
+    "pkt_len_mean", "pkt_len_std",
+    "flow_iat_mean", "flow_iat_max", "flow_iat_min", "flow_iat_std",
+    "fwd_iat_tot", "fwd_iat_max", "fwd_iat_min", "fwd_iat_mean", "fwd_iat_std",
+    "bwd_iat_tot", "bwd_iat_max", "bwd_iat_min", "bwd_iat_mean", "bwd_iat_std",
+    "fin_flag_cnt", "syn_flag_cnt", "rst_flag_cnt",
+    "ack_flag_cnt"
+]
+
+# Flag counts are kept in the preprocessed csv files but dropped before training the models
+FLAG_COLUMNS = ["fin_flag_cnt", "syn_flag_cnt", "rst_flag_cnt", "ack_flag_cnt"]
+
 def preprocess_traffic(filepath):
     """
     Preprocesses traffic data by keeping selected columns and removing missing values.
@@ -10,24 +26,11 @@ def preprocess_traffic(filepath):
     Returns:
     - df_clean: A cleaned pandas DataFrame.
     """
-    # Predefined list of columns to keep
-    columns_to_keep = [
-        "tot_fwd_pkts", "tot_bwd_pkts", "totlen_fwd_pkts", "totlen_bwd_pkts",
-        "fwd_pkt_len_max", "fwd_pkt_len_min", "fwd_pkt_len_mean", "fwd_pkt_len_std",
-        "bwd_pkt_len_max", "bwd_pkt_len_min", "bwd_pkt_len_mean", "bwd_pkt_len_std",
-        "pkt_len_mean", "pkt_len_std",
-        "flow_iat_mean", "flow_iat_max", "flow_iat_min", "flow_iat_std",
-        "fwd_iat_tot", "fwd_iat_max", "fwd_iat_min", "fwd_iat_mean", "fwd_iat_std",
-        "bwd_iat_tot", "bwd_iat_max", "bwd_iat_min", "bwd_iat_mean", "bwd_iat_std",
-        "fin_flag_cnt", "syn_flag_cnt", "rst_flag_cnt", 
-        "ack_flag_cnt"
-    ]
-
     # Load the dataset
     df = pd.read_csv(filepath)
 
     # Keep only the desired columns
-    df_filtered = df[columns_to_keep]
+    df_filtered = df[COLUMNS_TO_KEEP]
 
     # Drop rows with any missing values
     df_clean = df_filtered.dropna()
@@ -1,5 +1,26 @@
+import hashlib
+import json
 import os
 import subprocess
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+CICFLOWMETER = "cicflowmeter"  # converter name stamped on csv files written by convert_pcap_to_csv
+STAMP_SUFFIX = ".source.json"  # written next to every csv, records the pcap it was converted from
+HASH_BLOCK_SIZE = 1 << 20
+
+ConversionResult = namedtuple(
+    "ConversionResult",
+    [
+        "source_file",
+        "dest_file",
+        "status",  # 'converted', 'skipped' (csv up to date) or 'failed'
+        "elapsed",
+        "error",  # error message of a failed conversion, None otherwise
+    ],
+)
+
 
 def convert_pcap_to_csv(source_file, dest_file):
     """
@@ -7,25 +28,160 @@ def convert_pcap_to_csv(source_file, dest_file):
 
     :param source_file: Path to the source pcap or pcapng file.
     :param dest_file: Path to the destination csv file.
+    :raises subprocess.SubprocessError: If cicflowmeter fails, with its stderr in the message.
     """
     cmd = ['cicflowmeter', '-f', source_file, '-c', dest_file]
-    subprocess.run(cmd, check=True)
+    # Output is captured so parallel conversions do not interleave, a failure reports it instead
+    completed = subprocess.run(cmd, capture_output=True, text=True)
+    if completed.returncode != 0:
+        stderr = completed.stderr.strip()
+        raise subprocess.SubprocessError(
+            f"cicflowmeter exited with status {completed.returncode} on {source_file}"
+            + (f":\n{stderr}" if stderr else "")
+        )
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_stamp(dest_file):
+    try:
+        with open(dest_file + STAMP_SUFFIX) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_stamp(dest_file, stamp):
+    temporary_path = f"{dest_file}{STAMP_SUFFIX}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(stamp, file)
+    os.replace(temporary_path, dest_file + STAMP_SUFFIX)
 
-def process_directory(source_dir, dest_dir):
+
+def _converter_name(convert, converter):
+    if converter is not None:
+        return converter
+    if convert is convert_pcap_to_csv:
+        return CICFLOWMETER
+    raise ValueError(f"A converter name is required to stamp the csv files of {convert!r}")
+
+
+def is_up_to_date(source_file, dest_file, converter=CICFLOWMETER):
+    """
+    Checks whether dest_file was converted from the current contents of source_file by converter.
+    Size and mtime are compared first; the pcap is only hashed when they changed (e.g. after a copy), and
+    a matching hash refreshes the stamp.
+
+    :param source_file: Path to the source pcap or pcapng file.
+    :param dest_file: Path to the destination csv file.
+    :param converter: Name of the conversion the csv must come from.
+    :return: True if the csv can be reused.
+    """
+    stamp = _read_stamp(dest_file)
+    if stamp is None or not os.path.exists(dest_file) or stamp.get("converter") != converter:
+        return False
+    stat = os.stat(source_file)
+    if stamp["size"] == stat.st_size and stamp["mtime_ns"] == stat.st_mtime_ns:
+        return True
+    if stamp["size"] != stat.st_size or stamp["digest"] != file_digest(source_file):
+        return False
+    _write_stamp(dest_file, dict(stamp, mtime_ns=stat.st_mtime_ns))
+    return True
+
+
+def convert_if_changed(source_file, dest_file, convert=convert_pcap_to_csv, force=False, converter=None):
+    """
+    Converts source_file into dest_file unless the csv is up to date. The conversion writes to a temporary
+    file that replaces dest_file only once it succeeded, so an interrupted or failed run never leaves a
+    partial csv behind; the source stamp is written last.
+
+    :param source_file: Path to the source pcap or pcapng file.
+    :param dest_file: Path to the destination csv file.
+    :param convert: Function (source_file, dest_file) writing the csv.
+    :param force: Convert even if the csv is up to date.
+    :param converter: Name stamped on the csv, a csv stamped by another converter is converted again.
+        Required for any convert other than convert_pcap_to_csv.
+    :return: ConversionResult
+    """
+    started = time.time()
+    converter = _converter_name(convert, converter)
+    if not force and is_up_to_date(source_file, dest_file, converter):
+        return ConversionResult(source_file, dest_file, "skipped", 0.0, None)
+
+    stat = os.stat(source_file)
+    stamp = {"converter": converter, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+             "digest": file_digest(source_file)}
+    dest_dir, dest_filename = os.path.split(dest_file)
+    temporary_file = os.path.join(dest_dir, f".{os.getpid()}-{dest_filename}")
+    try:
+        convert(source_file, temporary_file)
+        os.replace(temporary_file, dest_file)
+        _write_stamp(dest_file, stamp)
+    except (OSError, subprocess.SubprocessError, ValueError) as error:
+        # Report a converter's last stderr line, whitespace-only stderr keeps the exception's message
+        if isinstance(error, subprocess.CalledProcessError) and error.stderr and error.stderr.strip():
+            error = error.stderr.strip().splitlines()[-1]
+        return ConversionResult(source_file, dest_file, "failed", time.time() - started, str(error))
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+    return ConversionResult(source_file, dest_file, "converted", time.time() - started, None)
+
+
+def process_directory(source_dir, dest_dir, workers=None, force=False, convert=convert_pcap_to_csv, converter=None):
     """
     Processes all pcap or pcapng files in the given source directory, converting them
     to csv format in the destination directory with '_flow.csv' appended to the original filename.
 
+    Files are converted in parallel and only if their csv is missing or its source stamp does not match
+    the pcap (size and mtime_ns, else the blake2b digest of its contents) and the converter (see
+    is_up_to_date), so re-running after perturbing a few captures only converts those. Progress and
+    failures are printed per file as the conversions finish; a failed file does not stop the others.
+
     :param source_dir: Path to the source directory containing pcap or pcapng files.
     :param dest_dir: Path to the destination directory for the csv files.
+    :param workers: Number of conversions running at once (os.cpu_count() by default).
+    :param force: Convert every file, even if its csv is up to date.
+    :param convert: Function (source_file, dest_file) writing the csv, cicflowmeter by default.
+    :param converter: Name stamped on the csv files, required for any convert other than convert_pcap_to_csv.
+    :return: List of ConversionResult in file name order.
     """
-    for filename in os.listdir(source_dir):
+    converter = _converter_name(convert, converter)
+    os.makedirs(dest_dir, exist_ok=True)
+    jobs = []
+    for filename in sorted(os.listdir(source_dir)):
         if filename.endswith(('.pcap', '.pcapng')):
             source_file = os.path.join(source_dir, filename)
             dest_filename = f"{os.path.splitext(filename)[0]}_flow.csv"
-            dest_file = os.path.join(dest_dir, dest_filename)
-            convert_pcap_to_csv(source_file, dest_file)
-            print(f"Processed {source_file} to {dest_file}")
+            jobs.append((source_file, os.path.join(dest_dir, dest_filename)))
+
+    results = {}
+    # Conversions run in cicflowmeter subprocesses, threads only wait for them
+    with ThreadPool(max(1, min(workers or os.cpu_count() or 1, len(jobs) or 1))) as pool:
+        completed = pool.imap_unordered(
+            lambda job: convert_if_changed(*job, convert=convert, force=force, converter=converter), jobs
+        )
+        for result in completed:
+            results[result.source_file] = result
+            progress = f"[{len(results)}/{len(jobs)}]"
+            if result.status == "converted":
+                print(f"{progress} Processed {result.source_file} to {result.dest_file} ({result.elapsed:.1f}s)")
+            elif result.status == "skipped":
+                print(f"{progress} Up to date {result.dest_file}")
+            else:
+                print(f"{progress} Failed {result.source_file}: {result.error}")
+
+    failed = sum(result.status == "failed" for result in results.values())
+    if failed:
+        print(f"{failed} of {len(jobs)} conversions failed")
+    return [results[source_file] for source_file, _ in jobs]
+
 
 if __name__ == "__main__":
     source_dir = "../../data/raw"
@@ -35,4 +191,3 @@ if __name__ == "__main__":
     os.makedirs(dest_dir, exist_ok=True)
 
     process_directory(source_dir, dest_dir)
-
@@ -0,0 +1,223 @@
+import argparse
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from src.data.cic_preprocess import COLUMNS_TO_KEEP
+from src.data.make_malicious_scenarios_flows import convert_pcap_to_csv
+from src.utils.flow import assign_flow_ids_to_packets
+from src.utils.flow_features import extract_all_flow_features
+from src.utils.truncated_packet import NO_FLOW, PacketTable, create_truncated_packets_from_pcap, int_to_ip, ip_to_int
+
+# Flow identification written before the feature columns, named like the cicflowmeter csv columns
+FLOW_ID_COLUMNS = ["src_ip", "dst_ip", "src_port", "dst_port", "protocol", "timestamp"]
+FLAG_COUNT_COLUMNS = {"fin_flag_cnt": "fin", "syn_flag_cnt": "syn", "rst_flag_cnt": "rst", "ack_flag_cnt": "ack"}
+# Filled here instead of from the model features. Those keep them at 0 like the original prepare_timing_stats,
+# so fitness values stay comparable with earlier campaigns; the export follows cicflowmeter instead.
+IAT_TOTAL_COLUMNS = {"fwd_iat_tot": 1, "bwd_iat_tot": 2}
+# IAT columns of the whole flow, the forward and the backward packets. cicflowmeter reports all of them as 0
+# when there is a single inter-arrival time (two packets), see cicflowmeter.utils.get_statistics.
+IAT_COLUMN_GROUPS = {
+    ("tot_fwd_pkts", "tot_bwd_pkts"): ["flow_iat_mean", "flow_iat_max", "flow_iat_min", "flow_iat_std"],
+    ("tot_fwd_pkts",): ["fwd_iat_tot", "fwd_iat_max", "fwd_iat_min", "fwd_iat_mean", "fwd_iat_std"],
+    ("tot_bwd_pkts",): ["bwd_iat_tot", "bwd_iat_max", "bwd_iat_min", "bwd_iat_mean", "bwd_iat_std"],
+}
+
+# Relative difference up to which a native value counts as equal to the cicflowmeter one
+PARITY_TOLERANCE = 1e-6
+
+ParityReport = namedtuple(
+    "ParityReport",
+    [
+        "matched",  # flows found in both exports
+        "native_only",  # flows only the native exporter produced
+        "cic_only",  # flows only cicflowmeter produced
+        "columns",  # DataFrame indexed by column: max_abs_diff, mean_abs_diff, equal_share
+    ],
+)
+
+
+def flow_feature_frame(truncated_packets):
+    """
+    Computes the cicflowmeter columns kept by cic_preprocess.preprocess_traffic for every flow of a capture,
+    in process and straight from the packet table.
+
+    Sizes and IATs come from extract_all_flow_features, flag counts are summed over the TCP packets of
+    each flow (like count_tcp_flags). fwd_iat_tot / bwd_iat_tot, which the model features leave at 0, are
+    the sums of the direction's inter-arrival times (microseconds), i.e. its last minus its first timestamp.
+    Like in cicflowmeter, the IAT columns of a flow or direction with a single inter-arrival time are 0.
+    The flow's source is the sender of its first packet.
+
+    Parameters:
+    - truncated_packets: A PacketTable (or a list of TruncatedPacket objects) with flow ids assigned.
+
+    Returns:
+    A pandas DataFrame indexed by flow_id with FLOW_ID_COLUMNS followed by COLUMNS_TO_KEEP.
+    """
+    if not isinstance(truncated_packets, PacketTable):
+        truncated_packets = PacketTable.from_packets(truncated_packets)
+    features = extract_all_flow_features(truncated_packets)
+
+    flows = truncated_packets[truncated_packets.flow_id != NO_FLOW]
+    order = np.lexsort((flows.timestamp, flows.flow_id))
+    flow_ids, first = np.unique(flows.flow_id[order], return_index=True)
+    first = order[first]
+
+    # Decode the canonical flow key (see flow_keys) and orient it by the first packet's sender
+    hi, lo = flows.flow_key_hi[first], flows.flow_key_lo[first]
+    low_ips, high_ips = (hi >> np.uint64(32)).astype(np.int64), (hi & np.uint64(0xFFFFFFFF)).astype(np.int64)
+    low_ports = (lo >> np.uint64(24)).astype(np.int64)
+    high_ports = ((lo >> np.uint64(8)) & np.uint64(0xFFFF)).astype(np.int64)
+    forward = flows.src_ip[first] == low_ips
+    frame = pd.DataFrame(
+        {
+            "src_ip": [int_to_ip(ip) for ip in np.where(forward, low_ips, high_ips).tolist()],
+            "dst_ip": [int_to_ip(ip) for ip in np.where(forward, high_ips, low_ips).tolist()],
+            "src_port": np.where(forward, low_ports, high_ports),
+            "dst_port": np.where(forward, high_ports, low_ports),
+            "protocol": (lo & np.uint64(0xFF)).astype(np.int64),
+            "timestamp": flows.time_base + flows.timestamp[first],
+        },
+        index=pd.Index(flow_ids, name="flow_id"),
+    )
+
+    positions = np.searchsorted(flow_ids, flows.flow_id)
+    tcp = flows.tcp != 0
+    for column in COLUMNS_TO_KEEP:
+        if column in FLAG_COUNT_COLUMNS:
+            flags = (flows.columns[FLAG_COUNT_COLUMNS[column]] != 0) & tcp
+            frame[column] = np.bincount(positions, weights=flags, minlength=len(flow_ids)).astype(np.int64)
+        elif column in IAT_TOTAL_COLUMNS:
+            frame[column] = _iat_totals(positions, flows.timestamp, flows.direction == IAT_TOTAL_COLUMNS[column],
+                                        len(flow_ids))
+        else:
+            frame[column] = features[column].reindex(frame.index).to_numpy()
+
+    for count_columns, iat_columns in IAT_COLUMN_GROUPS.items():
+        single_gap = frame[list(count_columns)].sum(axis=1) == 2
+        frame.loc[single_gap, [column for column in iat_columns if column in frame]] = 0.0
+    return frame
+
+
+def _iat_totals(positions, timestamps, in_direction, flow_count):
+    # Fragments share their packet's timestamp, so the IATs of a direction add up to its time span
+    first = np.full(flow_count, np.inf)
+    last = np.full(flow_count, -np.inf)
+    np.minimum.at(first, positions[in_direction], timestamps[in_direction])
+    np.maximum.at(last, positions[in_direction], timestamps[in_direction])
+    return np.where(last > first, last - first, 0.0) * 1000000.0
+
+
+def export_flow_features(truncated_packets, dest_file):
+    """
+    Writes flow_feature_frame to dest_file - Parquet if it ends with .parquet (needs pyarrow), csv otherwise.
+    The file is written under a temporary name and renamed, so readers never see a partial export.
+    """
+    frame = flow_feature_frame(truncated_packets).reset_index()
+    dest_dir, dest_filename = os.path.split(os.path.abspath(dest_file))
+    temporary_file = os.path.join(dest_dir, f".{os.getpid()}-{dest_filename}")
+    try:
+        if dest_file.endswith(".parquet"):
+            frame.to_parquet(temporary_file, index=False)
+        else:
+            frame.to_csv(temporary_file, index=False)
+        os.replace(temporary_file, dest_file)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+    return frame
+
+
+def convert_pcap_natively(source_file, dest_file):
+    """
+    Drop-in replacement of convert_pcap_to_csv that computes the flow features in process instead of running
+    cicflowmeter, e.g. process_directory(..., convert=convert_pcap_natively, converter="native").
+
+    :param source_file: Path to the source pcap or pcapng file.
+    :param dest_file: Path to the destination csv (or .parquet) file.
+    """
+    export_flow_features(assign_flow_ids_to_packets(create_truncated_packets_from_pcap(source_file)), dest_file)
+
+
+def _flow_match_keys(src_ips, src_ports, dst_ips, dst_ports, protocols, timestamps):
+    # Direction-independent 5-tuple plus the flow's rank among the flows of that 5-tuple, in start order
+    src = [(ip_to_int(ip), int(port)) for ip, port in zip(src_ips, src_ports)]
+    dst = [(ip_to_int(ip), int(port)) for ip, port in zip(dst_ips, dst_ports)]
+    keys = pd.Series([(*min(a, b), *max(a, b), int(protocol)) for a, b, protocol in zip(src, dst, protocols)])
+    ranks = pd.Series(np.asarray(timestamps)).groupby(keys.values).rank(method="first").astype(np.int64)
+    return list(zip(keys, ranks))
+
+
+def compare_with_cicflowmeter(pcap_file, cic_csv=None, columns=COLUMNS_TO_KEEP, tolerance=PARITY_TOLERANCE):
+    """
+    Parity check of the native exporter against cicflowmeter on one capture.
+
+    Flows of both exports are matched by their direction-independent 5-tuple and by their order among the
+    flows of that 5-tuple, then every column is compared.
+
+    Parameters:
+    - pcap_file: Capture to export.
+    - cic_csv: cicflowmeter csv of the capture; cicflowmeter is run into a temporary file when missing.
+    - columns: Columns to compare.
+    - tolerance: Relative difference up to which values count as equal.
+
+    Returns:
+    ParityReport
+    """
+    native = flow_feature_frame(assign_flow_ids_to_packets(create_truncated_packets_from_pcap(pcap_file)))
+    if cic_csv is None:
+        with tempfile.TemporaryDirectory() as directory:
+            cic_csv = os.path.join(directory, "cicflowmeter.csv")
+            convert_pcap_to_csv(pcap_file, cic_csv)
+            cic = pd.read_csv(cic_csv)
+    else:
+        cic = pd.read_csv(cic_csv)
+
+    native.index = pd.MultiIndex.from_tuples(_flow_match_keys(
+        native.src_ip, native.src_port, native.dst_ip, native.dst_port, native.protocol, native.timestamp
+    ))
+    cic.index = pd.MultiIndex.from_tuples(_flow_match_keys(
+        cic.src_ip, cic.src_port, cic.dst_ip, cic.dst_port, cic.protocol, pd.to_datetime(cic.timestamp)
+    ))
+    matched = native.index.intersection(cic.index)
+    native_values = native.loc[matched, columns].astype(np.float64)
+    cic_values = cic.loc[matched, columns].astype(np.float64)
+
+    differences = (native_values - cic_values).abs()
+    equal = differences <= tolerance * np.maximum(native_values.abs(), cic_values.abs()) + 1e-9
+    report = pd.DataFrame({
+        "max_abs_diff": differences.max(),
+        "mean_abs_diff": differences.mean(),
+        "equal_share": equal.mean(),
+    })
+    return ParityReport(len(matched), len(native) - len(matched), len(cic) - len(matched), report)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export cicflowmeter flow features of a capture in process.")
+    parser.add_argument("pcap_file", nargs="?", default="../../data/raw/testing_small.pcapng")
+    parser.add_argument("output_path", nargs="?", default="../../data/interim/testing_small_native_flow.csv")
+    parser.add_argument("--parity", action="store_true", help="compare the export with cicflowmeter")
+    parser.add_argument("--cic-csv", help="existing cicflowmeter csv of the capture for --parity")
+    args = parser.parse_args(argv)
+
+    truncated_packets = assign_flow_ids_to_packets(create_truncated_packets_from_pcap(args.pcap_file))
+    frame = export_flow_features(truncated_packets, args.output_path)
+    print(f"Exported {len(frame)} flows of {args.pcap_file} to {args.output_path}")
+    if not args.parity:
+        return
+
+    if args.cic_csv is None and shutil.which("cicflowmeter") is None:
+        print("Skipping the parity check, cicflowmeter is not on the PATH (or pass --cic-csv)")
+        return
+    report = compare_with_cicflowmeter(args.pcap_file, args.cic_csv)
+    print(f"Matched {report.matched} flows ({report.native_only} native only, {report.cic_only} cicflowmeter only)")
+    print(report.columns.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import multiprocessing
+import os
+import random
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from src.operations.genetic_optimization import *
+from src.utils.packet_cache import *
+
+CampaignTask = namedtuple("CampaignTask", ["scenario", "flow_id"])
+CampaignResult = namedtuple(
+    "CampaignResult",
+    [
+        "scenario",
+        "flow_id",
+        "attributes",  # [operation index per round, operation per round] (-1 when a round did not improve)
+        "max_fitness",  # best fitness reached over all rounds
+        "flow_packets",  # PacketTable of the flow with the improving rounds applied
+        "elapsed",
+    ],
+)
+
+# Read-only capture tables of the running campaign. Filled in the parent before the pool starts,
+# so forked workers share them copy-on-write instead of receiving pickled copies per task.
+_SCENARIOS = {}
+_CAMPAIGN_OPTIONS = {}
+
+
+def load_scenario(scenario, pcap_folder="../data/raw/filtered", shards=None, cache=True):
+    """
+    Reads {pcap_folder}/{scenario}.pcap into a PacketTable with flow ids assigned.
+    With shards the capture is parsed in parallel (see read_pcap_shards), with cache the table is kept
+    in a memory-mapped cache file next to the capture (see load_truncated_packets).
+    """
+    return load_truncated_packets(os.path.join(pcap_folder, f"{scenario}.pcap"), shards=shards, cache=cache)
+
+
+def median_flow_id(truncated_packets, min_packets=5):
+    flow_id, _ = select_median_flow(extract_all_flow_features(truncated_packets), flow_packet_counts(truncated_packets),
+                                    min_packets)
+    return flow_id
+
+
+def task_seed(seed, task):
+    # Independent of scheduling: the same task always starts from the same random state
+    return zlib.crc32(f"{seed}:{task.scenario}:{task.flow_id}".encode()) & 0x7FFFFFFF
+
+
+def optimize_flow_rounds(truncated_packets, model_name, flow_id, rounds=5, fitness_batch_size=None, checkpoint=None,
+                         scenario=None):
+    """
+    Runs `rounds` GA optimizations of one flow in a row. Every round starts from the packets left by the
+    previous one, and operations of a round are applied only when it beats the best fitness so far
+    (like process_flow_id in the XAI notebook).
+
+    Only the flow's own packets are copied - the capture itself is never modified.
+
+    With a CheckpointStore every finished round (and every generation inside a round) is recorded under
+    (scenario, flow_id, round). Finished rounds are replayed from their applied operations and an
+    interrupted round continues from its last generation.
+
+    Returns:
+    (attributes, max_fitness, flow_packets)
+    """
+    scenario = model_name if scenario is None else scenario
+    flow_packets = truncated_packets[truncated_packets.flow_rows(flow_id)]
+    max_fitness = [0, None, 0]
+    previous_max = 0
+    attributes = [[], []]
+    # The rounds of a flow revisit many genotypes of the previous ones on the same packets
+    fitness_cache = FitnessCache()
+
+    for round_number in range(rounds):
+        key = (scenario, flow_id, round_number)
+        saved = checkpoint.latest("round", key) if checkpoint is not None else None
+        if saved is not None:
+            max_fitness, applied = saved["max_fitness"], saved["applied"]
+            restore_random_state(saved["random_state"])
+        else:
+            optimizer = FlowOptimizer(flow_packets, model_name, flow_id, max_fitness, fitness_batch_size,
+                                      checkpoint=checkpoint, checkpoint_key=key, fitness_cache=fitness_cache)
+            max_fitness = optimizer.optimize_for_flow()[1]
+            applied = max_fitness[0] > previous_max
+
+        if applied:
+            flow_packets = apply_best_on_packets(flow_packets, (None, max_fitness), flow_id)
+            previous_max = max_fitness[0]
+            operation_index = max_fitness[2]
+            attributes[0].append(operation_index)
+            attributes[1].append(max_fitness[1][operation_index - 1] if operation_index > 0 else None)
+        else:
+            attributes[0].append(-1)
+            attributes[1].append(-1)
+
+        if checkpoint is not None and saved is None:
+            checkpoint.append("round", key, max_fitness=max_fitness, applied=applied,
+                              operations=max_fitness[1] if applied else None, random_state=random_state())
+
+    return attributes, previous_max, flow_packets
+
+
+def run_task(task):
+    """
+    Worker entry point - optimizes one (scenario, flow_id) with the options of the running campaign.
+    """
+    started = time.time()
+    seed = task_seed(_CAMPAIGN_OPTIONS.get("seed", 0), task)
+    np.random.seed(seed)
+    random.seed(seed)
+    attributes, max_fitness, flow_packets = optimize_flow_rounds(
+        _SCENARIOS[task.scenario],
+        task.scenario,
+        task.flow_id,
+        rounds=_CAMPAIGN_OPTIONS.get("rounds", 5),
+        fitness_batch_size=_CAMPAIGN_OPTIONS.get("fitness_batch_size"),
+        checkpoint=_CAMPAIGN_OPTIONS.get("checkpoint"),
+        scenario=task.scenario,
+    )
+    return CampaignResult(task.scenario, task.flow_id, attributes, max_fitness, flow_packets, time.time() - started)
+
+
+def _init_worker(scenarios, options):
+    # Only used when workers cannot be forked - they receive the tables once instead of per task
+    global _SCENARIOS, _CAMPAIGN_OPTIONS
+    if scenarios is not None:
+        _SCENARIOS = scenarios
+        _CAMPAIGN_OPTIONS = options
+
+
+def run_campaign(scenarios, flow_ids=None, rounds=5, processes=None, fitness_batch_size=None, seed=0,
+                 pcap_folder="../data/raw/filtered", checkpoint_path=None):
+    """
+    Optimizes many flows of many scenarios in parallel on a process pool.
+
+    Captures are loaded (and models warmed up) once in the parent. With the fork start method the workers
+    inherit both copy-on-write, so a work item only ships its (scenario, flow_id) and returns the flow's
+    perturbed packets.
+
+    Parameters:
+    - scenarios: Capture names (loaded from pcap_folder) or a dict {capture name: PacketTable with flow ids}.
+    - flow_ids: Optional dict {capture name: list of flow ids}; the median flow of every capture by default.
+    - rounds: GA optimizations chained per flow.
+    - processes: Pool size (os.cpu_count() by default); 1 runs everything in this process.
+    - fitness_batch_size: Passed to FlowOptimizer.
+    - seed: Base seed; every task derives its own seed from it, so results do not depend on scheduling.
+    - checkpoint_path: Optional CheckpointStore file. Finished flows are skipped when the campaign is
+      started again, interrupted flows continue from their last finished round / generation.
+
+    Returns:
+    List of CampaignResult in task order.
+    """
+    global _SCENARIOS, _CAMPAIGN_OPTIONS
+    if not isinstance(scenarios, dict):
+        scenarios = {scenario: load_scenario(scenario, pcap_folder) for scenario in scenarios}
+    if flow_ids is None:
+        flow_ids = {scenario: [median_flow_id(truncated_packets)] for scenario, truncated_packets in scenarios.items()}
+
+    tasks = [
+        CampaignTask(scenario, int(flow_id))
+        for scenario in scenarios
+        for flow_id in flow_ids.get(scenario, [])
+        if flow_id is not None
+    ]
+    checkpoint = CheckpointStore(checkpoint_path) if checkpoint_path is not None else None
+    results = {}
+    if checkpoint is not None:
+        for task in tasks:
+            saved = checkpoint.latest("flow", tuple(task))
+            if saved is not None:
+                results[task] = saved["result"]
+        print(f"Campaign: {len(results)} flows already finished in {checkpoint_path}")
+    pending = [task for task in tasks if task not in results]
+    warm_up_models(list(scenarios), kinds=("RF",))
+
+    _SCENARIOS = scenarios
+    _CAMPAIGN_OPTIONS = {"rounds": rounds, "fitness_batch_size": fitness_batch_size, "seed": seed,
+                         "checkpoint": checkpoint}
+    processes = min(processes or os.cpu_count() or 1, max(len(pending), 1))
+    print(f"Campaign: {len(pending)} flows from {len(scenarios)} scenarios on {processes} processes")
+
+    pool = None
+    try:
+        if processes == 1:
+            completed = map(run_task, pending)
+        else:
+            if "fork" in multiprocessing.get_all_start_methods():
+                context, initargs = multiprocessing.get_context("fork"), (None, None)
+            else:
+                context, initargs = multiprocessing.get_context(), (scenarios, _CAMPAIGN_OPTIONS)
+            pool = context.Pool(processes, initializer=_init_worker, initargs=initargs)
+            completed = pool.imap_unordered(run_task, pending, chunksize=1)
+
+        for result in completed:
+            task = CampaignTask(result.scenario, result.flow_id)
+            results[task] = result
+            if checkpoint is not None:
+                checkpoint.append("flow", tuple(task), result=result)
+            print(f"Completed {result.scenario} flow {result.flow_id}: max fitness {result.max_fitness}, "
+                  f"attributes {result.attributes[0]} ({len(results)}/{len(tasks)}, {result.elapsed:.1f}s)")
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _SCENARIOS, _CAMPAIGN_OPTIONS = {}, {}
+
+    return [results[task] for task in tasks]
@@ -0,0 +1,110 @@
+import os
+import pickle
+import random
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, appends are then only safe from a single process
+    fcntl = None
+
+# Every record is framed as <payload length, crc32 of payload> + pickled payload
+RECORD_HEADER = struct.Struct("<II")
+
+
+class CheckpointStore:
+    """
+    Append-only checkpoint log of GA campaigns.
+
+    Records are small pickled dictionaries with a 'kind' ('generation', 'round', 'flow') and a 'key'
+    (scenario, flow_id[, round]). Every record is appended with a single write under an exclusive file lock
+    and fsync'ed, and it carries its length and crc32. A record torn by a crash is detected and dropped
+    the next time the store is opened, so the log always ends at the last completed record.
+
+    Parameters:
+    - path: Checkpoint file, created on first append.
+    - sync: fsync after every append (a crash of the whole machine may lose the last records otherwise).
+    """
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self._latest = {}  # (kind, key) -> last record
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            data = file.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            record = pickle.loads(payload)
+            self._latest[(record["kind"], record["key"])] = record
+            offset += RECORD_HEADER.size + length
+        if offset < len(data):
+            print(f"Checkpoint {self.path}: dropping {len(data) - offset} bytes of an incomplete record")
+            with open(self.path, "r+b") as file:
+                file.truncate(offset)
+
+    def __len__(self):
+        return len(self._latest)
+
+    def append(self, kind, key, **fields):
+        record = {"kind": kind, "key": key, **fields}
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        frame = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with open(self.path, "ab") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.write(frame)
+                file.flush()
+                if self.sync:
+                    os.fsync(file.fileno())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+        self._latest[(kind, key)] = record
+        return record
+
+    def latest(self, kind, key):
+        """
+        Returns the last record of kind for key, or None.
+        """
+        return self._latest.get((kind, key))
+
+    def records(self, kind=None):
+        return [record for (record_kind, _), record in self._latest.items() if kind is None or record_kind == kind]
+
+    def compact(self):
+        """
+        Rewrites the log with only the last record of every (kind, key). The new file replaces the old one
+        atomically, so a crash during compaction leaves the previous log intact.
+        """
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "wb") as file:
+            for record in self._latest.values():
+                payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+
+def random_state():
+    # Both generators pygad draws from
+    return np.random.get_state(), random.getstate()
+
+
+def restore_random_state(state):
+    numpy_state, python_state = state
+    np.random.set_state(numpy_state)
+    random.setstate(python_state)
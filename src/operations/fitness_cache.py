@@ -0,0 +1,104 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 65536
+# Continuous genes are rounded to this many decimals before lookup. Genotypes closer than that
+# produce practically the same perturbed flow; lower it to trade accuracy for more hits.
+DEFAULT_GENE_DECIMALS = 6
+
+
+class FitnessCache:
+    """
+    Bounded LRU cache of solution fitness values.
+
+    Entries are keyed on (model id, flow_id, base-state version, quantized genotype) and hold the fitness
+    list of solution_fitnesses (unmodified flow followed by every decoded operation). The model id names the
+    scoring model itself (see fitness_model_id), so RF and LR fitness of the same scenario never mix. The
+    base-state version (PerturbationEngine.state_version) changes whenever the flow's packets change, e.g.
+    after a round's operations were applied, so results are only reused on identical flows.
+
+    Create one per run (e.g. per flow, shared by its rounds) and pass it to FlowOptimizer.
+
+    Parameters:
+    - max_entries: How many fitness lists are kept before the least recently used one is evicted.
+    - gene_decimals: Rounding of the continuous genes in the key.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, gene_decimals=DEFAULT_GENE_DECIMALS):
+        self.max_entries = max_entries
+        self.gene_decimals = gene_decimals
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+        if hasattr(os, "register_at_fork"):
+            cache = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: cache() is not None and cache()._after_fork())
+
+    def _after_fork(self):
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # Shipped to process workers with the optimizer - entries stay in this process, workers start empty
+        state = self.__dict__.copy()
+        state["_entries"] = OrderedDict()
+        state["hits"] = state["misses"] = 0
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, model_id, flow_id, state_version, genotype):
+        genotype = np.asarray(genotype, dtype=np.float64)
+        genes = tuple(np.round(genotype[:4], self.gene_decimals).tolist()) + tuple(int(gene) for gene in genotype[4:])
+        return model_id, flow_id, state_version, genes
+
+    def get(self, key):
+        """
+        Returns the cached fitness list for key, or None. Counts a hit or a miss.
+        """
+        with self._lock:
+            fitnesses = self._entries.get(key)
+            if fitnesses is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return fitnesses
+
+    def put(self, key, fitnesses):
+        with self._lock:
+            self._entries[key] = fitnesses
+            self._entries.move_to_end(key)
+            while len(self._entries) > max(self.max_entries, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        Returns:
+        {'hits', 'misses', 'entries', 'hit_rate'} - to tune gene_decimals and max_entries.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
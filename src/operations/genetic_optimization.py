@@ -1,65 +1,277 @@
 import pygad
 import copy
 
+import numpy as np
+
+from src.operations.calculate_fitness import *
+from src.operations.checkpoint import *
+from src.operations.fitness_cache import *
+from src.operations.perturbation_engine import *
+
+NUM_GENERATIONS = 8
+
 class FlowOptimizer:
-    def __init__(self, packets, model_name, flow_id, max_fitness):
+    def __init__(self, packets, model_name, flow_id, max_fitness, fitness_batch_size=None, parallel_processing=None,
+                 checkpoint=None, checkpoint_key=None, fitness_cache=None, fitness_model_kind="RF"):
         self.packets = packets
         self.model_name = model_name
+        # 'RF' or 'LR' fitness classifier of model_name (see get_fitness_model)
+        self.fitness_model_kind = fitness_model_kind
         self.flow_id = flow_id
         self.ga_instance = None
         self.max_fitness = max_fitness
+        # When set, pygad hands solutions to fitness_function_batch in batches of this size
+        self.fitness_batch_size = fitness_batch_size
+        # pygad parallel_processing, e.g. ['thread', 4] or ['process', 4]. Workers only return fitness values,
+        # max_fitness is then folded in solution order by fold_max_fitness in this process.
+        self.parallel_processing = parallel_processing
+        self._engine = None
+        self._folded_fitness = None
+        # Optional CheckpointStore - the GA state is saved after every generation under checkpoint_key
+        # (e.g. (scenario, flow_id, round)) and optimize_for_flow resumes from it
+        self.checkpoint = checkpoint
+        self.checkpoint_key = checkpoint_key if checkpoint_key is not None else (model_name, flow_id)
+        self.max_fitness_history = []
+        self._generation_offset = 0
+        self._best_fitness_prefix = []
+        # Optional FitnessCache, e.g. one per flow shared by its rounds (see optimize_flow_rounds). Process
+        # workers receive an empty copy with every pickled task, so only this process's lookups
+        # (e.g. fold_max_fitness) hit.
+        self.fitness_cache = fitness_cache
+        # FitnessCache.stats() after the last optimize_for_flow, to tune the cache
+        self.fitness_cache_stats = None
+
+    @property
+    def engine(self):
+        # Candidates are evaluated as overlays of the flow, packets are only touched by apply_best_solution
+        return self._ensure_engine()
+
+    def _ensure_engine(self):
+        """
+        Gathers the flow into its PerturbationEngine now instead of on first use, so copies pickled for
+        process workers carry the flow arrays and never need the capture.
+        """
+        if self._engine is None:
+            self._engine = PerturbationEngine(self.packets, self.flow_id)
+        return self._engine
+
+    def __getstate__(self):
+        # pygad's process mode pickles the bound fitness function into every task it submits. Workers only
+        # need the engine's flow arrays, so the capture, the GA and the checkpoint store stay here.
+        self._ensure_engine()
+        state = self.__dict__.copy()
+        for name in ("packets", "ga_instance", "checkpoint", "best_modified_packets"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.packets = self.ga_instance = self.checkpoint = None
         
     def apply_best_solution(self):
-        best_solution, best_solution_fitness, _ = self.ga_instance.best_solution()
+        best_solution, best_solution_fitness, _ = self.ga_instance.best_solution(
+            pop_fitness=self.ga_instance.last_generation_fitness)
         best_operations = self.decode_operations(best_solution)
-        self.best_modified_packets = self.apply_operations_to_packets(best_operations, self.packets, self.flow_id)
+        packets = self.packets.copy() if isinstance(self.packets, PacketTable) else copy.deepcopy(self.packets)
+        self.best_modified_packets = self.engine.materialize(self.engine.apply_all(best_operations), packets)
         return self.best_modified_packets, best_solution_fitness
 
     def on_generation(self, ga_instance):
-        print(f"Flow ID: {self.flow_id}, Generation: {ga_instance.generations_completed}")
-        message = f"Best score: {ga_instance.best_solution()[1]}"
+        print(f"Flow ID: {self.flow_id}, Generation: {self._generation_offset + ga_instance.generations_completed}")
+        # Reuse the generation's fitness, best_solution() would score the whole population again
+        message = f"Best score: {ga_instance.best_solution(pop_fitness=ga_instance.last_generation_fitness)[1]}"
         print(message)
+        self.max_fitness_history.append(self.max_fitness[0])
+        self.save_checkpoint(ga_instance)
+
+    def on_stop(self, ga_instance, population_fitness):
+        if self.parallel_processing:
+            self.fold_max_fitness(ga_instance, population_fitness)
+            if self.max_fitness_history:
+                self.max_fitness_history[-1] = self.max_fitness[0]
+        self.save_checkpoint(ga_instance)
+
+    def save_checkpoint(self, ga_instance):
+        """
+        Records the evaluated population together with the random state pygad continues from, so a resumed
+        run evolves exactly like an uninterrupted one.
+        """
+        if self.checkpoint is None:
+            return
+        self.checkpoint.append(
+            "generation",
+            self.checkpoint_key,
+            generations_completed=self._generation_offset + ga_instance.generations_completed,
+            population=ga_instance.population.copy(),
+            population_fitness=ga_instance.last_generation_fitness.copy(),
+            # pygad's per-generation best fitness, continued across resumed runs for plot_fitness
+            best_solutions_fitness=self._best_fitness_prefix + list(ga_instance.best_solutions_fitness),
+            max_fitness=self.max_fitness,
+            max_fitness_history=list(self.max_fitness_history),
+            random_state=random_state(),
+        )
             
     def on_fitness(self, ga_instance):
         ga_instance.plot_fitness()
 
-    def fitness_function(self, ga_instance, solution, solution_idx):
-        fitnesses = []
+    def solution_fitnesses(self, solution):
+        """
+        Returns (operations, fitnesses) of a solution - fitness of the unmodified flow followed by
+        the fitness after each decoded operation.
+        """
         operations = self.decode_operations(solution)
-        
-        modified_packets = self.packets
-        sizing_stats = prepare_size_stats(modified_packets, self.flow_id)
-        timing_stats = prepare_timing_stats(modified_packets, self.flow_id)
-        fitnesses.append(1.0 - predict_single_flow(self.model_name, sizing_stats, timing_stats))
-        
-        for operation in operations:
-            modified_packets = self.apply_operations_to_packets(operation, operation['op_type'])
-            sizing_stats = prepare_size_stats(modified_packets, self.flow_id)
-            timing_stats = prepare_timing_stats(modified_packets, self.flow_id)
-            fitnesses.append(1.0 - predict_single_flow(self.model_name, sizing_stats, timing_stats))
-        
+        key = self.cache_key(solution)
+        fitnesses = self.fitness_cache.get(key) if key is not None else None
+        if fitnesses is not None:
+            return operations, list(fitnesses)
+
+        # Row 0 is the unmodified flow, rows 1-4 the flow after each decoded operation
+        features = np.empty((len(operations) + 1, len(FEATURE_COLUMNS)), dtype=np.float64)
+        self.engine.features(out=features[0])
+        for i, operation in enumerate(operations, start=1):
+            self.engine.features(self.engine.apply(operation), out=features[i])
+        fitnesses = (1.0 - predict_flows_batch(self.model_name, features, self.fitness_model_kind)).tolist()
+        if key is not None:
+            self.fitness_cache.put(key, tuple(fitnesses))
+        return operations, fitnesses
+
+    def cache_key(self, solution):
+        if self.fitness_cache is None:
+            return None
+        model_id = fitness_model_id(self.model_name, self.fitness_model_kind)
+        return self.fitness_cache.key(model_id, self.flow_id, self.engine.state_version, solution)
+
+    def update_max_fitness(self, operations, fitnesses):
         max_fitness_value = max(fitnesses)
         if max_fitness_value > self.max_fitness[0]:
             self.max_fitness = [max_fitness_value, operations, fitnesses.index(max_fitness_value)]
-        
         return max_fitness_value
 
+    def fitness_function(self, ga_instance, solution, solution_idx):
+        operations, fitnesses = self.solution_fitnesses(solution)
+        if self.parallel_processing:
+            return max(fitnesses)
+        return self.update_max_fitness(operations, fitnesses)
+
+    def fold_max_fitness(self, ga_instance, population_fitness):
+        """
+        on_fitness / on_stop callback of parallel runs: updates max_fitness from the population's fitness
+        values in solution order, exactly like sequential fitness_function calls would. Fitness is
+        deterministic, so the winning solution is simply evaluated again here to recover its operations.
+        """
+        if population_fitness is self._folded_fitness:  # on_stop after a stopped generation
+            return None
+        self._folded_fitness = population_fitness
+        for solution, fitness in zip(ga_instance.population, population_fitness):
+            if fitness > self.max_fitness[0]:
+                self.update_max_fitness(*self.solution_fitnesses(solution))
+        return None
+
+    def fitness_function_batch(self, ga_instance, solutions, solution_indices):
+        """
+        Batch version of fitness_function: the features of every perturbed variant of the batch's solutions
+        are stacked into one matrix and scored with one model call. Solutions found in the fitness cache are not featurized again.
+        Fitness values and max_fitness updates equal fitness_function called for each solution in order.
+        """
+        operations_per_solution = [self.decode_operations(solution) for solution in solutions]
+        keys = [self.cache_key(solution) for solution in solutions]
+        cached = [self.fitness_cache.get(key) if key is not None else None for key in keys]
+        missing = [i for i, fitnesses in enumerate(cached) if fitnesses is None]
+
+        if missing:
+            # Row 0 is the unmodified flow, row 1 + k * 4 + j the flow after operation j of the k-th
+            # solution missing from the cache
+            variants = [operation for i in missing for operation in operations_per_solution[i]]
+            features = np.empty((len(variants) + 1, len(FEATURE_COLUMNS)), dtype=np.float64)
+            self.engine.features(out=features[0])
+            for row, operation in enumerate(variants, start=1):
+                self.engine.features(self.engine.apply(operation), out=features[row])
+            variant_fitnesses = (1.0 - predict_flows_batch(self.model_name, features, self.fitness_model_kind)).tolist()
+            for k, i in enumerate(missing):
+                count = len(operations_per_solution[i])
+                cached[i] = [variant_fitnesses[0]] + variant_fitnesses[1 + k * count:1 + (k + 1) * count]
+                if keys[i] is not None:
+                    self.fitness_cache.put(keys[i], tuple(cached[i]))
+
+        batch_fitness = []
+        for operations, fitnesses in zip(operations_per_solution, cached):
+            fitnesses = list(fitnesses)
+            if self.parallel_processing:
+                batch_fitness.append(max(fitnesses))
+            else:
+                batch_fitness.append(self.update_max_fitness(operations, fitnesses))
+        return batch_fitness
+
+    def create_ga(self, num_generations, initial_population=None):
+        batch_mode = self.fitness_batch_size is not None
+        return pygad.GA(num_generations=num_generations,
+                        initial_population=initial_population,
+                        num_parents_mating=2,
+                        fitness_func=self.fitness_function_batch if batch_mode else self.fitness_function,
+                        fitness_batch_size=self.fitness_batch_size,
+                        parallel_processing=self.parallel_processing,
+                        on_fitness=self.fold_max_fitness if self.parallel_processing else None,
+                        on_stop=self.on_stop,
+                        sol_per_pop=3,                          
+                        mutation_probability=0.6,
+                        on_generation=self.on_generation,
+                        num_genes=6,
+                        gene_space=[{'low': 1.1, 'high': 5.0},
+                                    {'low': 0.25, 'high': 5.0},
+                                    {'low': 1.1, 'high': 3.0},
+                                    {'low': 0.4, 'high': 2.4},
+                                    [0,1,2],
+                                    [0,1,2]])
+
+    def restore_completed_ga(self, saved):
+        """
+        Rebuilds the GA of a checkpoint that already completed NUM_GENERATIONS without evolving it again:
+        the saved population becomes the last generation, so best_solution(), apply_best_solution and
+        plot_fitness work like after an uninterrupted run.
+        """
+        ga_instance = self.create_ga(NUM_GENERATIONS, saved["population"])
+        ga_instance.generations_completed = saved["generations_completed"]
+        if saved.get("population_fitness") is not None:
+            ga_instance.last_generation_fitness = np.array(saved["population_fitness"])
+        else:  # written before the fitness was checkpointed - fitness is deterministic, score it again
+            ga_instance.last_generation_fitness = ga_instance.cal_pop_fitness()
+        best_solutions_fitness = list(saved.get("best_solutions_fitness", []))
+        if len(best_solutions_fitness) <= ga_instance.generations_completed:
+            # on_generation records lack the final population's entry pygad appends when the run ends
+            best_solutions_fitness.append(float(np.max(ga_instance.last_generation_fitness)))
+        ga_instance.best_solutions_fitness = best_solutions_fitness
+        ga_instance.run_completed = True
+        return ga_instance
+
     def optimize_for_flow(self):
-        ga_instance = pygad.GA(num_generations=8,
-                               num_parents_mating=2,
-                               fitness_func=self.fitness_function,
-                               sol_per_pop=3,                          
-                               mutation_probability=0.6,
-                               on_generation=self.on_generation,
-                               num_genes=6,
-                               gene_space=[{'low': 1.1, 'high': 5.0},
-                                           {'low': 0.25, 'high': 5.0},
-                                           {'low': 1.1, 'high': 3.0},
-                                           {'low': 0.4, 'high': 2.4},
-                                           [0,1,2],
-                                           [0,1,2]])
-        
+        saved = self.checkpoint.latest("generation", self.checkpoint_key) if self.checkpoint is not None else None
+        initial_population = None
+        if saved is not None:
+            self.max_fitness = saved["max_fitness"]
+            self.max_fitness_history = list(saved["max_fitness_history"])
+            self._generation_offset = saved["generations_completed"]
+            print(f"Flow ID: {self.flow_id}, resuming after generation {self._generation_offset} from checkpoint")
+            # An on_stop record also holds its final population's entry, which the resumed run adds again
+            self._best_fitness_prefix = list(saved.get("best_solutions_fitness", []))[:self._generation_offset]
+            if self._generation_offset >= NUM_GENERATIONS:
+                self.ga_instance = self.restore_completed_ga(saved)
+                restore_random_state(saved["random_state"])
+                return self.ga_instance, self.max_fitness
+            # pygad scores the initial population again before its first generation
+            initial_population = saved["population"]
+
+        if self.parallel_processing:
+            # Load the model and gather the flow before pygad starts its workers. Process workers get the
+            # optimizer pickled with every solution (see __getstate__) and load the model once per worker.
+            get_fitness_model(self.model_name, self.fitness_model_kind)
+            self._ensure_engine()
+        ga_instance = self.create_ga(NUM_GENERATIONS - self._generation_offset, initial_population)
+
+        if saved is not None:
+            restore_random_state(saved["random_state"])
         ga_instance.run()
+        self.ga_instance = ga_instance
+        self.fitness_cache_stats = self.fitness_cache.stats() if self.fitness_cache is not None else None
         return ga_instance, self.max_fitness
 
     def decode_operations(self, genotype):
@@ -99,13 +311,6 @@ def apply_best_on_packets(packets, best_solution, flow_id):
     """
     
     operations = best_solution[1][1]  # Assuming best_solution format is [fitness, [operations], index]
-    for operation in operations:
-        if operation['op_type'] == 'size_norm':
-            packets = adjust_packet_size(packets, flow_id, operation['direction'], 'normal', operation['scaling_factor'], operation['focus_point'])
-        elif operation['op_type'] == 'size_uni':
-            packets = adjust_packet_size(packets, flow_id, operation['direction'], 'uniform', operation['scaling_factor'], operation['focus_point'])
-        elif operation['op_type'] == 'time_norm':
-            packets = apply_time_perturbation_with_focus(packets, flow_id, 'normal', operation['focus_point'], operation['scaling_factor'])
-        elif operation['op_type'] == 'time_uni':
-            packets = apply_time_perturbation_with_focus(packets, flow_id, 'uniform', operation['focus_point'], operation['scaling_factor'])
-    return packets
+    # All operations are chained on the flow's overlay and written into the packets once
+    engine = PerturbationEngine(packets, flow_id)
+    return engine.materialize(engine.apply_all(operations))
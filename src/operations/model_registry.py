@@ -0,0 +1,178 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import joblib
+
+# Relative to the notebooks folder, like the paths predict_single_flow used to hardcode.
+# Override with the MODELS_ROOT / FITNESS_MODELS_ROOT environment variables or configure_model_roots().
+DEFAULT_MODELS_ROOT = os.environ.get("MODELS_ROOT", "../models")
+DEFAULT_FITNESS_MODELS_ROOT = os.environ.get("FITNESS_MODELS_ROOT")
+DEFAULT_MAX_MODELS = 16
+
+# Model kinds: fitness classifiers (joblib pickles) and target regressors (CatBoost)
+FITNESS_MODEL_KINDS = ("RF", "LR")
+TARGET_MODEL_KIND = "target"
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded fitness and target models with an LRU bound.
+
+    Every model is loaded once and then shared. Lookups are guarded by a lock so threads can share the
+    registry; after a fork the child gets a fresh lock and keeps the already loaded models (copy-on-write),
+    so warming up before starting worker processes loads each model only once.
+
+    Parameters:
+    - models_root: Folder of the CatBoost target models ({model_name}_regressor_model.cbm).
+    - fitness_models_root: Folder of the fitness models ({model_name}_{RF|LR}_model.pkl),
+      models_root/fitness by default.
+    - max_models: How many models are kept loaded before the least recently used one is evicted.
+    """
+
+    def __init__(self, models_root=DEFAULT_MODELS_ROOT, fitness_models_root=DEFAULT_FITNESS_MODELS_ROOT,
+                 max_models=DEFAULT_MAX_MODELS):
+        self.models_root = models_root
+        self.fitness_models_root = fitness_models_root
+        self.max_models = max_models
+        self._models = OrderedDict()  # (kind, model_name) -> model, least recently used first
+        self._lock = threading.RLock()
+        self.loads = 0
+
+        if hasattr(os, "register_at_fork"):
+            registry = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: registry() is not None and registry()._after_fork())
+
+    def _after_fork(self):
+        # The lock may have been held by another thread of the parent at fork time
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # Models are not shipped to spawned processes, they are loaded again on first use
+        state = self.__dict__.copy()
+        state["_models"] = OrderedDict()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def configure(self, models_root=None, fitness_models_root=None, max_models=None):
+        """
+        Changes model folders and/or the LRU bound. Changing a folder evicts all loaded models.
+        """
+        with self._lock:
+            if models_root is not None or fitness_models_root is not None:
+                if models_root is not None:
+                    self.models_root = models_root
+                if fitness_models_root is not None:
+                    self.fitness_models_root = fitness_models_root
+                self._models.clear()
+            if max_models is not None:
+                self.max_models = max_models
+                self._evict_over_limit()
+
+    def model_path(self, kind, model_name):
+        if kind in FITNESS_MODEL_KINDS:
+            root = self.fitness_models_root or os.path.join(self.models_root, "fitness")
+            return os.path.join(root, f"{model_name}_{kind}_model.pkl")
+        if kind == TARGET_MODEL_KIND:
+            return os.path.join(self.models_root, f"{model_name}_regressor_model.cbm")
+        raise ValueError(f"Unknown model kind: {kind}")
+
+    def _load(self, kind, model_name):
+        path = self.model_path(kind, model_name)
+        if kind == TARGET_MODEL_KIND:
+            from catboost import CatBoostRegressor
+            model = CatBoostRegressor()
+            model.load_model(path)
+        else:
+            model = joblib.load(path)
+        self.loads += 1
+        return model
+
+    def _evict_over_limit(self):
+        while len(self._models) > max(self.max_models, 0):
+            self._models.popitem(last=False)
+
+    def get(self, kind, model_name):
+        """
+        Returns the loaded model, loading it on first use.
+
+        Parameters:
+        - kind: 'RF' or 'LR' for fitness classifiers, 'target' for the CatBoost target regressor.
+        - model_name: Capture name the model was trained on, e.g. botnet-capture-20110812-rbot.
+        """
+        key = (kind, model_name)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._load(kind, model_name)
+                self._models[key] = model
+                self._evict_over_limit()
+            else:
+                self._models.move_to_end(key)
+            return model
+
+    def warm_up(self, model_names, kinds=("RF", TARGET_MODEL_KIND)):
+        """
+        Loads the given models ahead of time, e.g. before forking workers.
+        """
+        for model_name in model_names:
+            for kind in kinds:
+                self.get(kind, model_name)
+
+    def evict(self, model_name=None, kind=None):
+        """
+        Drops loaded models matching model_name and/or kind (everything when both are None).
+
+        Returns:
+        Number of evicted models.
+        """
+        with self._lock:
+            keys = [
+                key for key in self._models
+                if (kind is None or key[0] == kind) and (model_name is None or key[1] == model_name)
+            ]
+            for key in keys:
+                del self._models[key]
+            return len(keys)
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def get_fitness_model(model_name, kind="RF"):
+    return MODEL_REGISTRY.get(kind, model_name)
+
+
+def fitness_model_id(model_name, kind="RF"):
+    """
+    Identity of the fitness model get_fitness_model would use - its absolute path, which covers the kind and
+    the configured root - e.g. to key cached fitness values.
+    """
+    return os.path.abspath(MODEL_REGISTRY.model_path(kind, model_name))
+
+
+def get_target_model(model_name):
+    return MODEL_REGISTRY.get(TARGET_MODEL_KIND, model_name)
+
+
+def configure_model_roots(models_root=None, fitness_models_root=None, max_models=None):
+    MODEL_REGISTRY.configure(models_root, fitness_models_root, max_models)
+
+
+def warm_up_models(model_names, kinds=("RF", TARGET_MODEL_KIND)):
+    MODEL_REGISTRY.warm_up(model_names, kinds)
+
+
+def evict_models(model_name=None, kind=None):
+    return MODEL_REGISTRY.evict(model_name, kind)
@@ -0,0 +1,177 @@
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+
+from src.operations.size_perturbation_logic import adjusted_sizes
+from src.operations.timing_perturbation_logic import focus_distribution, generate_weights, perturbed_timestamps
+from src.utils.flow_features import features_from_statistics, size_statistics, timing_statistics
+from src.utils.truncated_packet import PacketTable
+
+# Perturbed columns of one flow, aligned with PerturbationEngine.positions, and their feature statistics
+# (size_statistics / timing_statistics). Arrays are never modified in place - an operation returns a new
+# overlay and shares every column and statistic it does not touch.
+FlowOverlay = namedtuple("FlowOverlay", ["size", "fragmented", "timestamp", "size_stats", "timing_stats"])
+
+SIZE_OPERATIONS = {"size_norm": "normal", "size_uni": "uniform"}
+TIME_OPERATIONS = {"time_norm": "normal", "time_uni": "uniform"}
+
+
+class PerturbationEngine:
+    """
+    Evaluates perturbations of a single flow without copying packets.
+
+    The flow's size/fragmented/timestamp columns are gathered once from the base capture, which is never
+    modified. Every candidate operation produces a FlowOverlay - new arrays for the flow's packets only -
+    that can be featurized directly and written back into the packets with materialize() once a solution
+    is chosen.
+
+    Features are maintained incrementally: an overlay carries per-direction sufficient statistics, a size
+    operation recomputes only the size statistics of the direction it changes (and the IAT statistics only
+    if fragmentation changed), a time operation only the IAT statistics.
+
+    Parameters:
+    - truncated_packets: A PacketTable or a list of TruncatedPacket objects with flow ids assigned.
+    - flow_id: The flow to perturb.
+    """
+
+    def __init__(self, truncated_packets, flow_id):
+        self.truncated_packets = truncated_packets
+        self.flow_id = flow_id
+        if isinstance(truncated_packets, PacketTable):
+            self.positions = truncated_packets.flow_rows(flow_id)
+            flow_packets = truncated_packets[self.positions]
+        else:
+            self.positions = np.array(
+                [i for i, packet in enumerate(truncated_packets) if packet.flow_id == flow_id], dtype=np.int64
+            )
+            flow_packets = PacketTable.from_packets([truncated_packets[i] for i in self.positions])
+        self.time_base = flow_packets.time_base
+        self.directions = flow_packets.direction
+        self.base = FlowOverlay(
+            flow_packets.size,
+            flow_packets.fragmented,
+            flow_packets.timestamp,
+            size_statistics(flow_packets.size, flow_packets.fragmented, self.directions),
+            timing_statistics(flow_packets.fragmented, flow_packets.timestamp, self.directions),
+        )
+        self._state_version = None
+
+    @property
+    def state_version(self):
+        """
+        Digest of the flow's unmodified columns - equal for engines over identical flows, so results computed
+        on one base state can be reused (see FitnessCache) until the flow's packets change.
+        """
+        if self._state_version is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(np.int64(self.time_base).tobytes())
+            for column in self.flow_arrays():
+                digest.update(np.ascontiguousarray(column).tobytes())
+            self._state_version = digest.hexdigest()
+        return self._state_version
+
+    def __getstate__(self):
+        # Process workers only featurize overlays of the flow - the capture stays in this process, the
+        # state digest is computed once here instead of in every worker
+        state = self.__dict__.copy()
+        state["truncated_packets"] = None
+        state["_state_version"] = self.state_version
+        return state
+
+    def __len__(self):
+        return len(self.positions)
+
+    def apply(self, operation, overlay=None):
+        """
+        Applies one decoded operation (see FlowOptimizer.decode_operations) on top of overlay
+        (the unmodified flow by default) and returns the resulting FlowOverlay.
+        Results equal adjust_packet_size / apply_time_perturbation_with_focus on a copy of the packets.
+        """
+        overlay = self.base if overlay is None else overlay
+        op_type = operation['op_type']
+        scaling_factor = operation['scaling_factor']
+        focus_point = operation['focus_point']
+
+        if op_type in SIZE_OPERATIONS:
+            direction = operation['direction']
+            rows = slice(None) if direction == 0 else self.directions == direction
+            sizes, fragmented = overlay.size.copy(), overlay.fragmented.copy()
+            sizes[rows], fragmented[rows] = adjusted_sizes(
+                overlay.size[rows], overlay.fragmented[rows], SIZE_OPERATIONS[op_type], scaling_factor, focus_point
+            )
+            timing_stats = overlay.timing_stats
+            if not np.array_equal(fragmented, overlay.fragmented):  # fragments add IATs of 0
+                timing_stats = timing_statistics(fragmented, overlay.timestamp, self.directions)
+            return overlay._replace(
+                size=sizes,
+                fragmented=fragmented,
+                size_stats=size_statistics(sizes, fragmented, self.directions, overlay.size_stats, int(direction)),
+                timing_stats=timing_stats,
+            )
+
+        if op_type in TIME_OPERATIONS:
+            if len(self) < 2:  # nothing to perturb, like apply_time_perturbation_with_focus
+                return overlay
+            if TIME_OPERATIONS[op_type] == 'normal':
+                mean, stddev = focus_distribution(len(self), focus_point, scaling_factor)
+                weights = lambda length: generate_weights(length, mean, stddev)
+            else:
+                weights = lambda length: scaling_factor
+            timestamps = perturbed_timestamps(overlay.timestamp, weights)
+            return overlay._replace(
+                timestamp=timestamps, timing_stats=timing_statistics(overlay.fragmented, timestamps, self.directions)
+            )
+
+        raise ValueError(f"Unsupported operation type: {op_type}")
+
+    def apply_all(self, operations, overlay=None):
+        """
+        Applies the operations one after another, like apply_best_on_packets.
+        """
+        for operation in operations:
+            overlay = self.apply(operation, overlay)
+        return overlay
+
+    def flow_arrays(self, overlay=None):
+        """
+        (sizes, fragmented, timestamps, directions) of the perturbed flow, the input of flow_features.
+        """
+        overlay = self.base if overlay is None else overlay
+        return overlay.size, overlay.fragmented, overlay.timestamp, self.directions
+
+    def features(self, overlay=None, out=None):
+        """
+        FEATURE_COLUMNS row of the perturbed flow, assembled from the overlay's statistics.
+        """
+        overlay = self.base if overlay is None else overlay
+        return features_from_statistics(overlay.size_stats, overlay.timing_stats, out=out)
+
+    def materialize(self, overlay, truncated_packets=None):
+        """
+        Writes the overlay into the packets - the base packets by default, or a copy of them
+        (same PacketTable layout / list order) given as truncated_packets.
+
+        Returns:
+        The updated packets.
+        """
+        truncated_packets = self.truncated_packets if truncated_packets is None else truncated_packets
+        if isinstance(truncated_packets, PacketTable):
+            timestamps = overlay.timestamp + (self.time_base - truncated_packets.time_base)
+            truncated_packets.size[self.positions] = overlay.size
+            truncated_packets.fragmented[self.positions] = overlay.fragmented
+            truncated_packets.timestamp[self.positions] = timestamps
+            return truncated_packets
+
+        changed = (
+            (overlay.size != self.base.size)
+            | (overlay.fragmented != self.base.fragmented)
+            | (overlay.timestamp != self.base.timestamp)
+        )
+        for i in np.flatnonzero(changed):
+            packet = truncated_packets[self.positions[i]]
+            packet.size = int(overlay.size[i])
+            packet.fragmented = int(overlay.fragmented[i])
+            if overlay.timestamp[i] != self.base.timestamp[i]:
+                packet.timestamp = self.time_base + float(overlay.timestamp[i])
+        return truncated_packets
@@ -2,6 +2,8 @@ import numpy as np
 from scipy.stats import norm
 import copy
 
+from src.utils.truncated_packet import PacketTable
+
 def generate_weights(length, focus_point='middle', scaling_factor=1.0):
     """
     Generates weights for adjusting sizes or timestamps based on a normal distribution,
@@ -39,6 +41,14 @@ def adjust_packet_size(truncated_packets, flow_id, direction, method='uniform',
     - scaling_factor: Scaling factor for the size adjustment.
     - focus_point: Specifies the focus point for 'normal' distribution adjustment ('start', 'middle', 'end').
     """
+    if isinstance(truncated_packets, PacketTable):
+        positions = truncated_packets.flow_rows(flow_id, direction)
+        sizes, fragmented = adjusted_sizes(truncated_packets.size[positions], truncated_packets.fragmented[positions],
+                                           method, scaling_factor, focus_point)
+        truncated_packets.size[positions] = sizes
+        truncated_packets.fragmented[positions] = fragmented
+        return truncated_packets
+
     if direction == 0:
         filtered_packets = [p for p in truncated_packets if p.flow_id == flow_id]
     else:
@@ -72,7 +82,36 @@ def adjust_packet_size(truncated_packets, flow_id, direction, method='uniform',
     return truncated_packets
 
 
+def adjusted_sizes(sizes, fragmented, method='uniform', scaling_factor=1.0, focus_point='middle'):
+    """
+    Vectorized counterpart of the per-packet loop in adjust_packet_size. Takes the sizes and fragmented levels
+    of the selected packets (in flow order) and returns their adjusted copies.
+    """
+    num_packets = len(sizes)
+    if method == 'normal':
+        weights = generate_weights(num_packets, focus_point=focus_point, scaling_factor=scaling_factor)[:num_packets]
+    else:
+        weights = np.full(num_packets, scaling_factor)
+
+    target_sizes = sizes * weights
+    increased = target_sizes > sizes
+    decreased = target_sizes < sizes
+
+    new_sizes = np.where(increased, np.minimum(target_sizes, 1500).astype(sizes.dtype), sizes)
+    new_fragmented = np.where(
+        decreased,
+        np.where((sizes >= 300) & (target_sizes < sizes * 1 / 4), 2,
+                 np.where((sizes >= 150) & (target_sizes < sizes * 3 / 4), 1, 0)),
+        fragmented,
+    ).astype(fragmented.dtype)
+    return new_sizes, new_fragmented
+
+
 def adjust_packet_size_deepcopy(truncated_packets, flow_id, direction, method='uniform', scaling_factor=1.0, focus_point='middle'):
+    if isinstance(truncated_packets, PacketTable):
+        # Fancy indexing copies the flow's columns only, the base table is left untouched
+        flow_packets = truncated_packets[truncated_packets.flow_rows(flow_id)]
+        return adjust_packet_size(flow_packets, flow_id, direction, method, scaling_factor, focus_point)
 
     filtered_packets = [p for p in truncated_packets if p.flow_id == flow_id]
     filtered_packets_copy = copy.deepcopy(filtered_packets)
@@ -2,6 +2,8 @@ import numpy as np
 from scipy.stats import norm
 import copy
 
+from src.utils.truncated_packet import PacketTable
+
 
 def generate_weights(length, mean, stddev):
     """
@@ -23,10 +25,65 @@ def rebuild_timestamps(flow_packets, adjusted_deltas):
             flow_packets[i + 1].timestamp = timestamp
 
 
+def rebuilt_timestamps(first_timestamp, adjusted_deltas):
+    """
+    Vectorized rebuild_timestamps - returns the timestamps of all packets of the flow (first one included).
+    Accumulates sequentially, so the result matches rebuild_timestamps exactly.
+    """
+    return np.add.accumulate(np.concatenate(([first_timestamp], adjusted_deltas)))
+
+
+def perturbed_timestamps(timestamps, weights):
+    """
+    Array version of the timestamp perturbations: deltas between the time-sorted timestamps are scaled by
+    weights(number of deltas), capped at 239 and accumulated again from the first timestamp.
+
+    Returns:
+    New timestamps aligned with the input order.
+    """
+    new_timestamps = np.empty_like(timestamps)
+    if not timestamps.size:
+        return new_timestamps
+    order = np.argsort(timestamps, kind="stable")
+    deltas = np.diff(timestamps[order])
+    adjusted_deltas = np.minimum(deltas * weights(len(deltas)), 239)
+    new_timestamps[order] = rebuilt_timestamps(timestamps[order[0]], adjusted_deltas)
+    return new_timestamps
+
+
+def focus_distribution(num_packets, focus_point='middle', scaling_factor=1.0):
+    """
+    Mean and stddev of the 'normal' time perturbation for a flow of num_packets packets.
+    """
+    # Determine mean and stddev based on focus_point for the normal distribution
+    if focus_point == 'start':
+        mean = num_packets * 0.25
+    elif focus_point == 'end':
+        mean = num_packets * 0.75
+    else:  # Default to 'middle'
+        mean = num_packets / 2
+    if isinstance(scaling_factor, str):
+        raise ValueError(f"scaling_factor can't be string: {scaling_factor}")
+    # Use a scaling factor to adjust the spread of the distribution
+    stddev = max(num_packets / (10 * scaling_factor), 1)  # Ensure stddev is at least 1 to avoid division by zero
+    return mean, stddev
+
+
+def _perturb_table_timestamps(truncated_packets, flow_id, weights):
+    positions = truncated_packets.flow_rows(flow_id)
+    if positions.size:
+        truncated_packets.timestamp[positions] = perturbed_timestamps(truncated_packets.timestamp[positions], weights)
+    return truncated_packets
+
+
 def apply_uniform_perturbation_deepcopy(truncated_packets, flow_id, scaling_factor=1.0):
     """
     Uniformly adjusts timestamps within a specified flow_id, ensuring no adjusted delta exceeds 239.
     """
+    if isinstance(truncated_packets, PacketTable):
+        flow_packets = truncated_packets[truncated_packets.flow_rows(flow_id)]
+        return apply_uniform_perturbation(flow_packets, flow_id, scaling_factor) if len(flow_packets) else truncated_packets
+
     flow_packets = sorted([p for p in truncated_packets if p.flow_id == flow_id], key=lambda p: p.timestamp)
     if not flow_packets:
         return truncated_packets
@@ -46,6 +103,10 @@ def apply_normal_perturbation_deepcopy(truncated_packets, flow_id, mean, stddev)
     Adjusts timestamps within a specified flow_id based on a normal distribution with specified mean and stddev,
     ensuring no adjusted delta exceeds 239.
     """
+    if isinstance(truncated_packets, PacketTable):
+        flow_packets = truncated_packets[truncated_packets.flow_rows(flow_id)]
+        return apply_normal_perturbation(flow_packets, flow_id, mean, stddev) if len(flow_packets) else truncated_packets
+
     flow_packets = sorted([p for p in truncated_packets if p.flow_id == flow_id], key=lambda p: p.timestamp)
     if not flow_packets:
         return truncated_packets
@@ -66,22 +127,15 @@ def apply_time_perturbation_with_focus_deepcopy(truncated_packets, flow_id, meth
     Applies perturbation with a focus point and scaling factor for the 'normal' method, automatically calculating
     mean and stddev based on the focus point.
     """
-    num_packets = sum(1 for p in truncated_packets if p.flow_id == flow_id)
+    if isinstance(truncated_packets, PacketTable):
+        num_packets = len(truncated_packets.flow_rows(flow_id))
+    else:
+        num_packets = sum(1 for p in truncated_packets if p.flow_id == flow_id)
     if num_packets < 2:
         print("Not enough packets to apply perturbation.")
         return truncated_packets
 
-    # Determine mean and stddev based on focus_point for the normal distribution
-    if focus_point == 'start':
-        mean = num_packets * 0.25
-    elif focus_point == 'end':
-        mean = num_packets * 0.75
-    else:  # Default to 'middle'
-        mean = num_packets / 2
-    if isinstance(scaling_factor, str):
-        raise ValueError(f"scaling_factor can't be string: {scaling_factor}")
-    # Use a scaling factor to adjust the spread of the distribution
-    stddev = max(num_packets / (10 * scaling_factor), 1)  # Ensure stddev is at least 1 to avoid division by zero
+    mean, stddev = focus_distribution(num_packets, focus_point, scaling_factor)
 
     if method == 'normal':
         return apply_normal_perturbation_deepcopy(truncated_packets, flow_id, mean, stddev)
@@ -96,22 +150,15 @@ def apply_time_perturbation_with_focus(truncated_packets, flow_id, method, focus
     Applies perturbation with a focus point and scaling factor for the 'normal' method, automatically calculating
     mean and stddev based on the focus point.
     """
-    num_packets = sum(1 for p in truncated_packets if p.flow_id == flow_id)
+    if isinstance(truncated_packets, PacketTable):
+        num_packets = len(truncated_packets.flow_rows(flow_id))
+    else:
+        num_packets = sum(1 for p in truncated_packets if p.flow_id == flow_id)
     if num_packets < 2:
         print("Not enough packets to apply perturbation.")
         return truncated_packets
 
-    # Determine mean and stddev based on focus_point for the normal distribution
-    if focus_point == 'start':
-        mean = num_packets * 0.25
-    elif focus_point == 'end':
-        mean = num_packets * 0.75
-    else:  # Default to 'middle'
-        mean = num_packets / 2
-    if isinstance(scaling_factor, str):
-        raise ValueError(f"scaling_factor can't be string: {scaling_factor}")
-    # Use a scaling factor to adjust the spread of the distribution
-    stddev = max(num_packets / (10 * scaling_factor), 1)  # Ensure stddev is at least 1 to avoid division by zero
+    mean, stddev = focus_distribution(num_packets, focus_point, scaling_factor)
 
     if method == 'normal':
         return apply_normal_perturbation(truncated_packets, flow_id, mean, stddev)
@@ -125,6 +172,9 @@ def apply_uniform_perturbation(truncated_packets, flow_id, scaling_factor=1.0):
     """
     Uniformly adjusts timestamps within a specified flow_id, ensuring no adjusted delta exceeds 239.
     """
+    if isinstance(truncated_packets, PacketTable):
+        return _perturb_table_timestamps(truncated_packets, flow_id, lambda length: scaling_factor)
+
     flow_packets = sorted([p for p in truncated_packets if p.flow_id == flow_id], key=lambda p: p.timestamp)
     if not flow_packets:
         return truncated_packets
@@ -143,6 +193,9 @@ def apply_normal_perturbation(truncated_packets, flow_id, mean, stddev):
     Adjusts timestamps within a specified flow_id based on a normal distribution with specified mean and stddev,
     ensuring no adjusted delta exceeds 239.
     """
+    if isinstance(truncated_packets, PacketTable):
+        return _perturb_table_timestamps(truncated_packets, flow_id, lambda length: generate_weights(length, mean, stddev))
+
     flow_packets = sorted([p for p in truncated_packets if p.flow_id == flow_id], key=lambda p: p.timestamp)
     if not flow_packets:
         return truncated_packets
@@ -1,17 +1,215 @@
 import scapy
 from scapy.all import IP, TCP, UDP, rdpcap
+import bisect
 from collections import defaultdict
 
+import numpy as np
+
+from src.utils.truncated_packet import NO_FLOW, NO_KEY, PacketTable
+
 TCP_EXPIRATION = 240  # typical MSL (Maximum Segment Lifetime) for TCP
 UDP_EXPIRATION = 240 # Sufficiently long for UDP
 
 from collections import defaultdict
 
+
+class FlowIndex:
+    """
+    flow_id -> packet positions of a PacketTable, split by direction. Positions of every flow (and of every
+    direction within a flow) are contiguous slices of two sorted orders, so looking a flow up costs a binary
+    search plus a view of its own packets instead of a scan over the whole capture.
+
+    Parameters:
+    - flow_ids: flow_id column of the table.
+    - directions: direction column of the table.
+    """
+
+    def __init__(self, flow_ids, directions):
+        # Stable sorts keep capture order inside every flow and every (flow, direction) pair
+        self._by_flow = np.argsort(flow_ids, kind="stable")
+        self._by_direction = np.lexsort((directions, flow_ids))
+        self.flow_ids, starts, counts = np.unique(flow_ids[self._by_flow], return_index=True, return_counts=True)
+        self._starts = starts
+        self._ends = starts + counts
+
+        # Directions are 0 (unassigned), 1 (forward) and 2 (backward), in this order inside each flow
+        sorted_directions = directions[self._by_direction]
+        self._direction_starts = np.empty((len(self.flow_ids), 4), dtype=np.int64)
+        self._direction_starts[:, 0] = starts
+        for direction in (1, 2, 3):
+            self._direction_starts[:, direction] = starts + np.add.reduceat(
+                sorted_directions < direction, starts
+            ) if len(starts) else starts
+
+    @classmethod
+    def from_table(cls, truncated_packets):
+        return cls(truncated_packets.flow_id, truncated_packets.direction)
+
+    def __len__(self):
+        return len(self.flow_ids)
+
+    def __contains__(self, flow_id):
+        return self._lookup(flow_id) is not None
+
+    def _lookup(self, flow_id):
+        flow_id = NO_FLOW if flow_id is None else flow_id
+        i = int(np.searchsorted(self.flow_ids, flow_id))
+        if i < len(self.flow_ids) and self.flow_ids[i] == flow_id:
+            return i
+        return None
+
+    def positions(self, flow_id, direction=0):
+        """
+        Returns the table positions (in capture order) of packets in flow_id; direction 0 means both.
+        """
+        i = self._lookup(flow_id)
+        if i is None:
+            return np.empty(0, dtype=np.int64)
+        if direction == 0:
+            return self._by_flow[self._starts[i]:self._ends[i]]
+        return self._by_direction[self._direction_starts[i, direction]:self._direction_starts[i, direction + 1]]
+
+    def packet_count(self, flow_id, direction=0):
+        return len(self.positions(flow_id, direction))
+
+
+def assign_flow_ids(flow_keys_hi, flow_keys_lo, timestamps, src_ips, tcp, fin):
+    """
+    Vectorized flow assembly over packet columns, with the same rules (and the same flow numbering) as
+    assign_flow_ids_to_packets: packets are grouped by flow key (groups numbered in order of their first
+    packet), sorted by time within a group, and a group is split into flows at expiry gaps and by the FIN rules.
+
+    Expiry breaks come from np.diff of the sorted timestamps. The FIN rules depend on what happened earlier in
+    the flow, so they are replayed packet by packet - but only from the first FIN of a group, and skipping
+    ahead to the next FIN whenever no FIN is pending.
+
+    Parameters:
+    - flow_keys_hi, flow_keys_lo: Canonical 5-tuple key columns (see flow_keys), flow_key_lo is NO_KEY for
+      packets without TCP/UDP layer.
+    - timestamps: Absolute timestamps (seconds).
+    - src_ips, tcp, fin: Packet columns.
+
+    Returns:
+    (rows, flow_ids, directions) - positions of the packets with a flow key and their flow ids / directions.
+    """
+    rows = np.flatnonzero(flow_keys_lo != NO_KEY)
+    keys_hi, keys_lo = flow_keys_hi[rows], flow_keys_lo[rows]
+
+    # Integer sort of the keys; lexsort is stable, so every run of equal keys starts with its first packet
+    by_key = np.lexsort((keys_lo, keys_hi))
+    key_starts = np.ones(len(rows), dtype=bool)
+    key_starts[1:] = (np.diff(keys_hi[by_key]) != 0) | (np.diff(keys_lo[by_key]) != 0)
+    print(f"hash groups: {int(np.count_nonzero(key_starts))}")
+    group_ranks = np.empty(int(np.count_nonzero(key_starts)), dtype=np.int64)
+    group_ranks[np.argsort(by_key[key_starts], kind="stable")] = np.arange(len(group_ranks))
+    packet_groups = np.empty(len(rows), dtype=np.int64)
+    packet_groups[by_key] = group_ranks[np.cumsum(key_starts) - 1]
+
+    # Stable: packets with equal timestamps stay in capture order, like list.sort
+    order = np.lexsort((timestamps[rows], packet_groups))
+    rows = rows[order]
+    groups = packet_groups[order]
+    times = timestamps[rows]
+    fins = fin[rows] != 0
+
+    group_starts = np.empty(len(rows), dtype=bool)
+    group_starts[:1] = True
+    group_starts[1:] = groups[1:] != groups[:-1]
+    gaps = np.zeros(len(rows), dtype=np.float64)
+    gaps[1:] = np.diff(times)
+    gaps[group_starts] = 0
+    expirations = np.where(tcp[rows] != 0, TCP_EXPIRATION, UDP_EXPIRATION)
+    expired = gaps >= expirations
+    flow_starts = group_starts | expired
+
+    _apply_fin_rules(flow_starts, expired, group_starts, times, fins)
+
+    flow_ids = np.cumsum(flow_starts)
+    flow_sources = src_ips[rows][flow_starts]
+    directions = np.where(src_ips[rows] == flow_sources[flow_ids - 1], 1, 2)
+    return rows, flow_ids, directions
+
+
+def _apply_fin_rules(flow_starts, expired, group_starts, times, fins):
+    """
+    Replays the FIN rules of assign_flow_ids_to_packets on time-sorted packets and marks the flows they start
+    in flow_starts (which already holds group starts and expiry breaks). A packet starting a flow does not
+    count its own FIN.
+    """
+    fin_positions = np.flatnonzero(fins)
+    if not fin_positions.size:
+        return
+    group_ends = np.append(np.flatnonzero(group_starts)[1:], len(flow_starts))
+    group_end_of = group_ends[np.cumsum(group_starts) - 1]
+    times, fins, expired = times.tolist(), fins.tolist(), expired.tolist()
+    fin_list = fin_positions.tolist()
+
+    k = 0
+    while k < len(fin_list):
+        i, end = fin_list[k], int(group_end_of[fin_list[k]])
+        fin_count, last_fin, new_flow_needed = 0, None, False
+        while i < end:
+            if last_fin is None and not new_flow_needed and not fins[i]:
+                # Nothing pending: only expiry can start a flow until the next FIN of the group
+                k = bisect.bisect_left(fin_list, i)
+                if k == len(fin_list) or fin_list[k] >= end:
+                    break
+                i = fin_list[k]
+                continue
+            if expired[i]:
+                new_flow_needed = True
+            if last_fin is not None and times[i] - last_fin >= 5.0 and not fins[i]:
+                new_flow_needed = True
+                last_fin = None
+            if new_flow_needed:
+                flow_starts[i] = True
+                fin_count, new_flow_needed = 0, False
+            elif fins[i]:
+                fin_count += 1
+                last_fin = times[i]
+                if fin_count >= 3:
+                    new_flow_needed = True
+                    last_fin = None
+            i += 1
+        k = bisect.bisect_left(fin_list, end)
+
+
+def _packet_group_key(packet):
+    flow_key_lo = getattr(packet, "flow_key_lo", NO_KEY)
+    if flow_key_lo != NO_KEY:
+        return packet.flow_key_hi, flow_key_lo
+    # Packets created before flow keys existed (e.g. unpickled from older runs) carry no 5-tuple key,
+    # they are grouped on their pseudo_hash like before. Packets without TCP/UDP layer have neither.
+    if packet.pseudo_hash is not None:
+        return "pseudo_hash", packet.pseudo_hash
+    return None
+
+
 def assign_flow_ids_to_packets(truncated_packets):
+    """
+    Splits packets into flows and sets their flow_id and direction (1 - from the source of the flow's first
+    packet, 2 - towards it). PacketTables are assembled by the vectorized assign_flow_ids, lists of
+    TruncatedPacket objects packet by packet with the same rules.
+    """
+    if isinstance(truncated_packets, PacketTable):
+        rows, flow_ids, directions = assign_flow_ids(
+            truncated_packets.flow_key_hi,
+            truncated_packets.flow_key_lo,
+            truncated_packets.time_base + truncated_packets.timestamp,
+            truncated_packets.src_ip,
+            truncated_packets.tcp,
+            truncated_packets.fin,
+        )
+        truncated_packets.flow_id[rows] = flow_ids
+        truncated_packets.direction[rows] = directions
+        truncated_packets.flow_index = FlowIndex.from_table(truncated_packets)
+        return truncated_packets
+
     packets_by_hash = defaultdict(list)
     for packet in truncated_packets:
-        if packet.pseudo_hash is not None:
-            packets_by_hash[packet.pseudo_hash].append(packet)
+        group_key = _packet_group_key(packet)
+        if group_key is not None:
+            packets_by_hash[group_key].append(packet)
 
     print(f"hash groups: {len(packets_by_hash.values())}")
     global_flow_id = 0
@@ -73,5 +271,4 @@ def assign_flow_ids_to_packets(truncated_packets):
             packet.flow_id = global_flow_id
             packet.direction = 1 if packet.src_ip == first_packet_src_ip else 2
 
-
     return truncated_packets
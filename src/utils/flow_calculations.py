@@ -1,5 +1,20 @@
 import numpy as np
 
+from src.utils.truncated_packet import PacketTable
+
+FRAGMENT_REPEATS = np.array([1, 2, 4])  # packets counted per fragmented level (0 - none, 1 - 2-way, 2 - 4-way)
+
+
+def expand_fragments(truncated_packets, rows):
+    """
+    Returns (sizes, timestamps) of the selected PacketTable rows, with every fragmented packet
+    expanded into 2 or 4 equal fragments sharing its timestamp.
+    """
+    repeats = FRAGMENT_REPEATS[truncated_packets.fragmented[rows]]
+    sizes = np.repeat(truncated_packets.size[rows] / repeats, repeats)
+    timestamps = np.repeat(truncated_packets.timestamp[rows], repeats)
+    return sizes, timestamps
+
 
 def calculate_size_statistics(flow_id, truncated_packets, direction=0):
     """
@@ -14,6 +29,12 @@ def calculate_size_statistics(flow_id, truncated_packets, direction=0):
     Returns:
     A dictionary with calculated size statistics: mean, min, max, std or a message if no packets match criteria.
     """
+    if isinstance(truncated_packets, PacketTable):
+        sizes, _ = expand_fragments(truncated_packets, truncated_packets.flow_rows(flow_id, direction))
+        if not sizes.size:
+            return {"mean": 0.0, "min": 0.0, "max": 0.0, "std": 0.0}
+        return {"mean": np.mean(sizes), "min": np.min(sizes), "max": np.max(sizes), "std": np.std(sizes)}
+
     sizes = []
     for pkt in truncated_packets:
         if pkt.flow_id == flow_id and (direction == 0 or pkt.direction == direction):
@@ -42,6 +63,10 @@ def calculate_size_statistics(flow_id, truncated_packets, direction=0):
 
 
 def calculate_delta_time_statistics(flow_id, truncated_packets, direction=0):
+    if isinstance(truncated_packets, PacketTable):
+        _, timestamps = expand_fragments(truncated_packets, truncated_packets.flow_rows(flow_id, direction))
+        return delta_time_statistics(timestamps)
+
   # Prepare a list of timestamps, taking packet fragmentation into account
     timestamps = []
     for pkt in truncated_packets:
@@ -56,6 +81,13 @@ def calculate_delta_time_statistics(flow_id, truncated_packets, direction=0):
                 # Duplicate the timestamp for 4-way fragmentation
                 timestamps.extend([pkt.timestamp] * 4)
 
+    return delta_time_statistics(timestamps)
+
+
+def delta_time_statistics(timestamps):
+    """
+    Inter-arrival time statistics (in microseconds, like CICFlowMeter) of an unordered sequence of timestamps.
+    """
     if len(timestamps) < 2:
         return {
         "mean": 0.0,
@@ -65,7 +97,7 @@ def calculate_delta_time_statistics(flow_id, truncated_packets, direction=0):
     }
 
     # Sort timestamps before calculating deltas to ensure chronological order
-    timestamps = sorted(timestamps)
+    timestamps = np.sort(timestamps) if isinstance(timestamps, np.ndarray) else sorted(timestamps)
     # Calculate time deltas between consecutive timestamps
     delta_times = np.diff(timestamps)
 
@@ -89,6 +121,8 @@ def calculate_delta_time_statistics(flow_id, truncated_packets, direction=0):
 
 
 def total_flow_size(flow_id, truncated_packets, direction=0):
+    if isinstance(truncated_packets, PacketTable):
+        return int(np.sum(truncated_packets.size[truncated_packets.flow_rows(flow_id, direction)], dtype=np.int64))
     total_size = sum(
         pkt.size
         for pkt in truncated_packets
@@ -98,6 +132,9 @@ def total_flow_size(flow_id, truncated_packets, direction=0):
 
 
 def total_flow_duration(flow_id, truncated_packets, direction=0):
+    if isinstance(truncated_packets, PacketTable):
+        timestamps = truncated_packets.timestamp[truncated_packets.flow_rows(flow_id, direction)]
+        return (np.max(timestamps) - np.min(timestamps)) * 1000000.0 if timestamps.size else 0.0
     timestamps = [
         pkt.timestamp
         for pkt in truncated_packets
@@ -122,6 +159,10 @@ def total_packet_count(flow_id, truncated_packets, direction=0):
     Returns:
     The total packet count, including individual fragments as separate packets.
     """
+    if isinstance(truncated_packets, PacketTable):
+        fragmented = truncated_packets.fragmented[truncated_packets.flow_rows(flow_id, direction)]
+        return int(np.sum(FRAGMENT_REPEATS[fragmented]))
+
     count = sum(
         # Count each packet normally if not fragmented
         1 if pkt.fragmented == 0 else
@@ -138,6 +179,12 @@ def total_packet_count(flow_id, truncated_packets, direction=0):
 # TODO: czy tu sie uwzglednia fragmentacje 
 def count_tcp_flags(flow_id, truncated_packets, direction=0):
     flags_count = {"FIN": 0, "SYN": 0, "RST": 0, "PSH": 0, "ACK": 0, "URG": 0}
+    if isinstance(truncated_packets, PacketTable):
+        rows = truncated_packets.flow_rows(flow_id, direction)
+        rows = rows[truncated_packets.tcp[rows] != 0]
+        for flag in flags_count:
+            flags_count[flag] = int(np.sum(truncated_packets.columns[flag.lower()][rows]))
+        return flags_count
     for pkt in truncated_packets:
         if (
             pkt.flow_id == flow_id
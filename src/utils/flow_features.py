@@ -0,0 +1,414 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from src.data.cic_preprocess import COLUMNS_TO_KEEP, FLAG_COLUMNS
+from src.utils.flow_calculations import FRAGMENT_REPEATS
+from src.utils.truncated_packet import NO_FLOW, PacketTable
+
+# Model input columns - the preprocessed CIC columns without the flag counts, in the same order
+FEATURE_COLUMNS = [column for column in COLUMNS_TO_KEEP if column not in FLAG_COLUMNS]
+SIZE_FEATURE_COLUMNS = FEATURE_COLUMNS[:14]
+TIMING_FEATURE_COLUMNS = FEATURE_COLUMNS[14:]
+COUNT_FEATURE_COLUMNS = ["tot_fwd_pkts", "tot_bwd_pkts", "totlen_fwd_pkts", "totlen_bwd_pkts"]
+
+FEATURE_INDEX = {column: i for i, column in enumerate(FEATURE_COLUMNS)}
+
+
+def flow_packet_arrays(truncated_packets, flow_id):
+    """
+    Collects the columns needed for feature extraction of a single flow.
+
+    Parameters:
+    - truncated_packets: A PacketTable or a list of TruncatedPacket objects.
+    - flow_id: The flow to collect.
+
+    Returns:
+    (sizes, fragmented, timestamps, directions) NumPy arrays of the flow's packets in capture order.
+    """
+    if isinstance(truncated_packets, PacketTable):
+        rows = truncated_packets.flow_rows(flow_id)
+        return (
+            truncated_packets.size[rows],
+            truncated_packets.fragmented[rows],
+            truncated_packets.timestamp[rows],
+            truncated_packets.direction[rows],
+        )
+
+    packets = [pkt for pkt in truncated_packets if pkt.flow_id == flow_id]
+    # Relative timestamps keep microsecond precision of the epoch values in float64
+    time_base = int(packets[0].timestamp) if packets else 0
+    return (
+        np.array([pkt.size for pkt in packets], dtype=np.int64),
+        np.array([pkt.fragmented for pkt in packets], dtype=np.int64),
+        np.array([float(pkt.timestamp - time_base) for pkt in packets], dtype=np.float64),
+        np.array([pkt.direction for pkt in packets], dtype=np.int64),
+    )
+
+
+def _size_features(row, offset, sizes):
+    # max, min, mean, std
+    if sizes.size:
+        row[offset:offset + 4] = np.max(sizes), np.min(sizes), np.mean(sizes), np.std(sizes)
+
+
+def _iat_features(timestamps):
+    # mean, max, min, std of inter-arrival times in microseconds (timestamps are already sorted)
+    if timestamps.size < 2:
+        return 0.0, 0.0, 0.0, 0.0
+    delta_times = np.diff(timestamps)
+    return (
+        np.mean(delta_times) * 1000000.0,
+        np.max(delta_times) * 1000000.0,
+        np.min(delta_times) * 1000000.0,
+        np.std(delta_times) * 1000000.0,
+    )
+
+
+def flow_features(sizes, fragmented, timestamps, directions, out=None):
+    """
+    Computes all model features of one flow in a single pass over its packet columns.
+
+    Fragmented packets are expanded into 2 or 4 equal fragments sharing the packet timestamp, exactly like
+    calculate_size_statistics and calculate_delta_time_statistics do. The flow is sorted by time once,
+    so the forward and backward subsets are sorted as well.
+
+    Returns:
+    A float64 NumPy array ordered like FEATURE_COLUMNS - `out` (e.g. a row of a pre-allocated
+    feature matrix) when given.
+    """
+    row = np.zeros(len(FEATURE_COLUMNS), dtype=np.float64) if out is None else out
+    row[:] = 0.0
+
+    order = np.argsort(timestamps, kind="stable")
+    repeats = FRAGMENT_REPEATS[fragmented[order]]
+    fragment_sizes = np.repeat(sizes[order] / repeats, repeats)
+    fragment_timestamps = np.repeat(timestamps[order], repeats)
+    fragment_directions = np.repeat(directions[order], repeats)
+    fwd = fragment_directions == 1
+    bwd = fragment_directions == 2
+
+    row[0] = np.count_nonzero(fwd)
+    row[1] = np.count_nonzero(bwd)
+    row[2] = np.sum(sizes[directions == 1], dtype=np.int64)
+    row[3] = np.sum(sizes[directions == 2], dtype=np.int64)
+    _size_features(row, 4, fragment_sizes[fwd])
+    _size_features(row, 8, fragment_sizes[bwd])
+    if fragment_sizes.size:
+        row[12:14] = np.mean(fragment_sizes), np.std(fragment_sizes)
+
+    row[14:18] = _iat_features(fragment_timestamps)
+    # fwd_iat_tot / bwd_iat_tot stay 0 - prepare_timing_stats never had a 'total' statistic to fill them and the
+    # models are scored on that, native_flows fills them for the cicflowmeter-compatible csv export
+    fwd_mean, fwd_max, fwd_min, fwd_std = _iat_features(fragment_timestamps[fwd])
+    row[19:23] = fwd_max, fwd_min, fwd_mean, fwd_std
+    bwd_mean, bwd_max, bwd_min, bwd_std = _iat_features(fragment_timestamps[bwd])
+    row[24:28] = bwd_max, bwd_min, bwd_mean, bwd_std
+    return row
+
+
+def extract_flow_features(truncated_packets, flow_id, out=None):
+    """
+    Fused replacement of prepare_size_stats + prepare_timing_stats.
+
+    Parameters:
+    - truncated_packets: A PacketTable or a list of TruncatedPacket objects.
+    - flow_id: The flow to describe.
+    - out: Optional float64 array of len(FEATURE_COLUMNS) to write the features into.
+
+    Returns:
+    A float64 NumPy array of the flow's features ordered like FEATURE_COLUMNS, ready for the models.
+    """
+    return flow_features(*flow_packet_arrays(truncated_packets, flow_id), out=out)
+
+
+def feature_dict(row, columns=FEATURE_COLUMNS):
+    """
+    Maps a feature row back to {column: value} for the given subset of FEATURE_COLUMNS.
+    Packet counts and byte totals are returned as ints, like total_packet_count and total_flow_size.
+    """
+    return {
+        column: int(row[FEATURE_INDEX[column]]) if column in COUNT_FEATURE_COLUMNS else row[FEATURE_INDEX[column]]
+        for column in columns
+    }
+
+
+# Sufficient statistics of a set of values: count, sum, centred sum of squares, min and max. Statistics of
+# disjoint sets merge without revisiting the values (the centred form keeps the merged variance stable).
+Moments = namedtuple("Moments", ["count", "total", "m2", "minimum", "maximum"])
+EMPTY_MOMENTS = Moments(0, 0.0, 0.0, np.inf, -np.inf)
+
+# Positions of the per-direction statistics - index 0 collects packets that are neither forward nor backward
+DIRECTIONS = (0, 1, 2)
+
+
+def weighted_moments(values, weights=None):
+    """
+    Moments of values, where values[i] occurs weights[i] times (once without weights).
+    """
+    if not values.size:
+        return EMPTY_MOMENTS
+    if weights is None:
+        count, total = values.size, float(np.sum(values))
+        deviation = values - total / count
+        m2 = float(np.dot(deviation, deviation))
+    else:
+        count, total = int(np.sum(weights)), float(np.dot(values, weights))
+        deviation = values - total / count
+        m2 = float(np.dot(weights, deviation * deviation))
+    return Moments(count, total, m2, float(np.min(values)), float(np.max(values)))
+
+
+def merge_moments(*parts):
+    merged = EMPTY_MOMENTS
+    for part in parts:
+        if not part.count:
+            continue
+        if not merged.count:
+            merged = part
+            continue
+        count = merged.count + part.count
+        delta = part.total / part.count - merged.total / merged.count
+        merged = Moments(
+            count,
+            merged.total + part.total,
+            merged.m2 + part.m2 + delta * delta * merged.count * part.count / count,
+            min(merged.minimum, part.minimum),
+            max(merged.maximum, part.maximum),
+        )
+    return merged
+
+
+def _moments_summary(moments, scale=1.0):
+    # mean, max, min, std
+    if not moments.count:
+        return 0.0, 0.0, 0.0, 0.0
+    return (
+        moments.total / moments.count * scale,
+        moments.maximum * scale,
+        moments.minimum * scale,
+        np.sqrt(moments.m2 / moments.count) * scale,
+    )
+
+
+def _direction_rows(directions, direction):
+    if direction == 0:
+        return (directions != 1) & (directions != 2)
+    return directions == direction
+
+
+def size_statistics(sizes, fragmented, directions, previous=None, direction=0):
+    """
+    Per-direction Moments of the fragment sizes (indexed like DIRECTIONS). Fragments are weighted instead of
+    expanded, so the sums are exact.
+
+    Parameters:
+    - sizes, fragmented, directions: Columns of the flow's packets.
+    - previous: Statistics of the same flow before only one direction's packets changed.
+    - direction: That direction (1 or 2) - only it is recomputed. 0 recomputes everything.
+
+    Returns:
+    A tuple of Moments, one per direction.
+    """
+    if previous is not None and direction in (1, 2):
+        statistics = list(previous)
+        changed = (direction,)
+    else:
+        statistics = [EMPTY_MOMENTS] * len(DIRECTIONS)
+        changed = DIRECTIONS
+    for changed_direction in changed:
+        rows = _direction_rows(directions, changed_direction)
+        repeats = FRAGMENT_REPEATS[fragmented[rows]]
+        statistics[changed_direction] = weighted_moments(sizes[rows] / repeats, repeats)
+    return tuple(statistics)
+
+
+def _iat_moments(timestamps, repeats):
+    # Inter-arrival times of time-sorted packets, every fragment after the first adds an IAT of 0
+    if np.sum(repeats) < 2:
+        return EMPTY_MOMENTS
+    fragment_gaps = int(np.sum(repeats)) - len(repeats)
+    return merge_moments(
+        weighted_moments(np.diff(timestamps)),
+        Moments(fragment_gaps, 0.0, 0.0, 0.0, 0.0) if fragment_gaps else EMPTY_MOMENTS,
+    )
+
+
+def timing_statistics(fragmented, timestamps, directions):
+    """
+    Moments of the inter-arrival times (seconds) of all, forward and backward fragments.
+
+    Returns:
+    (all, forward, backward) Moments.
+    """
+    order = np.argsort(timestamps, kind="stable")
+    timestamps, repeats, directions = timestamps[order], FRAGMENT_REPEATS[fragmented[order]], directions[order]
+    fwd = directions == 1
+    bwd = directions == 2
+    return (
+        _iat_moments(timestamps, repeats),
+        _iat_moments(timestamps[fwd], repeats[fwd]),
+        _iat_moments(timestamps[bwd], repeats[bwd]),
+    )
+
+
+def features_from_statistics(size_stats, timing_stats, out=None):
+    """
+    Assembles the FEATURE_COLUMNS row of a flow from its size_statistics and timing_statistics.
+    Equal to flow_features up to floating point rounding.
+    """
+    row = np.zeros(len(FEATURE_COLUMNS), dtype=np.float64) if out is None else out
+    row[:] = 0.0
+    fwd, bwd = size_stats[1], size_stats[2]
+    row[0:4] = fwd.count, bwd.count, fwd.total, bwd.total
+    for offset, moments in ((4, fwd), (8, bwd)):
+        mean, maximum, minimum, std = _moments_summary(moments)
+        row[offset:offset + 4] = maximum, minimum, mean, std
+    mean, _, _, std = _moments_summary(merge_moments(*size_stats))
+    row[12:14] = mean, std
+
+    all_iat, fwd_iat, bwd_iat = timing_stats
+    row[14:18] = _moments_summary(all_iat, 1000000.0)
+    # fwd_iat_tot / bwd_iat_tot stay 0, like in flow_features
+    for offset, moments in ((19, fwd_iat), (24, bwd_iat)):
+        mean, maximum, minimum, std = _moments_summary(moments, 1000000.0)
+        row[offset:offset + 4] = maximum, minimum, mean, std
+    return row
+
+
+def _segment_starts(keys):
+    # Start positions of runs of equal values in sorted keys
+    if not keys.size:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+
+def _segment_moments(keys, values, group_ids):
+    """
+    Per-group count, mean, min, max and std of values, where keys are the (sorted) group ids of values.
+    Results are aligned with the sorted unique group_ids; groups without values get zeros.
+    """
+    stats = np.zeros((len(group_ids), 5), dtype=np.float64)
+    starts = _segment_starts(keys)
+    if not starts.size:
+        return stats
+    counts = np.diff(np.append(starts, len(keys)))
+    mean = np.add.reduceat(values, starts) / counts
+    deviation = values - np.repeat(mean, counts)
+    std = np.sqrt(np.add.reduceat(deviation * deviation, starts) / counts)
+    positions = np.searchsorted(group_ids, keys[starts])
+    stats[positions, 0] = counts
+    stats[positions, 1] = mean
+    stats[positions, 2] = np.minimum.reduceat(values, starts)
+    stats[positions, 3] = np.maximum.reduceat(values, starts)
+    stats[positions, 4] = std
+    return stats
+
+
+def _segment_iat_moments(keys, timestamps, group_ids):
+    # Inter-arrival statistics (microseconds) per group of time-sorted timestamps
+    same_group = keys[1:] == keys[:-1]
+    delta_times = np.diff(timestamps)[same_group]
+    stats = _segment_moments(keys[1:][same_group], delta_times, group_ids)
+    stats[:, 1:] *= 1000000.0
+    return stats
+
+
+def grouped_flow_features(group_ids, sizes, fragmented, timestamps, directions):
+    """
+    Computes the features of many flows at once with segment reductions instead of a loop over flows.
+    Packets are sorted by (group, timestamp) once; every statistic is then a reduction over contiguous runs.
+
+    Parameters:
+    - group_ids: flow id (or any other grouping key) of every packet.
+    - sizes, fragmented, timestamps, directions: packet columns aligned with group_ids.
+
+    Returns:
+    (unique_group_ids, features) where features is a float64 matrix with one FEATURE_COLUMNS row per group.
+    """
+    unique_ids = np.unique(group_ids)
+    order = np.lexsort((timestamps, group_ids))
+    repeats = FRAGMENT_REPEATS[fragmented[order]]
+    keys = np.repeat(group_ids[order], repeats)
+    fragment_sizes = np.repeat(sizes[order] / repeats, repeats)
+    fragment_timestamps = np.repeat(timestamps[order], repeats)
+    fragment_directions = np.repeat(directions[order], repeats)
+
+    features = np.zeros((len(unique_ids), len(FEATURE_COLUMNS)), dtype=np.float64)
+    size_all = _segment_moments(keys, fragment_sizes, unique_ids)
+    features[:, 12:14] = size_all[:, [1, 4]]
+    iat_all = _segment_iat_moments(keys, fragment_timestamps, unique_ids)
+    features[:, 14:18] = iat_all[:, [1, 3, 2, 4]]  # mean, max, min, std
+
+    for direction, count_column, size_column, iat_column in ((1, 0, 4, 19), (2, 1, 8, 24)):
+        in_direction = fragment_directions == direction
+        size_stats = _segment_moments(keys[in_direction], fragment_sizes[in_direction], unique_ids)
+        features[:, count_column] = size_stats[:, 0]
+        features[:, size_column:size_column + 4] = size_stats[:, [3, 2, 1, 4]]  # max, min, mean, std
+        iat_stats = _segment_iat_moments(keys[in_direction], fragment_timestamps[in_direction], unique_ids)
+        # fwd_iat_tot / bwd_iat_tot (iat_column - 1) stay 0, like in flow_features
+        features[:, iat_column:iat_column + 4] = iat_stats[:, [3, 2, 1, 4]]  # max, min, mean, std
+
+        # Byte totals count original packets, not fragments
+        packet_directions = directions[order] == direction
+        totals = np.zeros(len(unique_ids), dtype=np.int64)
+        np.add.at(totals, np.searchsorted(unique_ids, group_ids[order][packet_directions]),
+                  sizes[order][packet_directions].astype(np.int64))
+        features[:, count_column + 2] = totals
+
+    return unique_ids, features
+
+
+def extract_all_flow_features(truncated_packets):
+    """
+    Feature matrix of every flow in a capture, computed in one grouped pass.
+
+    Parameters:
+    - truncated_packets: A PacketTable (or a list of TruncatedPacket objects) with flow ids assigned.
+
+    Returns:
+    A pandas DataFrame indexed by flow_id with FEATURE_COLUMNS, rows equal to extract_flow_features.
+    Packets without a flow are left out.
+    """
+    if not isinstance(truncated_packets, PacketTable):
+        truncated_packets = PacketTable.from_packets(truncated_packets)
+    flows = truncated_packets[truncated_packets.flow_id != NO_FLOW]
+    flow_ids, features = grouped_flow_features(
+        flows.flow_id, flows.size, flows.fragmented, flows.timestamp, flows.direction
+    )
+    frame = pd.DataFrame(features, index=pd.Index(flow_ids, name="flow_id"), columns=FEATURE_COLUMNS)
+    for column in COUNT_FEATURE_COLUMNS:
+        frame[column] = frame[column].astype(np.int64)
+    return frame
+
+
+def flow_packet_counts(truncated_packets):
+    """
+    Number of captured packets (fragments not expanded) of every flow, as a pandas Series indexed by flow_id.
+    """
+    if not isinstance(truncated_packets, PacketTable):
+        truncated_packets = PacketTable.from_packets(truncated_packets)
+    flow_ids, counts = np.unique(truncated_packets.flow_id[truncated_packets.flow_id != NO_FLOW], return_counts=True)
+    return pd.Series(counts, index=pd.Index(flow_ids, name="flow_id"), name="packet_count")
+
+
+def select_median_flow(flow_features_frame, packet_counts, min_packets=5):
+    """
+    Finds the flow closest (squared euclidean distance) to the feature-wise median of all flows.
+
+    Parameters:
+    - flow_features_frame: DataFrame returned by extract_all_flow_features.
+    - packet_counts: Series returned by flow_packet_counts.
+    - min_packets: Only flows with at least this many packets can be selected.
+
+    Returns:
+    (flow_id, median_stats) - flow_id is None when no flow is long enough; median_stats is a Series
+    with the median of every feature over all flows.
+    """
+    median_stats = flow_features_frame.median()
+    distances = ((flow_features_frame - median_stats) ** 2).sum(axis=1)
+    eligible = distances[packet_counts.reindex(distances.index, fill_value=0) >= min_packets]
+    if eligible.empty:
+        return None, median_stats
+    return eligible.idxmin(), median_stats
@@ -0,0 +1,213 @@
+import heapq
+from collections import OrderedDict, namedtuple
+
+from src.utils.flow import TCP_EXPIRATION, UDP_EXPIRATION
+from src.utils.flow_features import flow_features
+from src.utils.truncated_packet import (
+    CHUNK_SIZE,
+    NO_KEY,
+    PACKET_TABLE_COLUMNS,
+    PacketTable,
+    iter_truncated_packet_chunks,
+)
+
+# A flow can only be continued by a packet arriving less than this many seconds after its last packet
+MAX_EXPIRATION = max(TCP_EXPIRATION, UDP_EXPIRATION)
+FIN_TIMEOUT = 5.0  # a non-FIN packet this long after a FIN starts a new flow
+MAX_FINS = 3  # the flow is closed right after its third FIN
+DEFAULT_REORDER_WINDOW = 1.0  # seconds of capture-order jitter absorbed before packets are tracked
+DEFAULT_MAX_CLOSED_KEYS = 100000
+
+# Positions of the columns in the buffered packet rows
+PACKET_ID, TIMESTAMP, FLOW_ID, DIRECTION, SRC_IP, TCP, FIN, FLOW_KEY_HI, FLOW_KEY_LO = (
+    list(PACKET_TABLE_COLUMNS).index(name)
+    for name in ("packet_id", "timestamp", "flow_id", "direction", "src_ip", "tcp", "fin", "flow_key_hi", "flow_key_lo")
+)
+
+CompletedFlow = namedtuple(
+    "CompletedFlow",
+    [
+        "flow_id",
+        "flow_key",  # (flow_key_hi, flow_key_lo) of the flow's packets
+        "packets",  # PacketTable of the flow's packets in time order, flow_id / direction set
+        "features",  # FEATURE_COLUMNS row (see flow_features), None when the tracker skips features
+    ],
+)
+
+
+class _ActiveFlow:
+    __slots__ = ("flow_id", "first_src_ip", "fin_count", "last_fin", "last_timestamp", "rows")
+
+    def __init__(self, flow_id, first_src_ip):
+        self.flow_id = flow_id
+        self.first_src_ip = first_src_ip
+        self.fin_count = 0
+        self.last_fin = None
+        self.last_timestamp = None
+        self.rows = []
+
+
+class FlowTracker:
+    """
+    Streaming flow assembly. Packets are consumed in timestamp order and kept only while their flow is active;
+    a flow is emitted (with its features) as soon as no later packet can join it:
+
+    - its key was idle for MAX_EXPIRATION seconds,
+    - it received its third FIN,
+    - a packet of the same key started a new flow (expiry gap or a non-FIN packet 5s after a FIN).
+
+    Flows are split by the same rules as assign_flow_ids_to_packets, so they hold the same packets. Flow ids
+    are numbered in order of the flows' first packets instead of by hash group.
+
+    The batch rules depend slightly on a key's history: the FIN of a key's very first packet counts, the FIN
+    of a packet reopening the key does not, and it keeps the previous flow's last FIN. The tracker remembers
+    this for the max_closed_keys most recently closed keys; a key reused after that is treated as new.
+
+    Memory is bounded by the active flows, the reorder window and max_closed_keys, not by the capture.
+
+    Parameters:
+    - with_features: Compute the FEATURE_COLUMNS row of every emitted flow.
+    - reorder_window: Packets are buffered this many seconds and released in timestamp order, which absorbs
+      small capture-order inversions. A packet older than the already released ones raises ValueError.
+    - max_closed_keys: How many closed keys (with their last FIN) are remembered.
+    """
+
+    def __init__(self, with_features=True, reorder_window=DEFAULT_REORDER_WINDOW,
+                 max_closed_keys=DEFAULT_MAX_CLOSED_KEYS):
+        self.with_features = with_features
+        self.reorder_window = reorder_window
+        self.max_closed_keys = max_closed_keys
+        self.time_base = None
+        self.active = OrderedDict()  # flow key -> _ActiveFlow, least recently seen first
+        self.next_flow_id = 1
+        self.max_active = 0
+        self.emitted = 0
+        self.closed_keys = OrderedDict()  # flow key -> last FIN of its last flow (or None), least recent first
+        self._pending = []  # heap of (timestamp, sequence, row) waiting for the reorder window
+        self._sequence = 0
+        self._released_timestamp = None
+
+    def add_table(self, truncated_packets):
+        """
+        Consumes a PacketTable chunk (e.g. from iter_truncated_packet_chunks) in capture order.
+
+        Returns:
+        List of CompletedFlow finished by these packets.
+        """
+        if self.time_base is None:
+            self.time_base = truncated_packets.time_base
+        columns = [truncated_packets.columns[name].tolist() for name in PACKET_TABLE_COLUMNS]
+        columns[TIMESTAMP] = (truncated_packets.timestamp + (truncated_packets.time_base - self.time_base)).tolist()
+        completed = []
+        for row in zip(*columns):
+            completed.extend(self._push(list(row)))
+        return completed
+
+    def _push(self, row):
+        timestamp = self.time_base + row[TIMESTAMP]
+        if self._released_timestamp is not None and timestamp < self._released_timestamp:
+            raise ValueError(
+                f"Packet {row[PACKET_ID]} is {self._released_timestamp - timestamp:.6f}s older than already tracked "
+                f"packets - increase reorder_window"
+            )
+        heapq.heappush(self._pending, (timestamp, self._sequence, row))
+        self._sequence += 1
+        completed = []
+        while self._pending and self._pending[0][0] <= timestamp - self.reorder_window:
+            completed.extend(self._track(*heapq.heappop(self._pending)[::2]))
+        return completed
+
+    def _track(self, timestamp, row):
+        self._released_timestamp = timestamp
+        completed = self._evict_expired(timestamp)
+        if row[FLOW_KEY_LO] == NO_KEY:
+            return completed
+        flow_key = (row[FLOW_KEY_HI], row[FLOW_KEY_LO])
+
+        flow = self.active.get(flow_key)
+        if flow is not None:
+            expiration = TCP_EXPIRATION if row[TCP] else UDP_EXPIRATION
+            fin_timed_out = flow.last_fin is not None and timestamp - flow.last_fin >= FIN_TIMEOUT and not row[FIN]
+            if timestamp - flow.last_timestamp >= expiration or fin_timed_out:
+                completed.append(self._emit(flow_key))
+                flow = None
+
+        reopened = False
+        if flow is None:
+            reopened = flow_key in self.closed_keys
+            last_fin = self.closed_keys.pop(flow_key, None)
+            flow = _ActiveFlow(self.next_flow_id, row[SRC_IP])
+            self.next_flow_id += 1
+            self.active[flow_key] = flow
+            self.max_active = max(self.max_active, len(self.active))
+            if reopened:
+                # A reopening packet starts its flow without counting its FIN. A FIN keeps the previous
+                # flow's last FIN, any other packet clears it (it is past the FIN timeout).
+                flow.last_fin = last_fin if row[FIN] else None
+        if row[FIN] and not reopened:
+            flow.fin_count += 1
+            flow.last_fin = timestamp
+        self.active.move_to_end(flow_key)
+
+        row[FLOW_ID] = flow.flow_id
+        row[DIRECTION] = 1 if row[SRC_IP] == flow.first_src_ip else 2
+        flow.rows.append(row)
+        flow.last_timestamp = timestamp
+        if flow.fin_count >= MAX_FINS:
+            flow.last_fin = None
+            completed.append(self._emit(flow_key))
+        return completed
+
+    def _evict_expired(self, timestamp):
+        completed = []
+        while self.active:
+            flow_key, flow = next(iter(self.active.items()))
+            if timestamp - flow.last_timestamp < MAX_EXPIRATION:
+                break
+            completed.append(self._emit(flow_key))
+        return completed
+
+    def _emit(self, flow_key):
+        flow = self.active.pop(flow_key)
+        self.closed_keys[flow_key] = flow.last_fin
+        while len(self.closed_keys) > self.max_closed_keys:
+            self.closed_keys.popitem(last=False)
+        packets = PacketTable(
+            {name: [row[i] for row in flow.rows] for i, name in enumerate(PACKET_TABLE_COLUMNS)},
+            time_base=self.time_base,
+        )
+        features = None
+        if self.with_features:
+            features = flow_features(packets.size, packets.fragmented, packets.timestamp, packets.direction)
+        self.emitted += 1
+        return CompletedFlow(flow.flow_id, flow_key, packets, features)
+
+    def flush(self):
+        """
+        Ends the stream: tracks the buffered packets and emits every active flow.
+        """
+        completed = []
+        while self._pending:
+            completed.extend(self._track(*heapq.heappop(self._pending)[::2]))
+        while self.active:
+            completed.append(self._emit(next(iter(self.active))))
+        return completed
+
+
+def track_flows(chunks, with_features=True, reorder_window=DEFAULT_REORDER_WINDOW):
+    """
+    Generator of CompletedFlow over PacketTable chunks, see FlowTracker.
+    """
+    tracker = FlowTracker(with_features, reorder_window)
+    for chunk in chunks:
+        yield from tracker.add_table(chunk)
+    yield from tracker.flush()
+
+
+def stream_flows_from_pcap(file_path, chunk_size=CHUNK_SIZE, parser="raw", with_features=True,
+                           reorder_window=DEFAULT_REORDER_WINDOW):
+    """
+    Streams a pcap/pcapng file and yields its flows as they complete, holding only one chunk of packets and
+    the active flows in memory.
+    """
+    return track_flows(iter_truncated_packet_chunks(file_path, chunk_size, parser), with_features, reorder_window)
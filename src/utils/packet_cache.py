@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+from src.utils.flow import FlowIndex, assign_flow_ids_to_packets
+from src.utils.truncated_packet import (
+    CHUNK_SIZE,
+    PACKET_TABLE_COLUMNS,
+    PacketTable,
+    create_truncated_packets_from_pcap,
+)
+
+# Bump whenever the parser, the flow rules or the file layout change - older cache files are then rebuilt
+CACHE_FORMAT_VERSION = 1
+CACHE_SUFFIX = ".ptcache"
+CACHE_MAGIC = b"PTCACHE\0"
+# magic, format version, length of the JSON header
+CACHE_PREAMBLE = struct.Struct("<8sII")
+COLUMN_ALIGNMENT = 64
+# Bytes hashed from the start and from the end of the capture for its fingerprint
+FINGERPRINT_SAMPLE = 1 << 20
+
+
+def cache_path_for(file_path):
+    return f"{file_path}{CACHE_SUFFIX}"
+
+
+def capture_fingerprint(file_path):
+    """
+    Identity of a capture file: size, mtime and a blake2b digest of its first and last FINGERPRINT_SAMPLE
+    bytes. Hashing samples instead of the whole file keeps the check fast on multi-GB captures, size and
+    mtime catch appends and rewrites the samples could miss.
+    """
+    stat = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as file:
+        digest.update(file.read(FINGERPRINT_SAMPLE))
+        if stat.st_size > FINGERPRINT_SAMPLE:
+            file.seek(max(stat.st_size - FINGERPRINT_SAMPLE, FINGERPRINT_SAMPLE))
+            digest.update(file.read())
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest.hexdigest()}
+
+
+def _column_layout():
+    return [[name, np.dtype(dtype).str] for name, dtype in PACKET_TABLE_COLUMNS.items()]
+
+
+def save_packet_cache(truncated_packets, file_path, cache_path=None):
+    """
+    Stores a PacketTable read from file_path (flow_id / direction included) in a cache file next to the
+    capture. The columns are written uncompressed and aligned, so load_packet_cache can memory-map them.
+    The file is written under a temporary name and renamed, a crash never leaves a partial cache behind.
+    """
+    cache_path = cache_path_for(file_path) if cache_path is None else cache_path
+    header = {
+        "version": CACHE_FORMAT_VERSION,
+        "source": capture_fingerprint(file_path),
+        "time_base": truncated_packets.time_base,
+        "length": len(truncated_packets),
+        "columns": _column_layout(),
+    }
+    header_bytes = json.dumps(header).encode()
+    offset = CACHE_PREAMBLE.size + len(header_bytes)
+
+    temporary_path = f"{cache_path}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(CACHE_PREAMBLE.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, len(header_bytes)))
+        file.write(header_bytes)
+        for name in PACKET_TABLE_COLUMNS:
+            padding = -offset % COLUMN_ALIGNMENT
+            file.write(b"\0" * padding)
+            data = np.ascontiguousarray(truncated_packets.columns[name]).tobytes()
+            file.write(data)
+            offset += padding + len(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, cache_path)
+    return cache_path
+
+
+def load_packet_cache(file_path, cache_path=None):
+    """
+    Memory-maps the cached PacketTable of file_path. Columns are copy-on-write maps of the cache file:
+    only the pages a caller touches are read, and modifying the table never changes the cache.
+
+    Returns:
+    The PacketTable with its FlowIndex, or None if there is no cache or it does not match the capture
+    (different size / mtime / content fingerprint, format version or column layout).
+    """
+    cache_path = cache_path_for(file_path) if cache_path is None else cache_path
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, "rb") as file:
+        preamble = file.read(CACHE_PREAMBLE.size)
+        if len(preamble) < CACHE_PREAMBLE.size:
+            return None
+        magic, version, header_length = CACHE_PREAMBLE.unpack(preamble)
+        if magic != CACHE_MAGIC or version != CACHE_FORMAT_VERSION:
+            return None
+        try:
+            header = json.loads(file.read(header_length))
+        except ValueError:
+            return None
+    if header["columns"] != _column_layout() or header["source"] != capture_fingerprint(file_path):
+        return None
+
+    length = header["length"]
+    offset = CACHE_PREAMBLE.size + header_length
+    offsets = {}
+    for name, dtype in PACKET_TABLE_COLUMNS.items():
+        offset += -offset % COLUMN_ALIGNMENT
+        offsets[name] = offset
+        offset += length * np.dtype(dtype).itemsize
+    # A truncated cache file (e.g. a full disk) is rebuilt instead of mapping past its end
+    if offset > os.path.getsize(cache_path):
+        return None
+
+    columns = {}
+    for name, dtype in PACKET_TABLE_COLUMNS.items():
+        if length:
+            columns[name] = np.memmap(
+                cache_path, dtype=dtype, mode="c", offset=offsets[name], shape=(length,)
+            ).view(np.ndarray)
+        else:
+            columns[name] = np.empty(0, dtype=dtype)
+
+    truncated_packets = PacketTable(columns, time_base=header["time_base"])
+    truncated_packets.flow_index = FlowIndex.from_table(truncated_packets)
+    return truncated_packets
+
+
+def load_truncated_packets(file_path, chunk_size=CHUNK_SIZE, shards=None, cache=True, cache_path=None):
+    """
+    Cached create_truncated_packets_from_pcap + assign_flow_ids_to_packets. The first call reads the capture
+    (in parallel with shards) and stores the result next to it, later calls memory-map the cache until the
+    capture changes.
+
+    Parameters:
+    - file_path: Path to the pcap or pcapng file.
+    - chunk_size, shards: Passed to create_truncated_packets_from_pcap on a cache miss.
+    - cache: Set to False to always read the capture (the cache is not written either).
+    - cache_path: Cache file, {file_path}.ptcache by default.
+
+    Returns:
+    PacketTable with flow ids assigned.
+    """
+    if cache:
+        truncated_packets = load_packet_cache(file_path, cache_path)
+        if truncated_packets is not None:
+            print(f"Loaded {len(truncated_packets)} cached packets of {file_path}")
+            return truncated_packets
+
+    truncated_packets = assign_flow_ids_to_packets(
+        create_truncated_packets_from_pcap(file_path, chunk_size, shards=shards)
+    )
+    if cache:
+        try:
+            save_packet_cache(truncated_packets, file_path, cache_path)
+        except OSError as error:  # e.g. a read-only capture folder - the table is still usable
+            print(f"Could not write the packet cache of {file_path}: {error}")
+    return truncated_packets
@@ -0,0 +1,302 @@
+import mmap
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+LINKTYPE_ETHERNET = 1
+
+ETHERTYPE_IPV4 = 0x0800
+# Ethertypes which never carry an IP layer - everything else unknown goes to scapy
+ETHERTYPES_WITHOUT_IP = {0x0806, 0x8035, 0x88CC}  # ARP, RARP, LLDP
+
+PROTO_ICMP = 1
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+# Header decoding results
+PARSED = 0  # IPv4 with TCP/UDP decoded from raw bytes
+SKIPPED = 1  # certainly not a TCP/UDP over IP packet
+NEEDS_SCAPY = 2  # unusual encapsulation, has to be dissected by scapy
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+
+# Numpy arrays describing consecutive capture records
+RecordBatch = namedtuple(
+    "RecordBatch",
+    [
+        "number",  # 1-based record number in the capture (packet_id)
+        "offset",  # file offset of the whole record (pcap header / pcapng block)
+        "length",  # length of the whole record on disk
+        "data_offset",  # file offset of the captured packet bytes
+        "caplen",
+        "wirelen",
+        "linktype",
+        "ticks",  # timestamp in units of 1 / resolution seconds
+        "resolution",
+    ],
+)
+
+# Byte range of a capture holding whole records, with the walker state needed to parse it on its own
+Shard = namedtuple(
+    "Shard",
+    [
+        "offset",  # file offset of the shard's first record
+        "stop",  # file offset right after the shard's last record
+        "number",  # record number of the shard's first record
+        "endian",  # byte order of the section the shard starts in
+        "interfaces",  # pcapng interfaces defined before the shard
+    ],
+)
+
+
+class PcapFile:
+    """
+    Memory-mapped pcap/pcapng capture. Records are walked by reading only their headers and returned as
+    RecordBatch arrays, so packet bytes are never copied or dissected unless a caller asks for them.
+
+    Usage:
+        with PcapFile(path) as pcap:
+            for batch in pcap.iter_record_batches():
+                ...
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self._file.close()
+            raise ValueError(f"Empty capture file: {file_path}")
+        self.buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        self.interfaces = []  # (linktype, snaplen, resolution) of pcapng interfaces
+        self._read_file_header()
+
+    def _read_file_header(self):
+        magic = self._mmap[:4]
+        if magic in (b"\xa1\xb2\xc3\xd4", b"\xd4\xc3\xb2\xa1", b"\xa1\xb2\x3c\x4d", b"\x4d\x3c\xb2\xa1"):
+            self.format = "pcap"
+            self.endian = ">" if magic[0] == 0xA1 else "<"
+            self.resolution = 10**9 if magic in (b"\xa1\xb2\x3c\x4d", b"\x4d\x3c\xb2\xa1") else 10**6
+            _, _, _, _, self.snaplen, self.linktype = struct.unpack_from(self.endian + "HHIIII", self._mmap, 4)
+            self.header_length = 24
+        elif struct.unpack_from("<I", self._mmap, 0)[0] == PCAPNG_SHB:
+            self.format = "pcapng"
+            byte_order = self._mmap[8:12]
+            if byte_order == b"\x1a\x2b\x3c\x4d":
+                self.endian = ">"
+            elif byte_order == b"\x4d\x3c\x2b\x1a":
+                self.endian = "<"
+            else:
+                raise ValueError(f"Bad pcapng byte-order magic in {self.file_path}")
+            self.header_length = 0  # section header is walked as a regular block
+            self.linktype = None
+            self.resolution = None
+        else:
+            raise ValueError(f"Not a pcap/pcapng capture file: {self.file_path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self.buffer = None
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+
+    def __len__(self):
+        return len(self._mmap)
+
+    def read(self, offset, length):
+        return self._mmap[offset:offset + length]
+
+    def _walk(self, offset, stop, number):
+        walk = self._walk_pcap if self.format == "pcap" else self._walk_pcapng
+        return walk(offset, stop, number)
+
+    def iter_record_batches(self, batch_size=100000, shard=None):
+        """
+        Yields RecordBatch arrays for consecutive records, at most batch_size records each.
+        With a Shard (see shards) only the records of that byte range are walked.
+        """
+        if shard is None:
+            records = self._walk(self.header_length, len(self), 1)
+        else:
+            self.endian, self.interfaces = shard.endian, list(shard.interfaces)
+            records = self._walk(shard.offset, shard.stop, shard.number)
+        columns = [[] for _ in RecordBatch._fields]
+        for record in records:
+            for column, value in zip(columns, record):
+                column.append(value)
+            if len(columns[0]) >= batch_size:
+                yield _record_batch(columns)
+                columns = [[] for _ in RecordBatch._fields]
+        if columns[0]:
+            yield _record_batch(columns)
+
+    def shards(self, count):
+        """
+        Splits the capture into at most count byte ranges of about equal size. Boundaries are moved to the
+        next record start, so every shard holds whole records and can be parsed independently (e.g. in
+        another process). Only record headers are read.
+
+        Returns:
+        List of Shard in file order, empty for a capture without records.
+        """
+        start_endian, start_interfaces = self.endian, list(self.interfaces)
+        targets = [len(self) * i // count for i in range(1, count)]
+        starts = []
+        for number, offset, *_ in self._walk(self.header_length, len(self), 1):
+            if not starts or (targets and offset >= targets[0]):
+                while targets and offset >= targets[0]:
+                    targets.pop(0)
+                starts.append((number, offset, self.endian, list(self.interfaces)))
+        # Walking changed the section state, later reads start from the beginning again
+        self.endian, self.interfaces = start_endian, start_interfaces
+
+        return [
+            Shard(offset, starts[i + 1][1] if i + 1 < len(starts) else len(self), number, endian, interfaces)
+            for i, (number, offset, endian, interfaces) in enumerate(starts)
+        ]
+
+    def _walk_pcap(self, offset, stop, number):
+        unpack_from = struct.Struct(self.endian + "IIII").unpack_from
+        data = self._mmap
+        linktype, resolution = self.linktype, self.resolution
+        while offset + 16 <= stop:
+            sec, frac, caplen, wirelen = unpack_from(data, offset)
+            if offset + 16 + caplen > len(data):  # truncated last record
+                break
+            yield number, offset, 16 + caplen, offset + 16, caplen, wirelen, linktype, sec * resolution + frac, resolution
+            offset += 16 + caplen
+            number += 1
+
+    def _walk_pcapng(self, offset, stop, number):
+        data = self._mmap
+        while offset + 12 <= stop:
+            block_type = struct.unpack_from(self.endian + "I", data, offset)[0]
+            if block_type == PCAPNG_SHB:
+                # A new section may switch the byte order and always resets the interfaces
+                self.endian = ">" if data[offset + 8:offset + 12] == b"\x1a\x2b\x3c\x4d" else "<"
+                self.interfaces = []
+            block_length = struct.unpack_from(self.endian + "I", data, offset + 4)[0]
+            if block_length < 12 or offset + block_length > len(data):
+                break
+            body = offset + 8
+
+            if block_type == PCAPNG_IDB:
+                linktype, snaplen = struct.unpack_from(self.endian + "HxxI", data, body)
+                resolution = _pcapng_resolution(data, body + 8, offset + block_length - 4, self.endian)
+                self.interfaces.append((linktype, snaplen, resolution))
+                if self.linktype is None:
+                    self.linktype, self.resolution = linktype, resolution
+            elif block_type == PCAPNG_EPB:
+                interface, high, low, caplen, wirelen = struct.unpack_from(self.endian + "5I", data, body)
+                linktype, _, resolution = self.interfaces[interface]
+                yield number, offset, block_length, body + 20, caplen, wirelen, linktype, (high << 32) + low, resolution
+                number += 1
+            elif block_type == PCAPNG_PB:
+                interface, _, high, low, caplen, wirelen = struct.unpack_from(self.endian + "HH4I", data, body)
+                linktype, _, resolution = self.interfaces[interface]
+                yield number, offset, block_length, body + 20, caplen, wirelen, linktype, (high << 32) + low, resolution
+                number += 1
+            elif block_type == PCAPNG_SPB:
+                wirelen = struct.unpack_from(self.endian + "I", data, body)[0]
+                linktype, snaplen, resolution = self.interfaces[0]
+                # Simple packet blocks carry no timestamp
+                yield number, offset, block_length, body + 4, min(wirelen, snaplen), wirelen, linktype, 0, resolution
+                number += 1
+            offset += block_length
+
+
+def _record_batch(columns):
+    return RecordBatch(*(np.array(column, dtype=np.int64) for column in columns))
+
+
+def _pcapng_resolution(data, offset, end, endian):
+    """
+    Reads the if_tsresol option of an Interface Description Block (default is microseconds).
+    """
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", data, offset)
+        if code == 0:
+            break
+        if code == 9 and length == 1:
+            tsresol = data[offset + 4]
+            return (2 if tsresol & 128 else 10) ** (tsresol & 127)
+        offset += 4 + length + (-length) % 4
+    return 10**6
+
+
+def _gather(buffer, positions, valid):
+    # Out-of-record positions are clamped and masked out by `valid`, so they never raise
+    return np.where(valid, buffer[np.minimum(positions, len(buffer) - 1)], 0).astype(np.int64)
+
+
+def _gather_u16(buffer, positions, valid):
+    return (_gather(buffer, positions, valid) << 8) | _gather(buffer, positions + 1, valid)
+
+
+def parse_record_headers(buffer, batch):
+    """
+    Decodes Ethernet/IPv4/TCP/UDP headers of a RecordBatch straight from the capture bytes with NumPy
+    gathers - no per-packet Python code and no scapy dissection.
+
+    Parameters:
+    - buffer: uint8 NumPy view of the whole capture file (PcapFile.buffer).
+    - batch: RecordBatch to decode.
+
+    Returns:
+    A dictionary of arrays: status (PARSED / SKIPPED / NEEDS_SCAPY), src_ip, dst_ip (uint32 values),
+    proto, sport, dport and tcp_flags. Fields are only meaningful where status == PARSED.
+    """
+    data = batch.data_offset
+    caplen = batch.caplen
+    status = np.full(len(data), NEEDS_SCAPY, dtype=np.int8)
+
+    ethernet = (batch.linktype == LINKTYPE_ETHERNET) & (caplen >= 14)
+    ethertype = _gather_u16(buffer, data + 12, ethernet)
+    status[ethernet & np.isin(ethertype, list(ETHERTYPES_WITHOUT_IP))] = SKIPPED
+
+    ip = data + 14
+    ipv4 = ethernet & (ethertype == ETHERTYPE_IPV4) & (caplen >= 34)
+    version_ihl = _gather(buffer, ip, ipv4)
+    ihl = (version_ihl & 0x0F) * 4
+    total_length = _gather_u16(buffer, ip + 2, ipv4)
+    fragment_offset = _gather_u16(buffer, ip + 6, ipv4) & 0x1FFF
+    proto = _gather(buffer, ip + 9, ipv4)
+    ipv4 &= (version_ihl >> 4 == 4) & (ihl >= 20)
+
+    # scapy binds upper layers only to the first fragment (frag=0), later fragments stay Raw.
+    # ICMP never dissects into TCP/UDP layers either (error payloads become TCPerror/UDPerror).
+    status[ipv4 & ((fragment_offset != 0) | (proto == PROTO_ICMP))] = SKIPPED
+    ipv4 &= fragment_offset == 0
+
+    l4 = ip + ihl
+    header_length = np.where(proto == PROTO_TCP, 20, 8)
+    transport = (
+        ipv4
+        & ((proto == PROTO_TCP) | (proto == PROTO_UDP))
+        & (caplen >= 14 + ihl + header_length)
+        & (total_length >= ihl + header_length)
+    )
+    status[transport] = PARSED
+
+    return {
+        "status": status,
+        "src_ip": (_gather_u16(buffer, ip + 12, transport) << 16) | _gather_u16(buffer, ip + 14, transport),
+        "dst_ip": (_gather_u16(buffer, ip + 16, transport) << 16) | _gather_u16(buffer, ip + 18, transport),
+        "proto": np.where(transport, proto, 0),
+        "sport": _gather_u16(buffer, l4, transport),
+        "dport": _gather_u16(buffer, l4 + 2, transport),
+        "tcp_flags": _gather(buffer, l4 + 13, transport & (proto == PROTO_TCP)),
+    }
@@ -1,9 +1,46 @@
+import heapq
+import json
 import os
+import shutil
+import struct
+import tempfile
+from collections import namedtuple
 
+import numpy as np
 from scapy.all import (IP, TCP, Ether, Packet, Padding, PcapReader, PcapWriter,
                        Raw, fragment)
+from scapy.data import MTU
 from scapy.fields import StrField
 
+from src.utils.flow import TCP_EXPIRATION, UDP_EXPIRATION
+from src.utils.packet_cache import capture_fingerprint
+from src.utils.pcap_parser import PcapFile, RecordBatch
+from src.utils.truncated_packet import CHUNK_SIZE, PACKET_TABLE_COLUMNS, PacketTable, _dissect_record
+
+WRITE_BUFFER_SIZE = 8 << 20  # bytes of output collected before a write reaches the file
+# Native byte order and microsecond timestamps, like scapy's PcapWriter
+PCAP_FILE_HEADER = struct.Struct("=IHHIIII")
+PCAP_MAGIC_MICROSECONDS = 0xA1B2C3D4
+
+# Records moved further than this can only end up in another flow anyway (flows expire after 240s)
+MAX_REORDER_WINDOW = min(TCP_EXPIRATION, UDP_EXPIRATION) - 1
+DEFAULT_REORDER_BUFFER = 256 << 20  # bytes of records held by the re-sequencing window
+
+MANIFEST_VERSION = 1
+# Columns of the changed packets kept in a diff manifest: their capture record and their new values
+MANIFEST_RECORD_COLUMNS = ["number", "offset", "length", "data_offset", "caplen", "wirelen", "linktype"]
+MANIFEST_PACKET_COLUMNS = ["timestamp", "size", "fragmented"]
+
+RestorationStats = namedtuple(
+    "RestorationStats",
+    [
+        "records",  # capture records read (changed records only for delta restoration)
+        "raw",  # records copied as raw bytes (timestamp header rewritten)
+        "rebuilt",  # records rebuilt by scapy for padding / fragmentation
+        "max_shift",  # largest timestamp change of a record in seconds, sizes the re-sequencing window
+    ],
+)
+
 
 class StealthProtocol(Packet):
     name = "StealthProtocol"
@@ -99,66 +136,424 @@ def dummy_flag(packet, flags):
         return "The packet does not contain an IP layer."
 
 
-def modify_and_write_packets_one_by_one(
-    original_pcap, modified_pcap, truncated_packets=None
-):
-
-    if os.path.exists(modified_pcap):
-        os.remove(modified_pcap)
-
-    writer = PcapWriter(modified_pcap, append=True, sync=True)
-    truncated_packets_dict = {tp.packet_id: tp for tp in truncated_packets}
-
-    with PcapReader(original_pcap) as reader:
-        for i, packet in enumerate(reader):
-            if IP in packet:
-                packet_id = i + 1
-                if packet_id in truncated_packets_dict:
-                    tp = truncated_packets_dict[packet_id]
-
-                    # Change timestamp if necessary
-                    packet.time = tp.timestamp
-
-                    # Adjust packet size by adding padding or fragmenting
-                    packet_length = len(packet)
-                    if packet_length < tp.size:
-                        packet = add_padding(packet, tp.size - packet_length)
-
-                    # Fragmentation
-                    if tp.fragmented == 1:
-                        packet = fragment_packet(packet, int(tp.size/2))
-                    elif tp.fragmented == 2:
-                        packet = fragment_packet(packet, int(tp.size/4))
-
-                    # TEST CASE SCENARIOS WHICH WORKED:
-
-                    # CHANGE TIMESTAMP
-                    # new_timestamp = packet.time + 100000000
-                    # packet = change_packet_timestamp(packet, new_timestamp)
-
-                    # PACKET FRAGMENTATION
-                    # fragment_size = 500
-                    # packet = fragment_packet(packet, fragment_size)
-
-                    # PADDING
-                    # padding_size = 200
-                    # packet = add_padding(packet, padding_size)
-
-                    # SPLIT FLOW
-                    # writer.write(packet) - dont send afterwards
-                    # splt = split_flow(packet)
-                    # writer.write(splt)
+def _packet_lookup(truncated_packets):
+    """
+    Returns (table, positions): a PacketTable of the packets and a function mapping record numbers to table
+    positions (-1 for records without a TruncatedPacket).
+    """
+    table = truncated_packets if isinstance(truncated_packets, PacketTable) else PacketTable.from_packets(
+        list(truncated_packets or [])
+    )
+    order = np.argsort(table.packet_id, kind="stable")
+    packet_ids = table.packet_id[order]
+
+    def positions(numbers):
+        if not len(packet_ids):
+            return np.full(len(numbers), -1, dtype=np.int64)
+        i = np.minimum(np.searchsorted(packet_ids, numbers), len(packet_ids) - 1)
+        return np.where(packet_ids[i] == numbers, order[i], -1)
+
+    return table, positions
+
+
+def _rebuild_packet(pcap, batch, index, tp):
+    """
+    Dissects a capture record and applies the TruncatedPacket tp: timestamp, padding up to its size and
+    fragmentation. Returns a scapy packet or a list of fragments.
+    """
+    packet = _dissect_record(pcap, batch, index)
+    packet.wirelen = int(batch.wirelen[index])
+    packet.time = tp.timestamp
+    packet_length = len(packet)
+    if packet_length < tp.size:
+        packet = add_padding(packet, tp.size - packet_length)
+    if tp.fragmented == 1:
+        packet = fragment_packet(packet, int(tp.size / 2))
+    elif tp.fragmented == 2:
+        packet = fragment_packet(packet, int(tp.size / 4))
+    return packet
 
-                    # DUMMY PACKET
-                    # writer.write(packet) - dont send afterwards
-                    # writer.write(dummy_packet(packet, 1000))
 
-                    # DUMMY FLAG
-                    # writer.write(packet) - donr send afterwards
-                    # writer.write(dummy_flag(packet, "SA"))
+def _split_timestamps(timestamps, resolution):
+    """
+    Whole seconds and fraction (in 1 / resolution units) of float timestamps, rounded half to even like
+    PcapWriter. A fraction that rounds up to a full second is carried into the seconds, PcapWriter would
+    write it as an out of range fraction.
+    """
+    whole = np.trunc(timestamps)
+    fraction = np.rint((timestamps - whole) * resolution).astype(np.int64)
+    carry = fraction >= resolution
+    return whole.astype(np.int64) + carry, fraction - carry * resolution
+
+
+def _write_rebuilt(writer, packet, seconds, fraction):
+    # A rebuilt packet (or its fragments) with the record time of _split_timestamps
+    for part in packet if isinstance(packet, list) else [packet]:
+        writer.write_packet(part, sec=int(seconds), usec=int(fraction))
+
+
+def _record_times(batch, rows, table):
+    """
+    Seconds / microseconds of every record, rounded like PcapWriter (see _split_timestamps): records with a
+    TruncatedPacket take its (float) timestamp, all others keep their capture timestamp.
+    """
+    seconds = batch.ticks // batch.resolution
+    # Exact ticks, rounded half to even like the Decimal timestamps of PcapReader
+    microseconds, remainder = np.divmod((batch.ticks % batch.resolution) * 10**6, batch.resolution)
+    microseconds += (2 * remainder > batch.resolution) | ((2 * remainder == batch.resolution) & (microseconds % 2 == 1))
+
+    known = rows >= 0
+    seconds[known], microseconds[known] = _split_timestamps(table.time_base + table.timestamp[rows[known]], 10**6)
+    return seconds, microseconds
+
+
+def write_restored_pcap(original_pcap, modified_pcap, truncated_packets, batch_size=CHUNK_SIZE,
+                        buffer_size=WRITE_BUFFER_SIZE, resequence=False):
+    """
+    Writes original_pcap with the sizes, fragmentation and timestamps of truncated_packets applied, the
+    result equals modify_and_write_packets_one_by_one (as a microsecond pcap file).
+
+    Records are walked straight from the memory-mapped capture (see PcapFile). A record whose packet only
+    changed its timestamp (or did not change at all) is copied as raw bytes behind a rewritten record
+    header; scapy dissects only the packets that need padding or fragmentation. Output is collected per
+    batch and written through a buffer_size file buffer instead of being flushed packet by packet.
+
+    Parameters:
+    - original_pcap: Capture the packets were read from (pcap or pcapng).
+    - modified_pcap: Output pcap file, replaced if it exists.
+    - truncated_packets: PacketTable or list of TruncatedPacket objects, matched to records by packet_id.
+    - batch_size: Capture records handled at once.
+    - buffer_size: Size of the output file buffer.
+    - resequence: Write the records in timestamp order (see resequence_pcap) instead of capture order.
+
+    Returns:
+    RestorationStats
+
+    Raises ValueError if the capture mixes linktypes (a pcapng file with several kinds of interfaces), a pcap
+    file has a single linktype in its header.
+    """
+    if resequence:
+        return _resequenced(write_restored_pcap, original_pcap, modified_pcap, truncated_packets,
+                            batch_size=batch_size, buffer_size=buffer_size)
+
+    table, lookup = _packet_lookup(truncated_packets)
+    records = raw = rebuilt = 0
+    max_shift = 0.0
+
+    with PcapFile(original_pcap) as pcap, open(modified_pcap, "wb", buffering=buffer_size) as output:
+        writer = None
+        for batch in pcap.iter_record_batches(batch_size):
+            if writer is None:
+                linktype = int(batch.linktype[0])
+                output.write(PCAP_FILE_HEADER.pack(PCAP_MAGIC_MICROSECONDS, 2, 4, 0, 0, MTU, linktype))
+                writer = PcapWriter(output, linktype=linktype)
+                writer.header_present = True
+            mixed = batch.linktype != linktype
+            if np.any(mixed):
+                raise ValueError(
+                    f"{original_pcap} mixes linktypes {linktype} and {int(batch.linktype[mixed][0])} "
+                    f"(record {int(batch.number[mixed][0])}), a pcap file can only hold one"
+                )
+
+            rows = lookup(batch.number)
+            seconds, microseconds = _record_times(batch, rows, table)
+            headers = np.stack([seconds, microseconds, batch.caplen, batch.wirelen], axis=1).astype(np.uint32)
+            headers = memoryview(headers.tobytes())
+
+            known = rows >= 0
+            if np.any(known):
+                shifts = table.time_base + table.timestamp[rows[known]] - batch.ticks[known] / batch.resolution[known]
+                max_shift = max(max_shift, float(np.abs(shifts).max()))
+            sizes = np.where(known, table.size[rows], 0)
+            fragmented = np.where(known, table.fragmented[rows], 0)
+            needs_scapy = known & ((sizes > batch.caplen) | (fragmented != 0))
+
+            parts = []
+            for index in range(len(rows)):
+                if not needs_scapy[index]:
+                    parts.append(headers[16 * index:16 * index + 16])
+                    parts.append(pcap.read(int(batch.data_offset[index]), int(batch.caplen[index])))
+                    continue
+                output.write(b"".join(parts))
+                parts = []
+                _write_rebuilt(writer, _rebuild_packet(pcap, batch, index, table[int(rows[index])]),
+                               seconds[index], microseconds[index])
+                rebuilt += 1
+            output.write(b"".join(parts))
+            records += len(rows)
+            raw += len(rows) - int(needs_scapy.sum())
+
+    return RestorationStats(records, raw, rebuilt, max_shift)
+
+
+def changed_packet_ids(original_packets, perturbed_packets):
+    """
+    packet_ids whose timestamp, size or fragmentation differ between two versions of the same packets
+    (PacketTables or lists of TruncatedPacket objects, matched by packet_id) - the change log of
+    write_delta_pcap.
+    """
+    original, lookup = _packet_lookup(original_packets)
+    perturbed, _ = _packet_lookup(perturbed_packets)
+    rows = lookup(perturbed.packet_id)
+    known = rows >= 0
+    changed = ~known
+    changed[known] = (
+        (perturbed.size[known] != original.size[rows[known]])
+        | (perturbed.fragmented[known] != original.fragmented[rows[known]])
+        | (perturbed.time_base + perturbed.timestamp[known] != original.time_base + original.timestamp[rows[known]])
+    )
+    return np.unique(perturbed.packet_id[changed])
+
+
+def write_delta_pcap(original_pcap, modified_pcap, truncated_packets, packet_ids, manifest_path=None,
+                     batch_size=CHUNK_SIZE, resequence=False):
+    """
+    Writes original_pcap with only the packets in packet_ids perturbed (e.g. changed_packet_ids of the
+    optimized flows). Every other record is passed through untouched: the bytes between two changed records
+    are copied from the memory-mapped capture in a single write, and record headers are walked only up to
+    the last changed packet.
+
+    The changes are described by a diff manifest - the capture's fingerprint plus, for every changed packet,
+    its record location and new timestamp / size / fragmentation. restore_from_manifest rebuilds the variant
+    from the original capture and the manifest alone, so many candidate variants of a capture can be kept
+    as small manifests and written on demand.
+
+    Only pcap captures are spliced. A pcapng capture is written by write_restored_pcap with the changed
+    packets applied, which re-encodes every record.
+
+    Parameters:
+    - original_pcap: Capture the packets were read from.
+    - modified_pcap: Output capture, replaced if it exists.
+    - truncated_packets: PacketTable or list of TruncatedPacket objects with the perturbed values.
+    - packet_ids: Iterable of the packet_ids to write perturbed.
+    - manifest_path: Optional file to store the diff manifest (JSON) in.
+    - batch_size: Capture records walked at once.
+    - resequence: Write the records in timestamp order (see resequence_pcap) instead of capture order.
+
+    Returns:
+    The manifest dictionary.
+    """
+    table, lookup = _packet_lookup(truncated_packets)
+    packet_ids = np.unique(np.asarray(list(packet_ids), dtype=np.int64))
+    rows = lookup(packet_ids)
+    if np.any(rows < 0):
+        raise ValueError(f"No TruncatedPacket for packet_ids {packet_ids[rows < 0][:10].tolist()}")
+
+    records = {name: [] for name in MANIFEST_RECORD_COLUMNS}
+    with PcapFile(original_pcap) as pcap:
+        for batch in pcap.iter_record_batches(batch_size):
+            matched = np.isin(batch.number, packet_ids)
+            for name in MANIFEST_RECORD_COLUMNS:
+                records[name].extend(getattr(batch, name)[matched].tolist())
+            if len(packet_ids) == 0 or batch.number[-1] >= packet_ids[-1]:
+                break
+    if len(records["number"]) != len(packet_ids):
+        raise ValueError(f"{len(packet_ids) - len(records['number'])} packet_ids are not records of {original_pcap}")
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "source": capture_fingerprint(original_pcap),
+        "records": records,
+        "packets": {
+            "timestamp": (table.time_base + table.timestamp[rows]).tolist(),
+            "size": table.size[rows].tolist(),
+            "fragmented": table.fragmented[rows].tolist(),
+        },
+    }
+    if manifest_path is not None:
+        with open(manifest_path, "w") as file:
+            json.dump(manifest, file, separators=(",", ":"))
+    if resequence:
+        _resequenced(_apply_manifest, original_pcap, modified_pcap, manifest)
+    else:
+        _apply_manifest(original_pcap, modified_pcap, manifest)
+    return manifest
+
+
+def restore_from_manifest(original_pcap, manifest_path, modified_pcap, resequence=False):
+    """
+    Writes the capture variant described by a diff manifest of write_delta_pcap (in timestamp order with
+    resequence). Raises ValueError if original_pcap is not the capture the manifest was made from.
+    """
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    if manifest["version"] != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version {manifest['version']} in {manifest_path}")
+    if manifest["source"] != capture_fingerprint(original_pcap):
+        raise ValueError(f"{manifest_path} was not made from {original_pcap}")
+    if resequence:
+        return _resequenced(_apply_manifest, original_pcap, modified_pcap, manifest)
+    return _apply_manifest(original_pcap, modified_pcap, manifest)
+
+
+def _manifest_changes(manifest):
+    """
+    (RecordBatch, PacketTable) of the changed records and their new values, aligned row by row.
+    """
+    records = {name: np.array(manifest["records"][name], dtype=np.int64) for name in MANIFEST_RECORD_COLUMNS}
+    count = len(records["number"])
+    batch = RecordBatch(**records, ticks=np.zeros(count, dtype=np.int64), resolution=np.ones(count, dtype=np.int64))
+    columns = {name: np.zeros(count) for name in PACKET_TABLE_COLUMNS}
+    # Absolute timestamps with time_base 0, so they are written exactly as they were recorded
+    columns.update(packet_id=records["number"], timestamp=manifest["packets"]["timestamp"],
+                   size=manifest["packets"]["size"], fragmented=manifest["packets"]["fragmented"])
+    return batch, PacketTable(columns)
+
+
+def _apply_manifest(original_pcap, modified_pcap, manifest, buffer_size=WRITE_BUFFER_SIZE):
+    batch, changes = _manifest_changes(manifest)
+    with PcapFile(original_pcap) as pcap:
+        if pcap.format != "pcap":
+            return write_restored_pcap(original_pcap, modified_pcap, changes)
+
+        record_header = struct.Struct(pcap.endian + "IIII")
+        new_seconds, new_fractions = _split_timestamps(changes.time_base + changes.timestamp, pcap.resolution)
+        raw = rebuilt = 0
+        max_shift = 0.0
+        with open(modified_pcap, "wb", buffering=buffer_size) as output:
+            writer = PcapWriter(output, linktype=pcap.linktype, endianness=pcap.endian,
+                                nano=pcap.resolution == 10**9)
+            writer.header_present = True
+            position = 0
+            for index in range(len(batch.number)):
+                output.write(pcap.buffer[position:batch.offset[index]])  # untouched records, straight from the map
+                tp = changes[index]
+                caplen = int(batch.caplen[index])
+                seconds, fraction = record_header.unpack_from(pcap.buffer, int(batch.offset[index]))[:2]
+                max_shift = max(max_shift, abs(tp.timestamp - (seconds + fraction / pcap.resolution)))
+                if tp.fragmented != 0 or tp.size > caplen:
+                    _write_rebuilt(writer, _rebuild_packet(pcap, batch, index, tp),
+                                   new_seconds[index], new_fractions[index])
+                    rebuilt += 1
+                else:
+                    output.write(record_header.pack(int(new_seconds[index]), int(new_fractions[index]), caplen,
+                                                    int(batch.wirelen[index])))
+                    output.write(pcap.buffer[batch.data_offset[index]:batch.data_offset[index] + caplen])
+                    raw += 1
+                position = int(batch.offset[index] + batch.length[index])
+            output.write(pcap.buffer[position:])
+    return RestorationStats(len(batch.number), raw, rebuilt, max_shift)
+
+
+def _resequenced(restore, original_pcap, modified_pcap, *args, **kwargs):
+    """
+    Runs a restoration into a temporary file and re-sequences it into modified_pcap, with the reorder window
+    sized from the largest timestamp change it applied.
+    """
+    temporary_path = f"{modified_pcap}.unordered"
+    try:
+        stats = restore(original_pcap, temporary_path, *args, **kwargs)
+        resequence_pcap(temporary_path, modified_pcap, window=stats.max_shift)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return stats
+
+
+def _pcap_records(pcap, batch_size=CHUNK_SIZE):
+    # (ticks, whole record bytes) in file order
+    for batch in pcap.iter_record_batches(batch_size):
+        for ticks, offset, length in zip(batch.ticks.tolist(), batch.offset.tolist(), batch.length.tolist()):
+            yield ticks, pcap.read(offset, length)
+
+
+def resequence_pcap(input_pcap, output_pcap, window=MAX_REORDER_WINDOW, max_buffered=DEFAULT_REORDER_BUFFER,
+                    buffer_size=WRITE_BUFFER_SIZE):
+    """
+    Rewrites a pcap file with its records in timestamp order (records with equal timestamps keep their
+    order), e.g. after timing perturbations moved packets past their neighbours.
+
+    Records are streamed through a heap and released once the capture has advanced `window` seconds past
+    them, so memory holds only the records of one window (at most max_buffered bytes). A record older than
+    the already released ones - moved back further than the window - is held for the next sorted run
+    (replacement selection). Runs are spilled to temporary files and combined by an external k-way merge;
+    in the usual case of a single run the file is just moved into place.
+
+    Parameters:
+    - input_pcap: pcap file to re-sequence (e.g. written by write_restored_pcap).
+    - output_pcap: Output pcap file, replaced if it exists. Must differ from input_pcap.
+    - window: Largest expected timestamp change in seconds, clamped to MAX_REORDER_WINDOW.
+    - max_buffered: Bytes of records the window may hold before records are released early.
+    - buffer_size: Size of the output file buffers.
+
+    Returns:
+    Number of sorted runs that were merged.
+    """
+    window = min(max(window, 0.0), MAX_REORDER_WINDOW)
+    run_directory = tempfile.mkdtemp(prefix="resequence-", dir=os.path.dirname(os.path.abspath(output_pcap)))
+    run_paths = []
+    try:
+        with PcapFile(input_pcap) as pcap:
+            if pcap.format != "pcap":
+                raise ValueError(f"Only pcap files can be re-sequenced: {input_pcap}")
+            file_header = pcap.read(0, pcap.header_length)
+            window_ticks = int(window * pcap.resolution)
+
+            def new_run():
+                run_paths.append(os.path.join(run_directory, f"run-{len(run_paths)}.pcap"))
+                run = open(run_paths[-1], "wb", buffering=buffer_size)
+                run.write(file_header)
+                return run
+
+            run = new_run()
+            run_number = 0
+            heap = []  # (run number, ticks, sequence, record)
+            buffered = sequence = 0
+            watermark = last_released = None
+
+            def release():
+                nonlocal run, run_number, buffered, last_released
+                record_run, ticks, _, record = heapq.heappop(heap)
+                buffered -= len(record)
+                if record_run != run_number:
+                    run.close()
+                    run = new_run()
+                    run_number = record_run
+                run.write(record)
+                last_released = ticks
+
+            for ticks, record in _pcap_records(pcap):
+                # Replacement selection: a record older than the released ones waits for the next run
+                late = last_released is not None and ticks < last_released
+                heapq.heappush(heap, (run_number + late, ticks, sequence, record))
+                sequence += 1
+                buffered += len(record)
+                watermark = ticks if watermark is None else max(watermark, ticks)
+                while heap and (buffered > max_buffered
+                                or (heap[0][0] == run_number and heap[0][1] <= watermark - window_ticks)):
+                    release()
+            while heap:
+                release()
+            run.close()
+
+        if len(run_paths) == 1:
+            os.replace(run_paths[0], output_pcap)
+        else:
+            print(f"Re-sequencing {input_pcap}: merging {len(run_paths)} runs")
+            runs = [PcapFile(path) for path in run_paths]
+            try:
+                with open(output_pcap, "wb", buffering=buffer_size) as output:
+                    output.write(file_header)
+                    merged = heapq.merge(
+                        *(((ticks, i, record) for ticks, record in _pcap_records(run)) for i, run in enumerate(runs))
+                    )
+                    for _, _, record in merged:
+                        output.write(record)
+            finally:
+                for run in runs:
+                    run.close()
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
+    return len(run_paths)
 
-                    #TODO: test
-                    #writer.write(packet) # <--- don't write packet if not in truncated_packets list
-            writer.write(packet) # <--- always write packet - even if not in truncated_packets
 
-    writer.close()
+def modify_and_write_packets_one_by_one(
+    original_pcap, modified_pcap, truncated_packets=None, resequence=False
+):
+    """
+    Writes original_pcap into modified_pcap with the perturbations of truncated_packets applied
+    (timestamps, padding up to the packet size, fragmentation). See write_restored_pcap.
+    """
+    stats = write_restored_pcap(original_pcap, modified_pcap, truncated_packets, resequence=resequence)
+    print(f"Restored {stats.records} records to {modified_pcap}: {stats.raw} copied, {stats.rebuilt} rebuilt")
+    return stats
@@ -1,4 +1,11 @@
-from scapy.all import IP, TCP, UDP, rdpcap
+import multiprocessing
+import os
+import socket
+
+import numpy as np
+from scapy.all import IP, TCP, UDP, PcapReader, conf
+
+from src.utils.pcap_parser import NEEDS_SCAPY, PARSED, PROTO_TCP, PROTO_UDP, PcapFile, parse_record_headers
 
 
 class TruncatedPacket:
@@ -20,6 +27,8 @@ class TruncatedPacket:
         ack,
         psh,
         urg,
+        flow_key_hi=0,
+        flow_key_lo=0,
     ):
         self.packet_id = packet_id
         self.timestamp = timestamp
@@ -37,6 +46,8 @@ class TruncatedPacket:
         self.ack = ack
         self.psh = psh
         self.urg = urg
+        self.flow_key_hi = flow_key_hi  # canonical 5-tuple key, see flow_keys
+        self.flow_key_lo = flow_key_lo
 
     def __repr__(self):
         return (
@@ -46,79 +57,526 @@ class TruncatedPacket:
         )
 
 
+# Column layout of PacketTable - one contiguous array per TruncatedPacket attribute
+PACKET_TABLE_COLUMNS = {
+    "packet_id": np.int64,
+    "timestamp": np.float64,  # seconds relative to PacketTable.time_base
+    "size": np.int32,
+    "pseudo_hash": np.int64,
+    "flow_id": np.int64,
+    "direction": np.int8,
+    "src_ip": np.uint32,  # IPv4 address packed into an integer
+    "fragmented": np.int8,
+    "tcp": np.int8,
+    "udp": np.int8,
+    "fin": np.int8,
+    "syn": np.int8,
+    "rst": np.int8,
+    "ack": np.int8,
+    "psh": np.int8,
+    "urg": np.int8,
+    "flow_key_hi": np.uint64,  # canonical bidirectional 5-tuple (see flow_keys): both IPv4 addresses
+    "flow_key_lo": np.uint64,  # both ports and the IP protocol
+}
+
+NO_FLOW = 0  # flow_id stored for packets without assigned flow (flow ids start from 1)
+NO_HASH = np.iinfo(np.int64).min  # pseudo_hash stored for packets without TCP/UDP layer
+NO_KEY = 0  # flow_key_lo stored for packets without TCP/UDP layer (a real key always has a protocol)
+
+
+def ip_to_int(ip):
+    return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(int(value).to_bytes(4, "big"))
+
+
+def wrap_pseudo_hash(pseudo_hash):
+    """
+    Maps a pseudo_hash onto the int64 range of the pseudo_hash column (sum of Python hashes can overflow it).
+    """
+    if pseudo_hash is None:
+        return NO_HASH
+    return (pseudo_hash + 2**63) % 2**64 - 2**63
+
+
+def flow_keys(src_ips, dst_ips, sports, dports, protos):
+    """
+    Canonical bidirectional 5-tuple of every packet, packed exactly into two unsigned 64-bit words.
+    The endpoints are ordered by (IPv4 address, port), so both directions of a connection get the same key:
+
+    - hi: lower endpoint's address << 32 | higher endpoint's address
+    - lo: lower endpoint's port << 24 | higher endpoint's port << 8 | protocol
+
+    Keys only depend on header values, so they are the same in every process and every capture shard.
+
+    Returns:
+    (hi, lo) uint64 arrays.
+    """
+    src_ips, dst_ips = np.asarray(src_ips, dtype=np.uint64), np.asarray(dst_ips, dtype=np.uint64)
+    sports, dports = np.asarray(sports, dtype=np.uint64), np.asarray(dports, dtype=np.uint64)
+    src_endpoints = (src_ips << np.uint64(16)) | sports
+    dst_endpoints = (dst_ips << np.uint64(16)) | dports
+    swap = src_endpoints > dst_endpoints
+    low_ips, high_ips = np.where(swap, dst_ips, src_ips), np.where(swap, src_ips, dst_ips)
+    low_ports, high_ports = np.where(swap, dports, sports), np.where(swap, sports, dports)
+    hi = (low_ips << np.uint64(32)) | high_ips
+    lo = (low_ports << np.uint64(24)) | (high_ports << np.uint64(8)) | np.asarray(protos, dtype=np.uint64)
+    return hi, lo
+
+
+def flow_key_digests(hi, lo):
+    """
+    Stable 64-bit digest of flow keys (splitmix64 finalizer), stored as pseudo_hash. Unlike the previous
+    sum of Python hash() values it does not depend on PYTHONHASHSEED. Grouping uses the exact key.
+    """
+    x = np.array(hi, dtype=np.uint64, ndmin=1) * np.uint64(0x9E3779B97F4A7C15) + np.array(lo, dtype=np.uint64, ndmin=1)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    digests = (x ^ (x >> np.uint64(31))).view(np.int64)
+    return np.where(digests == NO_HASH, NO_HASH + 1, digests)
+
+
+def _to_column(name, value, time_base=0):
+    if name == "timestamp":
+        return float(value - time_base)
+    if name == "flow_id":
+        return NO_FLOW if value is None else value
+    if name == "pseudo_hash":
+        return wrap_pseudo_hash(value)
+    if name == "src_ip":
+        return ip_to_int(value)
+    return value
+
+
+def _from_column(name, value, time_base=0):
+    value = value.item()
+    if name == "timestamp":
+        return time_base + value
+    if name == "flow_id":
+        return None if value == NO_FLOW else value
+    if name == "pseudo_hash":
+        return None if value == NO_HASH else value
+    if name == "src_ip":
+        return int_to_ip(value)
+    return value
+
+
+class PacketRow:
+    """
+    Row view over a PacketTable, exposing the same attributes as TruncatedPacket.
+    Reading and assigning attributes goes straight to the underlying column arrays,
+    so code written for lists of TruncatedPacket objects keeps working on a PacketTable.
+    """
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def to_truncated_packet(self):
+        return TruncatedPacket(**{name: getattr(self, name) for name in PACKET_TABLE_COLUMNS})
+
+    # Copies are detached from the table - deepcopy of a row must not copy the whole capture
+    def __copy__(self):
+        return self.to_truncated_packet()
+
+    def __deepcopy__(self, memo):
+        return self.to_truncated_packet()
+
+    def __eq__(self, other):
+        if not isinstance(other, PacketRow):
+            return NotImplemented
+        return self.table is other.table and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.table), self.index))
+
+    __repr__ = TruncatedPacket.__repr__
+
+
+def _row_property(name):
+    def getter(row):
+        return _from_column(name, row.table.columns[name][row.index], row.table.time_base)
+
+    def setter(row, value):
+        row.table.columns[name][row.index] = _to_column(name, value, row.table.time_base)
+        if name in ("flow_id", "direction"):
+            row.table.flow_index = None  # flow membership changed, the index is stale
+
+    return property(getter, setter)
+
+
+for _name in PACKET_TABLE_COLUMNS:
+    setattr(PacketRow, _name, _row_property(_name))
+
+
+class PacketTable:
+    """
+    Columnar replacement for a list of TruncatedPacket objects. Every attribute is kept in its own
+    contiguous NumPy array (see PACKET_TABLE_COLUMNS), which takes an order of magnitude less memory than
+    per-packet objects and lets flow statistics run vectorized. Iterating or indexing the table yields
+    PacketRow views, so existing callers written for lists keep working.
+
+    Columns can be accessed directly as attributes, e.g. `table.size` or `table.timestamp`.
+    Timestamps are stored relative to the integer `time_base` (seconds), because float64 epoch timestamps
+    lose sub-microsecond precision; rows still report absolute timestamps.
+    """
+
+    def __init__(self, columns=None, length=0, time_base=0):
+        self.time_base = int(time_base)
+        self.flow_index = None  # FlowIndex maintained by assign_flow_ids_to_packets
+        if columns is None:
+            columns = {name: np.zeros(length, dtype=dtype) for name, dtype in PACKET_TABLE_COLUMNS.items()}
+        self.columns = {
+            name: np.ascontiguousarray(columns[name], dtype=dtype) for name, dtype in PACKET_TABLE_COLUMNS.items()
+        }
+        lengths = {len(column) for column in self.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"PacketTable columns have different lengths: {lengths}")
+
+    @classmethod
+    def from_packets(cls, truncated_packets):
+        """
+        Builds a PacketTable from any iterable of TruncatedPacket-like objects.
+        """
+        if isinstance(truncated_packets, PacketTable):
+            return truncated_packets
+        truncated_packets = list(truncated_packets)
+        time_base = int(truncated_packets[0].timestamp) if truncated_packets else 0
+        columns = {name: [] for name in PACKET_TABLE_COLUMNS}
+        for packet in truncated_packets:
+            for name, values in columns.items():
+                values.append(_to_column(name, getattr(packet, name), time_base))
+        return cls(columns, time_base=time_base)
+
+    @classmethod
+    def concatenate(cls, tables):
+        tables = list(tables)
+        if not tables:
+            return cls()
+        time_base = tables[0].time_base
+        columns = {name: np.concatenate([table.columns[name] for table in tables]) for name in PACKET_TABLE_COLUMNS}
+        columns["timestamp"] = np.concatenate(
+            [table.timestamp + (table.time_base - time_base) for table in tables]
+        )
+        return cls(columns, time_base=time_base)
+
+    def to_packets(self):
+        """
+        Materializes the table as a list of standalone TruncatedPacket objects.
+        """
+        return [row.to_truncated_packet() for row in self]
+
+    def copy(self):
+        table = PacketTable({name: column.copy() for name, column in self.columns.items()}, time_base=self.time_base)
+        table.flow_index = self.flow_index  # flow membership is the same, the index can be shared
+        return table
+
+    def flow_mask(self, flow_id, direction=0):
+        """
+        Boolean mask of packets belonging to flow_id (and direction, unless direction is 0).
+        """
+        mask = self.columns["flow_id"] == _to_column("flow_id", flow_id)
+        if direction != 0:
+            mask &= self.columns["direction"] == direction
+        return mask
+
+    def flow_rows(self, flow_id, direction=0):
+        """
+        Row positions (in capture order) of packets belonging to flow_id and direction. Uses the flow index
+        when one is attached, which costs O(packets in flow) instead of a scan of the whole table.
+        """
+        if self.flow_index is not None:
+            return self.flow_index.positions(flow_id, direction)
+        return np.flatnonzero(self.flow_mask(flow_id, direction))
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get("columns")
+        if columns is not None and name in columns:
+            return columns[name]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __len__(self):
+        return len(self.columns["packet_id"])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield PacketRow(self, index)
+
+    def __getitem__(self, key):
+        """
+        Integer keys return a PacketRow view, slices and index/boolean arrays return a PacketTable
+        over the selected rows (with NumPy semantics - slices share memory with this table).
+        """
+        if isinstance(key, (int, np.integer)):
+            length = len(self)
+            if key < 0:
+                key += length
+            if not 0 <= key < length:
+                raise IndexError("PacketTable index out of range")
+            return PacketRow(self, int(key))
+        return PacketTable({name: column[key] for name, column in self.columns.items()}, time_base=self.time_base)
+
+    def __repr__(self):
+        return f"PacketTable(packets={len(self)}, nbytes={self.nbytes})"
+
+
+def packet_flow_key(entity):
+    """
+    flow_keys of a single scapy packet, or None for packets without TCP/UDP over IPv4.
+    """
+    if IP not in entity:
+        return None
+    layer = TCP if entity.haslayer(TCP) else UDP if entity.haslayer(UDP) else None
+    if layer is None:
+        return None
+    hi, lo = flow_keys([ip_to_int(entity[IP].src)], [ip_to_int(entity[IP].dst)], [int(entity[layer].sport)],
+                       [int(entity[layer].dport)], [int(entity[IP].proto)])
+    return int(hi[0]), int(lo[0])
+
+
 def generate_pseudo_hash(entity):
-    elements = []
-
-    if entity.haslayer(TCP):
-        elements = [
-            hash(entity[IP].src),
-            hash(entity[IP].dst),
-            int(entity[TCP].sport), #TODO: PRZYWROCIC
-            int(entity[TCP].dport),
-            int(entity[IP].proto),
-        ]
-    elif entity.haslayer(UDP):
-        elements = [
-            hash(entity[IP].src),
-            hash(entity[IP].dst),
-            int(entity[UDP].sport),
-            int(entity[UDP].dport),
-            int(entity[IP].proto),
-        ]
-
-    return int(sum(elements)) if elements else None  # Returns the sum of 'elements' or None if the list is empty
-
-
-def create_truncated_packets_from_pcap(file_path):
-    truncated_packets = []
-    cap = rdpcap(file_path)
-
-    for packet_number, scapy_packet in enumerate(cap, start=1):
-        if IP in scapy_packet and (
-            scapy_packet.haslayer(TCP) or scapy_packet.haslayer(UDP)
-        ):
-            pseudo_hash = generate_pseudo_hash(scapy_packet)
-
-            tcp, udp, fin, syn, rst, ack, psh, urg = (
-                0,
-            ) * 8  # Initialize all flags to 0
-
-            if scapy_packet.haslayer(TCP):
-                tcp = 1
-                flags = scapy_packet[TCP].flags
-                fin = int(bool(flags & 0x01))
-                syn = int(bool(flags & 0x02))
-                rst = int(bool(flags & 0x04))
-                ack = int(bool(flags & 0x10))
-                psh = int(bool(flags & 0x08))
-                urg = int(bool(flags & 0x20))
-
-            udp = int(scapy_packet.haslayer(UDP))
-
-            truncated_packet = TruncatedPacket(
-                packet_id=packet_number,  # According to schema
-                timestamp=scapy_packet.time,  # Timestamp will need to have margin of error
-                size=len(scapy_packet),
-                pseudo_hash=pseudo_hash,
-                flow_id=None,  # Later assignment
-                direction=0,  # 0 - not yet analyzed, 1 - fwd, 2 - bwd
-                src_ip=scapy_packet[IP].src,
-                fragmented=0, # 0 for non-fragmented, 1 - for signle fragmentation (MTU = size/2), 2 - for double fragmentation (MTU = size/4)
-                tcp=tcp,
-                udp=udp,
-                fin=fin,
-                syn=syn,
-                rst=rst,
-                ack=ack,
-                psh=psh,
-                urg=urg,
-            )
-            truncated_packets.append(truncated_packet)
-            
-
-    return truncated_packets
+    """
+    Stable pseudo_hash (flow_key_digests of the packet's flow key), None for packets without TCP/UDP.
+    """
+    key = packet_flow_key(entity)
+    if key is None:
+        return None
+    return int(flow_key_digests(*key)[0])
+
+
+CHUNK_SIZE = 100000  # packets per PacketTable chunk when streaming a capture
+
+
+def truncated_packet_fields(scapy_packet, packet_number, time_base=0):
+    """
+    Extracts the PacketTable row of a single scapy packet, or returns None for packets without TCP/UDP over IP.
+    """
+    if IP in scapy_packet and (
+        scapy_packet.haslayer(TCP) or scapy_packet.haslayer(UDP)
+    ):
+        flow_key_hi, flow_key_lo = packet_flow_key(scapy_packet)
+
+        tcp, udp, fin, syn, rst, ack, psh, urg = (
+            0,
+        ) * 8  # Initialize all flags to 0
+
+        if scapy_packet.haslayer(TCP):
+            tcp = 1
+            flags = scapy_packet[TCP].flags
+            fin = int(bool(flags & 0x01))
+            syn = int(bool(flags & 0x02))
+            rst = int(bool(flags & 0x04))
+            ack = int(bool(flags & 0x10))
+            psh = int(bool(flags & 0x08))
+            urg = int(bool(flags & 0x20))
+
+        udp = int(scapy_packet.haslayer(UDP))
+
+        return {
+            "packet_id": packet_number,  # According to schema
+            "timestamp": float(scapy_packet.time - time_base),  # Timestamp will need to have margin of error
+            "size": len(scapy_packet),
+            "pseudo_hash": int(flow_key_digests(flow_key_hi, flow_key_lo)[0]),
+            "flow_id": NO_FLOW,  # Later assignment
+            "direction": 0,  # 0 - not yet analyzed, 1 - fwd, 2 - bwd
+            "src_ip": ip_to_int(scapy_packet[IP].src),
+            "fragmented": 0, # 0 for non-fragmented, 1 - for signle fragmentation (MTU = size/2), 2 - for double fragmentation (MTU = size/4)
+            "tcp": tcp,
+            "udp": udp,
+            "fin": fin,
+            "syn": syn,
+            "rst": rst,
+            "ack": ack,
+            "psh": psh,
+            "urg": urg,
+            "flow_key_hi": flow_key_hi,
+            "flow_key_lo": flow_key_lo,
+        }
+    return None
+
+
+def _scapy_packet_chunks(file_path, chunk_size):
+    columns = {name: [] for name in PACKET_TABLE_COLUMNS}
+    time_base = None
+
+    with PcapReader(file_path) as reader:
+        for packet_number, scapy_packet in enumerate(reader, start=1):
+            if time_base is None:
+                time_base = int(scapy_packet.time)
+
+            row = truncated_packet_fields(scapy_packet, packet_number, time_base)
+            if row is None:
+                continue
+            for name, value in row.items():
+                columns[name].append(value)
+
+            if len(columns["packet_id"]) >= chunk_size:
+                yield PacketTable(columns, time_base=time_base)
+                columns = {name: [] for name in PACKET_TABLE_COLUMNS}
+
+    if columns["packet_id"]:
+        yield PacketTable(columns, time_base=time_base)
+
+
+def _dissect_record(pcap, batch, index):
+    """
+    Dissects a single capture record with scapy, the same way PcapReader would.
+    """
+    data = pcap.read(int(batch.data_offset[index]), int(batch.caplen[index]))
+    layer = conf.l2types.num2layer.get(int(batch.linktype[index]), conf.raw_layer)
+    try:
+        return layer(data)
+    except Exception:
+        return conf.raw_layer(data)
+
+
+def raw_packet_table(pcap, batch, time_base):
+    """
+    Builds the PacketTable rows of a RecordBatch from raw header bytes (see pcap_parser.parse_record_headers).
+    Only records with unusual encapsulations are dissected by scapy.
+    """
+    headers = parse_record_headers(pcap.buffer, batch)
+    parsed = headers["status"] == PARSED
+    proto = headers["proto"][parsed]
+    tcp_flags = headers["tcp_flags"][parsed]
+    ticks = batch.ticks - time_base * batch.resolution
+    timestamps = ticks / batch.resolution  # exact ticks divided once, like scapy's Decimal timestamps
+
+    flow_key_hi, flow_key_lo = flow_keys(headers["src_ip"][parsed], headers["dst_ip"][parsed],
+                                         headers["sport"][parsed], headers["dport"][parsed], proto)
+    columns = {
+        "packet_id": batch.number[parsed],
+        "timestamp": timestamps[parsed],
+        "size": batch.caplen[parsed],
+        "pseudo_hash": flow_key_digests(flow_key_hi, flow_key_lo),
+        "flow_id": np.full(len(proto), NO_FLOW),
+        "direction": np.zeros(len(proto)),
+        "src_ip": headers["src_ip"][parsed],
+        "fragmented": np.zeros(len(proto)),
+        "tcp": proto == PROTO_TCP,
+        "udp": proto == PROTO_UDP,
+        "fin": (tcp_flags & 0x01) != 0,
+        "syn": (tcp_flags & 0x02) != 0,
+        "rst": (tcp_flags & 0x04) != 0,
+        "ack": (tcp_flags & 0x10) != 0,
+        "psh": (tcp_flags & 0x08) != 0,
+        "urg": (tcp_flags & 0x20) != 0,
+        "flow_key_hi": flow_key_hi,
+        "flow_key_lo": flow_key_lo,
+    }
+    table = PacketTable(columns, time_base=time_base)
+
+    fallback_rows = []
+    for index in np.flatnonzero(headers["status"] == NEEDS_SCAPY):
+        row = truncated_packet_fields(_dissect_record(pcap, batch, index), int(batch.number[index]), time_base)
+        if row is not None:
+            row["timestamp"] = timestamps[index]
+            fallback_rows.append(row)
+    if fallback_rows:
+        fallback = PacketTable({name: [row[name] for row in fallback_rows] for name in PACKET_TABLE_COLUMNS},
+                               time_base=time_base)
+        table = PacketTable.concatenate([table, fallback])
+        table = table[np.argsort(table.packet_id, kind="stable")]
+    return table
+
+
+def _raw_packet_chunks(file_path, chunk_size):
+    with PcapFile(file_path) as pcap:
+        time_base = None
+        for batch in pcap.iter_record_batches(chunk_size):
+            if time_base is None:
+                time_base = int(batch.ticks[0] // batch.resolution[0])
+            table = raw_packet_table(pcap, batch, time_base)
+            if len(table):
+                yield table
+
+
+def iter_truncated_packet_chunks(file_path, chunk_size=CHUNK_SIZE, parser="raw"):
+    """
+    Streams a pcap/pcapng file and yields its TCP/UDP over IP packets as PacketTable chunks of at most
+    chunk_size rows. Only one chunk is held in memory at a time, no matter how large the capture is.
+    All chunks share the time_base of the first packet, so they can be concatenated directly.
+
+    Parameters:
+    - file_path: Path to the pcap or pcapng file.
+    - chunk_size: Maximum number of packets per yielded PacketTable.
+    - parser: 'raw' decodes Ethernet/IPv4/TCP/UDP headers straight from the memory-mapped file (scapy only
+      for unusual encapsulations), 'scapy' dissects every packet with scapy's PcapReader.
+    """
+    if parser == "raw":
+        return _raw_packet_chunks(file_path, chunk_size)
+    elif parser == "scapy":
+        return _scapy_packet_chunks(file_path, chunk_size)
+    raise ValueError(f"Unsupported parser: {parser}")
+
+
+def _parse_shard(task):
+    # Pool entry point - parses one Shard of a capture with the capture-wide time_base
+    file_path, shard, time_base, chunk_size = task
+    with PcapFile(file_path) as pcap:
+        return PacketTable.concatenate(
+            [raw_packet_table(pcap, batch, time_base) for batch in pcap.iter_record_batches(chunk_size, shard)]
+        )
+
+
+def read_pcap_shards(file_path, shards, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Parses a pcap/pcapng file in parallel: the capture is split into `shards` byte ranges aligned on record
+    boundaries (see PcapFile.shards), every shard is parsed with the raw parser in a process pool and the
+    tables are merged in file order. packet_id is the record number in the whole capture and all shards use
+    the time_base of the first record, so the result equals create_truncated_packets_from_pcap(file_path).
+
+    Parameters:
+    - file_path: Path to the pcap or pcapng file.
+    - shards: Number of byte ranges to split the capture into.
+    - processes: Pool size (min(shards, os.cpu_count()) by default); 1 parses the shards in this process.
+    - chunk_size: Records per parsed batch inside a shard.
+    """
+    with PcapFile(file_path) as pcap:
+        pcap_shards = pcap.shards(shards)
+        if not pcap_shards:
+            return PacketTable()
+        first = next(pcap.iter_record_batches(1, pcap_shards[0]))
+        time_base = int(first.ticks[0] // first.resolution[0])
+
+    tasks = [(file_path, shard, time_base, chunk_size) for shard in pcap_shards]
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    if processes == 1:
+        return PacketTable.concatenate(map(_parse_shard, tasks))
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    with context.Pool(processes) as pool:
+        return PacketTable.concatenate(pool.map(_parse_shard, tasks, chunksize=1))
+
+
+def create_truncated_packets_from_pcap(file_path, chunk_size=CHUNK_SIZE, parser="raw", shards=None, processes=None):
+    """
+    Reads a pcap/pcapng file and returns its TCP/UDP over IP packets as a PacketTable.
+    The capture is streamed chunk by chunk (see iter_truncated_packet_chunks) instead of being loaded
+    with rdpcap, so peak memory stays close to the size of the resulting table.
+
+    With shards the capture is parsed in parallel by read_pcap_shards (raw parser only). The merged table
+    is identical to a serial read, so assign_flow_ids_to_packets assembles flows crossing shard boundaries
+    by the same expiration rules.
+    """
+    if shards is not None:
+        if parser != "raw":
+            raise ValueError(f"Sharded reading needs the raw parser, got: {parser}")
+        return read_pcap_shards(file_path, shards, processes, chunk_size)
+    return PacketTable.concatenate(iter_truncated_packet_chunks(file_path, chunk_size, parser))
+
 
 def count_directions(truncated_packets, flow_id):
+    if isinstance(truncated_packets, PacketTable):
+        directions = truncated_packets.direction[truncated_packets.flow_rows(flow_id)]
+        return {"1": int(np.sum(directions == 1)), "2": int(np.sum(directions == 2))}
     direction_counts = {"1": 0, "2": 0}
     for packet in truncated_packets:
         if packet.flow_id == flow_id:
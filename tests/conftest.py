@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The registry reads the models folder on import, notebooks use ../models relative to notebooks/
+os.environ.setdefault("MODELS_ROOT", os.path.join(ROOT, "models"))
+
+TESTING_SMALL = os.path.join(ROOT, "data", "raw", "testing_small.pcapng")
+RBOT = os.path.join(ROOT, "data", "raw", "filtered", "botnet-capture-20110812-rbot.pcap")
+RBOT_SCENARIO = "botnet-capture-20110812-rbot"
+RBOT_MEDIAN_FLOW = 858
+
+
+@pytest.fixture(scope="session")
+def rbot_packets():
+    from src.utils.flow import assign_flow_ids_to_packets
+    from src.utils.truncated_packet import create_truncated_packets_from_pcap
+
+    return assign_flow_ids_to_packets(create_truncated_packets_from_pcap(RBOT))
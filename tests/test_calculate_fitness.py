@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from src.operations.calculate_fitness import (
+    predict_flows_batch,
+    predict_single_flow,
+    predict_single_flow_target,
+    prepare_size_stats,
+    prepare_timing_stats,
+)
+from src.operations.genetic_optimization import FlowOptimizer
+from src.utils.flow_features import (
+    SIZE_FEATURE_COLUMNS,
+    TIMING_FEATURE_COLUMNS,
+    extract_flow_features,
+    feature_dict,
+)
+
+from conftest import RBOT_MEDIAN_FLOW, RBOT_SCENARIO
+
+
+def single_flow_scores(rows, predict):
+    # One model call per flow, the path predict_flows_batch replaced
+    return [predict(RBOT_SCENARIO, feature_dict(row, SIZE_FEATURE_COLUMNS), feature_dict(row, TIMING_FEATURE_COLUMNS))
+            for row in rows]
+
+
+@pytest.mark.parametrize("kind, predict", [
+    ("RF", predict_single_flow),
+    ("target", predict_single_flow_target),
+])
+def test_batch_prediction_matches_single_flows(rbot_packets, kind, predict):
+    flow_ids = np.unique(rbot_packets.flow_id)[1:40:3]
+    rows = np.empty((len(flow_ids), len(SIZE_FEATURE_COLUMNS) + len(TIMING_FEATURE_COLUMNS)))
+    for row, flow_id in zip(rows, flow_ids):
+        extract_flow_features(rbot_packets, int(flow_id), out=row)
+        assert feature_dict(row, SIZE_FEATURE_COLUMNS) == prepare_size_stats(rbot_packets, int(flow_id))
+
+    np.testing.assert_allclose(predict_flows_batch(RBOT_SCENARIO, rows, kind), single_flow_scores(rows, predict),
+                               rtol=1e-12)
+    assert predict_flows_batch(RBOT_SCENARIO, rows[0], kind).shape == (1,)
+
+
+def test_solution_fitnesses_match_per_variant_predictions(rbot_packets):
+    optimizer = FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0])
+    solution = np.array([2.0, 1.5, 2.0, 1.0, 0, 1])
+    operations, fitnesses = optimizer.solution_fitnesses(solution)
+
+    engine = optimizer.engine
+    rows = [engine.features()] + [engine.features(engine.apply(operation)) for operation in operations]
+    expected = [1.0 - score for score in single_flow_scores(rows, predict_single_flow)]
+    assert len(fitnesses) == len(operations) + 1
+    np.testing.assert_allclose(fitnesses, expected, rtol=1e-12)
+    assert prepare_timing_stats(rbot_packets, RBOT_MEDIAN_FLOW) == feature_dict(rows[0], TIMING_FEATURE_COLUMNS)
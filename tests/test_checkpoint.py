@@ -0,0 +1,113 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+import src.operations.genetic_optimization as genetic_optimization
+from src.operations.checkpoint import CheckpointStore
+from src.operations.genetic_optimization import FlowOptimizer
+
+from conftest import RBOT_MEDIAN_FLOW, RBOT_SCENARIO
+
+
+def tear_last_record(path, missing=5):
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - missing)
+
+
+def test_truncated_tail_is_dropped(tmp_path, capsys):
+    path = str(tmp_path / "campaign.ckpt")
+    store = CheckpointStore(path, sync=False)
+    store.append("generation", ("rbot", 1), generations_completed=1)
+    store.append("generation", ("rbot", 1), generations_completed=2)
+    complete_size = os.path.getsize(path)
+    store.append("generation", ("rbot", 1), generations_completed=3)
+    tear_last_record(path)
+
+    resumed = CheckpointStore(path)
+    assert resumed.latest("generation", ("rbot", 1))["generations_completed"] == 2
+    assert os.path.getsize(path) == complete_size
+    assert "incomplete record" in capsys.readouterr().out
+
+    resumed.append("flow", ("rbot", 1), max_fitness=0.5)
+    reopened = CheckpointStore(path)
+    assert reopened.latest("flow", ("rbot", 1))["max_fitness"] == 0.5
+    assert reopened.latest("generation", ("rbot", 1))["generations_completed"] == 2
+
+
+def test_corrupted_record_ends_the_log(tmp_path):
+    path = str(tmp_path / "campaign.ckpt")
+    store = CheckpointStore(path)
+    store.append("round", ("rbot", 1, 0), best=1)
+    store.append("round", ("rbot", 1, 1), best=2)
+    with open(path, "rb") as file:
+        data = bytearray(file.read())
+    data[-1] ^= 0xFF  # flips the crc32 check of the last record
+    with open(path, "wb") as file:
+        file.write(data)
+    assert [record["best"] for record in CheckpointStore(path).records("round")] == [1]
+
+
+def optimize(packets, generations, monkeypatch, checkpoint=None):
+    monkeypatch.setattr(genetic_optimization, "NUM_GENERATIONS", generations)
+    optimizer = FlowOptimizer(packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0], checkpoint=checkpoint,
+                              fitness_cache=None)
+    optimizer.optimize_for_flow()
+    return optimizer
+
+
+def test_resume_after_torn_tail_matches_uninterrupted_run(rbot_packets, tmp_path, monkeypatch):
+    np.random.seed(0)
+    random.seed(0)
+    uninterrupted = optimize(rbot_packets, 3, monkeypatch)
+
+    path = str(tmp_path / "campaign.ckpt")
+    np.random.seed(0)
+    random.seed(0)
+    optimize(rbot_packets, 2, monkeypatch, CheckpointStore(path))
+    tear_last_record(path)  # the crash hit the final on_stop record
+    np.random.seed(1)
+    random.seed(1)
+    resumed = optimize(rbot_packets, 3, monkeypatch, CheckpointStore(path))
+
+    assert resumed.max_fitness[0] == uninterrupted.max_fitness[0]
+    assert resumed.max_fitness_history == uninterrupted.max_fitness_history
+    np.testing.assert_array_equal(resumed.ga_instance.population, uninterrupted.ga_instance.population)
+
+
+@pytest.mark.parametrize("torn", [False, True])
+def test_resume_of_completed_run_restores_the_ga(rbot_packets, tmp_path, monkeypatch, torn):
+    path = str(tmp_path / "campaign.ckpt")
+    np.random.seed(0)
+    random.seed(0)
+    completed = optimize(rbot_packets, 2, monkeypatch, CheckpointStore(path))
+    if torn:
+        tear_last_record(path)  # falls back to the last on_generation record
+
+    resumed = optimize(rbot_packets, 2, monkeypatch, CheckpointStore(path))
+    assert resumed.ga_instance is not None and resumed.ga_instance.generations_completed == 2
+    np.testing.assert_array_equal(resumed.ga_instance.population, completed.ga_instance.population)
+    assert resumed.ga_instance.best_solutions_fitness == list(completed.ga_instance.best_solutions_fitness)
+    assert resumed.max_fitness[0] == completed.max_fitness[0]
+
+    expected_packets, expected_fitness = completed.apply_best_solution()
+    packets, fitness = resumed.apply_best_solution()
+    assert fitness == expected_fitness
+    np.testing.assert_array_equal(packets.size, expected_packets.size)
+    np.testing.assert_array_equal(packets.timestamp, expected_packets.timestamp)
+
+
+def test_resumed_run_continues_best_fitness_history(rbot_packets, tmp_path, monkeypatch):
+    np.random.seed(0)
+    random.seed(0)
+    uninterrupted = optimize(rbot_packets, 3, monkeypatch)
+
+    path = str(tmp_path / "campaign.ckpt")
+    np.random.seed(0)
+    random.seed(0)
+    optimize(rbot_packets, 2, monkeypatch, CheckpointStore(path))
+    resumed = optimize(rbot_packets, 3, monkeypatch, CheckpointStore(path))
+    assert CheckpointStore(path).latest("generation", (RBOT_SCENARIO, RBOT_MEDIAN_FLOW))["best_solutions_fitness"] == \
+        list(uninterrupted.ga_instance.best_solutions_fitness)
+    assert resumed.max_fitness[0] == uninterrupted.max_fitness[0]
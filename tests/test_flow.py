@@ -0,0 +1,94 @@
+import copy
+import os
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from src.utils.flow import TCP_EXPIRATION, UDP_EXPIRATION, assign_flow_ids_to_packets
+from src.utils.truncated_packet import create_truncated_packets_from_pcap
+
+from conftest import RBOT, ROOT, TESTING_SMALL
+
+NERIS = os.path.join(ROOT, "data", "raw", "filtered", "botnet-capture-20110811-neris.pcap")
+
+
+def assign_flow_ids_one_by_one(truncated_packets):
+    # The per-packet loop assign_flow_ids replaced, grouping on pseudo_hash (a digest of the flow key)
+    packets_by_hash = defaultdict(list)
+    for packet in truncated_packets:
+        if packet.pseudo_hash is not None:
+            packets_by_hash[packet.pseudo_hash].append(packet)
+
+    global_flow_id = 0
+    fin_count = defaultdict(int)
+    for hash_group in packets_by_hash.values():
+        hash_group.sort(key=lambda pkt: pkt.timestamp)
+        new_flow_needed = False
+        last_fin_timestamp = None
+        for i, packet in enumerate(hash_group):
+            if i == 0:
+                global_flow_id += 1
+                first_packet_src_ip = packet.src_ip
+                fin_count[global_flow_id] = 0
+            time_since_last_packet = packet.timestamp - hash_group[i - 1].timestamp if i > 0 else 0
+            if time_since_last_packet >= (TCP_EXPIRATION if packet.tcp else UDP_EXPIRATION):
+                new_flow_needed = True
+            if last_fin_timestamp is not None:
+                if packet.timestamp - last_fin_timestamp >= 5.0 and packet.fin == 0:
+                    new_flow_needed = True
+                    last_fin_timestamp = None
+            if new_flow_needed:
+                global_flow_id += 1
+                first_packet_src_ip = packet.src_ip
+                fin_count[global_flow_id] = 0
+                new_flow_needed = False
+                packet.flow_id = global_flow_id
+                packet.direction = 1 if packet.src_ip == first_packet_src_ip else 2
+                continue
+            if packet.fin:
+                fin_count[global_flow_id] += 1
+                last_fin_timestamp = packet.timestamp
+                if fin_count[global_flow_id] >= 3:
+                    new_flow_needed = True
+                    last_fin_timestamp = None
+            packet.flow_id = global_flow_id
+            packet.direction = 1 if packet.src_ip == first_packet_src_ip else 2
+    return truncated_packets
+
+
+def flows_of(packets):
+    # Partition of packets into flows and their directions, independent of the flow numbering
+    flows = {}
+    for packet in packets:
+        if packet.flow_id:
+            flows.setdefault(packet.flow_id, []).append((packet.packet_id, packet.direction))
+    return sorted(sorted(flow) for flow in flows.values())
+
+
+@pytest.mark.parametrize("pcap_file", [TESTING_SMALL, RBOT, NERIS])
+def test_vectorized_matches_one_by_one_loop(pcap_file):
+    table = create_truncated_packets_from_pcap(pcap_file)
+    expected = assign_flow_ids_one_by_one(table.to_packets())
+    packets = assign_flow_ids_to_packets(table.to_packets())
+    assign_flow_ids_to_packets(table)
+
+    expected_flow_ids = np.array([packet.flow_id for packet in expected])
+    expected_directions = np.array([packet.direction for packet in expected])
+    np.testing.assert_array_equal(table.flow_id, expected_flow_ids)
+    np.testing.assert_array_equal(table.direction, expected_directions)
+    np.testing.assert_array_equal([packet.flow_id for packet in packets], expected_flow_ids)
+    np.testing.assert_array_equal([packet.direction for packet in packets], expected_directions)
+    assert np.array_equal(table.flow_index.positions(int(table.flow_id.max())),
+                          np.flatnonzero(table.flow_id == table.flow_id.max()))
+
+
+def test_packets_without_flow_keys_fall_back_to_pseudo_hash():
+    packets = create_truncated_packets_from_pcap(TESTING_SMALL).to_packets()
+    legacy = copy.deepcopy(packets)
+    for packet in legacy:
+        # Like TruncatedPacket objects pickled before flow keys existed
+        del packet.flow_key_hi, packet.flow_key_lo
+    assign_flow_ids_to_packets(packets)
+    assign_flow_ids_to_packets(legacy)
+    assert flows_of(legacy) == flows_of(packets)
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from src.operations.perturbation_engine import PerturbationEngine
+from src.utils.flow import assign_flow_ids_to_packets
+from src.utils.flow_calculations import (
+    calculate_delta_time_statistics,
+    calculate_size_statistics,
+    total_flow_size,
+    total_packet_count,
+)
+from src.utils.flow_features import FEATURE_COLUMNS, extract_all_flow_features, extract_flow_features
+from src.utils.truncated_packet import create_truncated_packets_from_pcap
+
+from conftest import RBOT, TESTING_SMALL
+
+
+def per_statistic_features(truncated_packets, flow_id):
+    # The model row as prepare_size_stats / prepare_timing_stats assembled it, one statistic call at a time
+    sizes = [calculate_size_statistics(flow_id, truncated_packets, direction) for direction in (0, 1, 2)]
+    iats = [calculate_delta_time_statistics(flow_id, truncated_packets, direction) for direction in (0, 1, 2)]
+    features = {
+        "tot_fwd_pkts": total_packet_count(flow_id, truncated_packets, 1),
+        "tot_bwd_pkts": total_packet_count(flow_id, truncated_packets, 2),
+        "totlen_fwd_pkts": total_flow_size(flow_id, truncated_packets, 1),
+        "totlen_bwd_pkts": total_flow_size(flow_id, truncated_packets, 2),
+        "pkt_len_mean": sizes[0]["mean"],
+        "pkt_len_std": sizes[0]["std"],
+        "flow_iat_mean": iats[0]["mean"],
+        "flow_iat_max": iats[0]["max"],
+        "flow_iat_min": iats[0]["min"],
+        "flow_iat_std": iats[0]["std"],
+        "fwd_iat_tot": 0.0,
+        "bwd_iat_tot": 0.0,
+    }
+    for prefix, stats in (("fwd", sizes[1]), ("bwd", sizes[2])):
+        features.update({f"{prefix}_pkt_len_{name}": stats[name] for name in ("max", "min", "mean", "std")})
+    for prefix, stats in (("fwd", iats[1]), ("bwd", iats[2])):
+        features.update({f"{prefix}_iat_{name}": stats[name] for name in ("max", "min", "mean", "std")})
+    return np.array([features[column] for column in FEATURE_COLUMNS], dtype=np.float64)
+
+
+@pytest.fixture(scope="module", params=[TESTING_SMALL, RBOT])
+def table(request):
+    return assign_flow_ids_to_packets(create_truncated_packets_from_pcap(request.param))
+
+
+def sample_flows(table, count=25):
+    flow_ids = np.unique(table.flow_id[table.flow_id != 0])
+    return flow_ids[np.linspace(0, len(flow_ids) - 1, min(count, len(flow_ids))).astype(int)].tolist()
+
+
+def test_fused_features_match_per_statistic(table):
+    packets = table.to_packets()
+    grouped = extract_all_flow_features(table)
+    for flow_id in sample_flows(table):
+        expected = per_statistic_features(table, flow_id)
+        # Objects hold absolute epoch timestamps, whose float64 resolution is a fraction of a microsecond
+        np.testing.assert_allclose(per_statistic_features(packets, flow_id), expected, rtol=1e-9, atol=1.0)
+        np.testing.assert_allclose(extract_flow_features(table, flow_id), expected, rtol=1e-9, atol=1e-6)
+        np.testing.assert_allclose(grouped.loc[flow_id].to_numpy(np.float64), expected, rtol=1e-9, atol=1e-6)
+        np.testing.assert_allclose(PerturbationEngine(table, flow_id).features(), expected, rtol=1e-9, atol=1e-6)
+
+
+def test_perturbed_overlay_features_match_materialized(table):
+    flow_id = sample_flows(table)[-1]
+    engine = PerturbationEngine(table, flow_id)
+    operations = [
+        {'scaling_factor': 2.0, 'direction': 0, 'focus_point': 'middle', 'op_type': 'size_norm'},
+        {'scaling_factor': 0.5, 'direction': 1, 'focus_point': 'start', 'op_type': 'size_uni'},
+        {'scaling_factor': 1.5, 'direction': 0, 'focus_point': 'end', 'op_type': 'time_norm'},
+    ]
+    np.random.seed(0)
+    overlay = engine.apply_all(operations)
+    materialized = engine.materialize(overlay, table.copy())
+    np.testing.assert_allclose(engine.features(overlay), per_statistic_features(materialized, flow_id),
+                               rtol=1e-9, atol=1e-6)
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from src.utils.flow import assign_flow_ids_to_packets
+from src.utils.flow_features import extract_all_flow_features
+from src.utils.flow_tracker import MAX_EXPIRATION, FlowTracker, stream_flows_from_pcap
+from src.utils.truncated_packet import PACKET_TABLE_COLUMNS, PacketTable, create_truncated_packets_from_pcap
+
+from conftest import RBOT, TESTING_SMALL
+from test_flow import NERIS
+
+
+def synthetic_table(packets, time_base=1000):
+    # packets: (timestamp, flow_key_lo, src_ip, fin) rows of TCP packets with flow_key_hi 1
+    columns = {name: np.zeros(len(packets), dtype=dtype) for name, dtype in PACKET_TABLE_COLUMNS.items()}
+    for i, (timestamp, key, src_ip, fin) in enumerate(packets):
+        columns["packet_id"][i] = i + 1
+        columns["timestamp"][i] = timestamp
+        columns["size"][i] = 60
+        columns["src_ip"][i] = src_ip
+        columns["tcp"][i] = 1
+        columns["fin"][i] = fin
+        columns["flow_key_hi"][i] = 1
+        columns["flow_key_lo"][i] = key
+    return PacketTable(columns, time_base=time_base)
+
+
+def flow_partition(packet_ids, flow_ids, directions):
+    flows = {}
+    for packet_id, flow_id, direction in zip(packet_ids, flow_ids, directions):
+        if flow_id:
+            flows.setdefault(flow_id, []).append((packet_id, direction))
+    return sorted(sorted(flow) for flow in flows.values())
+
+
+@pytest.mark.parametrize("pcap_file", [TESTING_SMALL, RBOT, NERIS])
+def test_streamed_flows_match_batch_assignment(pcap_file):
+    table = assign_flow_ids_to_packets(create_truncated_packets_from_pcap(pcap_file))
+    batch_features = extract_all_flow_features(table)
+    flows = list(stream_flows_from_pcap(pcap_file, chunk_size=500))
+
+    streamed = [(packet_id, flow.flow_id, direction) for flow in flows
+                for packet_id, direction in zip(flow.packets.packet_id.tolist(), flow.packets.direction.tolist())]
+    assert flow_partition(*zip(*streamed)) == flow_partition(table.packet_id, table.flow_id, table.direction)
+
+    # Features of every streamed flow equal the grouped features of the batch flow holding the same packets
+    batch_flow_of = dict(zip(table.packet_id.tolist(), table.flow_id.tolist()))
+    for flow in flows:
+        batch_flow_id = batch_flow_of[int(flow.packets.packet_id[0])]
+        np.testing.assert_allclose(flow.features, batch_features.loc[batch_flow_id].to_numpy(np.float64),
+                                   rtol=1e-9, atol=1e-6)
+
+
+def test_idle_flows_are_evicted_before_the_stream_ends():
+    tracker = FlowTracker(reorder_window=0.0)
+    completed = tracker.add_table(synthetic_table([
+        (0.0, 10, 1, 0), (1.0, 10, 2, 0),  # flow of key 10 goes idle
+        (2.0, 20, 1, 0), (MAX_EXPIRATION + 1.5, 30, 1, 0),
+    ]))
+    # Key 10 is evicted as soon as the stream passes its expiry, key 20 is still within it
+    assert [(flow.flow_key[1], len(flow.packets)) for flow in completed] == [(10, 2)]
+    assert completed[0].packets.direction.tolist() == [1, 2]
+    assert list(tracker.active) == [(1, 20), (1, 30)]
+    assert [flow.flow_key[1] for flow in tracker.flush()] == [20, 30]
+    assert tracker.emitted == 3 and tracker.max_active == 2 and not tracker.active
+
+
+def test_third_fin_closes_the_flow_immediately():
+    tracker = FlowTracker(reorder_window=0.0, with_features=False)
+    completed = tracker.add_table(synthetic_table([
+        (0.0, 10, 1, 1), (0.1, 10, 2, 1), (0.2, 10, 1, 1), (0.3, 10, 2, 0),
+    ]))
+    assert [len(flow.packets) for flow in completed] == [3]
+    assert completed[0].features is None
+    assert [flow.flow_id for flow in tracker.flush()] == [2]
+
+
+def test_reorder_window_absorbs_jitter_and_rejects_older_packets():
+    tracker = FlowTracker(reorder_window=1.0)
+    tracker.add_table(synthetic_table([(0.5, 10, 1, 0), (0.0, 10, 2, 0), (3.0, 10, 1, 0)]))
+    flows = tracker.flush()
+    assert flows[0].packets.packet_id.tolist() == [2, 1, 3]
+
+    tracker = FlowTracker(reorder_window=1.0)
+    with pytest.raises(ValueError):
+        tracker.add_table(synthetic_table([(1.0, 10, 1, 0), (5.0, 10, 1, 0), (0.5, 10, 1, 0)]))
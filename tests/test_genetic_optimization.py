@@ -0,0 +1,104 @@
+import random
+
+import numpy as np
+import pytest
+
+import src.operations.genetic_optimization as genetic_optimization
+from src.operations.fitness_cache import FitnessCache
+from src.operations.genetic_optimization import FlowOptimizer
+
+from conftest import RBOT_MEDIAN_FLOW, RBOT_SCENARIO
+
+
+def run_one_generation(packets, monkeypatch, **options):
+    monkeypatch.setattr(genetic_optimization, "NUM_GENERATIONS", 1)
+    np.random.seed(0)
+    random.seed(0)
+    optimizer = FlowOptimizer(packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0], **options)
+    _, max_fitness = optimizer.optimize_for_flow()
+    return max_fitness
+
+
+@pytest.mark.parametrize("fitness_cache", [None, FitnessCache()])
+def test_process_mode_matches_sequential(rbot_packets, monkeypatch, fitness_cache):
+    sequential = run_one_generation(rbot_packets, monkeypatch, fitness_cache=None)
+    parallel = run_one_generation(rbot_packets, monkeypatch, parallel_processing=["process", 2],
+                                  fitness_cache=fitness_cache)
+    assert parallel[0] == sequential[0]
+    assert parallel[2] == sequential[2]
+
+
+def test_fitness_cache_pickles_without_entries():
+    import pickle
+
+    cache = FitnessCache(max_entries=4)
+    cache.put(("model", 1, "state", (1.0,)), (0.5,))
+    cache.get(("model", 1, "state", (1.0,)))
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy) == 0 and copy.max_entries == 4 and copy.stats()["hits"] == 0
+    copy.put(("model", 1, "state", (1.0,)), (0.5,))
+    assert len(cache) == 1
+
+
+def test_pickled_optimizer_leaves_capture_behind(rbot_packets):
+    import pickle
+
+    optimizer = FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0], fitness_cache=None)
+    payload = pickle.dumps(optimizer.fitness_function)
+    assert len(payload) < rbot_packets.size.nbytes
+
+    worker = pickle.loads(payload).__self__
+    assert worker.packets is None and worker.engine.truncated_packets is None
+    solution = np.array([2.0, 1.5, 2.0, 1.0, 0, 1])
+    assert worker.solution_fitnesses(solution) == optimizer.solution_fitnesses(solution)
+
+
+def test_fitness_cache_is_keyed_on_the_fitness_model(rbot_packets):
+    cache = FitnessCache()
+    solution = np.array([2.0, 1.5, 2.0, 1.0, 0, 1])
+    optimizers = {
+        kind: FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0], fitness_cache=cache,
+                            fitness_model_kind=kind)
+        for kind in ("RF", "LR")
+    }
+    assert optimizers["RF"].cache_key(solution) != optimizers["LR"].cache_key(solution)
+    rf_fitnesses = optimizers["RF"].solution_fitnesses(solution)[1]
+    lr_fitnesses = optimizers["LR"].solution_fitnesses(solution)[1]
+    uncached = FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0], fitness_model_kind="LR")
+    assert lr_fitnesses == uncached.solution_fitnesses(solution)[1] != rf_fitnesses
+    assert len(cache) == 2
+    assert FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0]).fitness_cache is None
+
+
+def test_optimizer_reports_cache_stats_without_printing(rbot_packets, monkeypatch, capsys):
+    monkeypatch.setattr(genetic_optimization, "NUM_GENERATIONS", 1)
+    optimizer = FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0], fitness_cache=FitnessCache())
+    optimizer.optimize_for_flow()
+    assert optimizer.fitness_cache_stats["misses"] > 0
+    assert "Fitness cache" not in capsys.readouterr().out
+
+
+def test_batch_fitness_matches_per_solution_fitness(rbot_packets):
+    rng = np.random.default_rng(0)
+    population = np.column_stack([rng.uniform(0.5, 3.0, (12, 4)), rng.integers(0, 2, 12), rng.integers(0, 3, 12)])
+    population[5] = population[2]  # a repeated solution is served from the cache
+
+    sequential = FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0])
+    expected = [sequential.fitness_function(None, solution, i) for i, solution in enumerate(population)]
+    batched = FlowOptimizer(rbot_packets, RBOT_SCENARIO, RBOT_MEDIAN_FLOW, [0, None, 0], fitness_batch_size=5,
+                            fitness_cache=FitnessCache())
+    actual = [fitness for start in range(0, len(population), 5)
+              for fitness in batched.fitness_function_batch(None, population[start:start + 5],
+                                                            list(range(start, start + 5)))]
+    assert actual == expected
+    assert batched.max_fitness == sequential.max_fitness
+    assert batched.fitness_cache.stats()["hits"] == 1
+
+
+def test_batch_mode_run_matches_sequential(rbot_packets, monkeypatch):
+    sequential = run_one_generation(rbot_packets, monkeypatch, fitness_cache=None)
+    batched = run_one_generation(rbot_packets, monkeypatch, fitness_batch_size=2, fitness_cache=None)
+    assert batched[0] == sequential[0]
+    assert batched[2] == sequential[2]
+    assert [operation["scaling_factor"] for operation in batched[1]] == \
+        [operation["scaling_factor"] for operation in sequential[1]]
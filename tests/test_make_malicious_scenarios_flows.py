@@ -0,0 +1,71 @@
+import os
+import subprocess
+
+import pytest
+
+from src.data.make_malicious_scenarios_flows import convert_if_changed, convert_pcap_to_csv, process_directory
+
+
+def failing_converter(stderr):
+    def convert(source_file, dest_file):
+        raise subprocess.CalledProcessError(1, ["cicflowmeter"], stderr=stderr)
+    return convert
+
+
+@pytest.mark.parametrize("stderr, expected", [
+    ("Traceback ...\nValueError: bad capture\n", "ValueError: bad capture"),
+    ("  \n\n", "returned non-zero exit status 1"),
+])
+def test_failed_conversion_reports_error(tmp_path, stderr, expected):
+    source_file = tmp_path / "capture.pcap"
+    source_file.write_bytes(b"\0" * 24)
+    result = convert_if_changed(str(source_file), str(tmp_path / "capture_flow.csv"), convert=failing_converter(stderr),
+                                converter="failing")
+    assert result.status == "failed" and expected in result.error
+
+
+def copy_capture(source_file, dest_file):
+    with open(source_file, "rb") as source, open(dest_file, "wb") as dest:
+        dest.write(source.read())
+
+
+def test_process_directory_skips_unchanged_captures(tmp_path):
+    source_dir, dest_dir = tmp_path / "raw", tmp_path / "interim"
+    source_dir.mkdir()
+    (source_dir / "a.pcap").write_bytes(b"a" * 24)
+    (source_dir / "b.pcapng").write_bytes(b"b" * 24)
+
+    def statuses(converter="copy"):
+        results = process_directory(str(source_dir), str(dest_dir), convert=copy_capture, converter=converter)
+        return [result.status for result in results]
+
+    assert statuses() == ["converted", "converted"]
+    (source_dir / "b.pcapng").write_bytes(b"c" * 24)
+    assert statuses() == ["skipped", "converted"]
+    # csv files of another converter are not reused
+    assert statuses("other") == ["converted", "converted"]
+
+
+def test_custom_converter_needs_a_name(tmp_path):
+    source_file = tmp_path / "capture.pcap"
+    source_file.write_bytes(b"\0" * 24)
+    with pytest.raises(ValueError):
+        convert_if_changed(str(source_file), str(tmp_path / "capture_flow.csv"), convert=lambda s, d: copy_capture(s, d))
+    with pytest.raises(ValueError):
+        process_directory(str(tmp_path), str(tmp_path / "interim"), convert=copy_capture)
+
+
+def test_cicflowmeter_failure_reports_its_stderr(tmp_path, monkeypatch):
+    # Stand-in cicflowmeter executable that fails like a crashing conversion
+    cicflowmeter = tmp_path / "bin" / "cicflowmeter"
+    cicflowmeter.parent.mkdir()
+    cicflowmeter.write_text("#!/bin/sh\necho progress\necho 'Traceback ...' >&2\necho 'OSError: bad capture' >&2\nexit 3\n")
+    cicflowmeter.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{cicflowmeter.parent}{os.pathsep}{os.environ['PATH']}")
+    source_file = tmp_path / "capture.pcap"
+    source_file.write_bytes(b"\0" * 24)
+
+    with pytest.raises(subprocess.SubprocessError, match="status 3(.|\n)*Traceback(.|\n)*OSError: bad capture"):
+        convert_pcap_to_csv(str(source_file), str(tmp_path / "capture_flow.csv"))
+    result = convert_if_changed(str(source_file), str(tmp_path / "capture_flow.csv"))
+    assert result.status == "failed" and "OSError: bad capture" in result.error
@@ -0,0 +1,54 @@
+import os
+import pickle
+
+import pytest
+
+from src.operations.model_registry import MODEL_REGISTRY, ModelRegistry
+
+from conftest import RBOT_SCENARIO
+
+NERIS_SCENARIO = "botnet-capture-20110811-neris"
+
+
+@pytest.fixture
+def registry():
+    return ModelRegistry(models_root=MODEL_REGISTRY.models_root, max_models=2)
+
+
+def test_models_are_loaded_once(registry):
+    model = registry.get("RF", RBOT_SCENARIO)
+    assert registry.get("RF", RBOT_SCENARIO) is model
+    assert registry.loads == 1 and ("RF", RBOT_SCENARIO) in registry
+    assert registry.get("LR", RBOT_SCENARIO) is not model and registry.loads == 2
+    assert type(registry.get("target", RBOT_SCENARIO)).__name__ == "CatBoostRegressor"
+
+
+def test_least_recently_used_model_is_evicted(registry):
+    registry.get("RF", RBOT_SCENARIO)
+    registry.get("RF", NERIS_SCENARIO)
+    registry.get("RF", RBOT_SCENARIO)  # neris becomes the least recently used
+    registry.get("LR", RBOT_SCENARIO)
+    assert list(registry._models) == [("RF", RBOT_SCENARIO), ("LR", RBOT_SCENARIO)]
+
+    registry.configure(max_models=1)
+    assert list(registry._models) == [("LR", RBOT_SCENARIO)]
+    assert registry.evict(kind="RF") == 0 and registry.evict(RBOT_SCENARIO) == 1 and len(registry) == 0
+
+
+def test_changing_a_model_root_evicts_loaded_models(registry, tmp_path):
+    registry.get("RF", RBOT_SCENARIO)
+    registry.configure(fitness_models_root=str(tmp_path))
+    assert len(registry) == 0
+    assert registry.model_path("RF", RBOT_SCENARIO) == os.path.join(str(tmp_path), f"{RBOT_SCENARIO}_RF_model.pkl")
+    with pytest.raises(FileNotFoundError):
+        registry.get("RF", RBOT_SCENARIO)
+    with pytest.raises(ValueError):
+        registry.model_path("SVM", RBOT_SCENARIO)
+
+
+def test_pickled_registry_ships_no_models(registry):
+    registry.get("RF", RBOT_SCENARIO)
+    copy = pickle.loads(pickle.dumps(registry))
+    assert len(copy) == 0 and copy.models_root == registry.models_root and copy.max_models == 2
+    copy.get("RF", RBOT_SCENARIO)
+    assert copy.loads == registry.loads + 1  # loaded again in the copy
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.cic_preprocess import COLUMNS_TO_KEEP
+from src.data.native_flows import PARITY_TOLERANCE, compare_with_cicflowmeter, flow_feature_frame
+from src.utils.flow import assign_flow_ids_to_packets
+from src.utils.flow_features import extract_all_flow_features
+from src.utils.truncated_packet import create_truncated_packets_from_pcap
+
+from conftest import ROOT, TESTING_SMALL
+
+# cicflowmeter 0.1.9 (requirements.txt) exports, regenerate with
+# cicflowmeter -f data/raw/testing_small.pcapng -c tests/data/testing_small_cicflowmeter.csv
+# Without libpcap for the "ip and (tcp or udp)" capture filter, the same filter can be passed to cicflowmeter's
+# FlowSession as a scapy lfilter. The rbot export is cut to FLOW_ID_COLUMNS + COLUMNS_TO_KEEP.
+CIC_REFERENCE = os.path.join(ROOT, "tests", "data", "testing_small_cicflowmeter.csv")
+RBOT_CIC_REFERENCE = os.path.join(ROOT, "tests", "data", "botnet-capture-20110812-rbot_cicflowmeter.csv")
+
+
+@pytest.fixture(scope="module")
+def small_packets():
+    return assign_flow_ids_to_packets(create_truncated_packets_from_pcap(TESTING_SMALL))
+
+
+def assert_columns_within_tolerance(native, cic, columns=COLUMNS_TO_KEEP):
+    native, cic = native[columns].astype(np.float64), cic[columns].astype(np.float64)
+    for column in columns:
+        np.testing.assert_allclose(native[column], cic[column], rtol=PARITY_TOLERANCE, atol=1e-9, err_msg=column)
+
+
+def test_iat_totals_are_mean_times_gaps(small_packets):
+    frame = flow_feature_frame(small_packets)
+    features = extract_all_flow_features(small_packets)
+    for direction in ("fwd", "bwd"):
+        gaps = frame[f"tot_{direction}_pkts"] - 1
+        # cicflowmeter reports no IAT statistics for a single gap
+        expected = np.where(gaps > 1, features[f"{direction}_iat_mean"] * gaps, 0.0)
+        np.testing.assert_allclose(frame[f"{direction}_iat_tot"], expected, rtol=1e-9, atol=1e-3)
+    assert (frame["fwd_iat_tot"] > 0).any()
+    # The model features keep the totals at 0, like the original prepare_timing_stats
+    assert (features[["fwd_iat_tot", "bwd_iat_tot"]] == 0).all().all()
+
+
+def test_parity_with_cicflowmeter():
+    report = compare_with_cicflowmeter(TESTING_SMALL, CIC_REFERENCE)
+    assert report.matched == 9 and report.native_only == report.cic_only == 0
+    assert (report.columns["max_abs_diff"] < 1e-6).all(), report.columns.to_string()
+
+    native = flow_feature_frame(assign_flow_ids_to_packets(create_truncated_packets_from_pcap(TESTING_SMALL)))
+    cic = pd.read_csv(CIC_REFERENCE)
+    native = native.set_index(["src_ip", "src_port", "dst_ip", "dst_port", "protocol"]).sort_index()
+    cic = cic.set_index(["src_ip", "src_port", "dst_ip", "dst_port", "protocol"]).sort_index()
+    assert native.index.equals(cic.index)
+    assert_columns_within_tolerance(native, cic)
+
+
+def test_parity_on_flows_with_same_boundaries(rbot_packets):
+    # The packets of a flow come from assign_flow_ids_to_packets (240s expiry, FIN rules), cicflowmeter cuts
+    # flows by its own timeouts. Flows holding the same packets in both exports must agree on every column.
+    flow_columns = ["src_ip", "src_port", "dst_ip", "dst_port", "protocol", "tot_fwd_pkts", "tot_bwd_pkts",
+                    "totlen_fwd_pkts", "totlen_bwd_pkts"]
+    native = flow_feature_frame(rbot_packets).set_index(flow_columns, drop=False)
+    cic = pd.read_csv(RBOT_CIC_REFERENCE).set_index(flow_columns, drop=False)
+    native = native[~native.index.duplicated(keep=False)]
+    cic = cic[~cic.index.duplicated(keep=False)]
+    matched = native.index.intersection(cic.index)
+    assert len(matched) >= 25
+    assert_columns_within_tolerance(native.loc[matched], cic.loc[matched])
+
+
+def test_main_skips_parity_without_cicflowmeter(tmp_path, monkeypatch, capsys):
+    from src.data import native_flows
+
+    monkeypatch.setattr(native_flows.shutil, "which", lambda name: None)
+    output_path = tmp_path / "flows.csv"
+    native_flows.main([TESTING_SMALL, str(output_path), "--parity"])
+    assert output_path.exists()
+    assert "Skipping the parity check" in capsys.readouterr().out
@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from src.utils import packet_cache
+from src.utils.packet_cache import (
+    CACHE_PREAMBLE,
+    cache_path_for,
+    load_packet_cache,
+    load_truncated_packets,
+    save_packet_cache,
+)
+from src.utils.truncated_packet import PACKET_TABLE_COLUMNS
+
+from conftest import RBOT
+
+
+@pytest.fixture
+def capture(tmp_path):
+    file_path = tmp_path / os.path.basename(RBOT)
+    shutil.copyfile(RBOT, file_path)
+    return str(file_path)
+
+
+def assert_same_table(table, expected):
+    assert len(table) == len(expected)
+    assert table.time_base == expected.time_base
+    for name in PACKET_TABLE_COLUMNS:
+        np.testing.assert_array_equal(table.columns[name], expected.columns[name])
+
+
+def test_miss_writes_the_cache_and_hit_maps_the_same_columns(capture, rbot_packets):
+    assert load_packet_cache(capture) is None
+    table = load_truncated_packets(capture)
+    assert_same_table(table, rbot_packets)
+    assert os.path.exists(cache_path_for(capture))
+
+    cached = load_truncated_packets(capture)
+    assert isinstance(cached.size.base, np.memmap)
+    assert_same_table(cached, rbot_packets)
+    assert cached.flow_index is not None
+    np.testing.assert_array_equal(cached.flow_rows(int(cached.flow_id.max())),
+                                  rbot_packets.flow_rows(int(rbot_packets.flow_id.max())))
+
+
+def test_cached_table_is_copy_on_write(capture, rbot_packets):
+    save_packet_cache(rbot_packets, capture)
+    cached = load_packet_cache(capture)
+    cached.size[:] = 0
+    assert_same_table(load_packet_cache(capture), rbot_packets)
+
+
+def test_changed_capture_invalidates_the_cache(capture, rbot_packets):
+    save_packet_cache(rbot_packets, capture)
+    stat = os.stat(capture)
+    os.utime(capture, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert load_packet_cache(capture) is None
+
+    save_packet_cache(rbot_packets, capture)
+    with open(capture, "ab") as file:
+        file.write(b"\0" * 16)
+    assert load_packet_cache(capture) is None
+
+
+def test_other_format_version_or_corrupt_header_invalidates_the_cache(capture, rbot_packets, monkeypatch):
+    save_packet_cache(rbot_packets, capture)
+    monkeypatch.setattr(packet_cache, "CACHE_FORMAT_VERSION", packet_cache.CACHE_FORMAT_VERSION + 1)
+    assert load_packet_cache(capture) is None
+    monkeypatch.undo()
+
+    with open(cache_path_for(capture), "r+b") as file:
+        file.seek(CACHE_PREAMBLE.size)
+        file.write(b"}")
+    assert load_packet_cache(capture) is None
+
+    # A truncated cache file is rejected instead of mapping past its end
+    save_packet_cache(rbot_packets, capture)
+    with open(cache_path_for(capture), "r+b") as file:
+        file.truncate(os.path.getsize(cache_path_for(capture)) // 2)
+    assert load_packet_cache(capture) is None
+    # load_truncated_packets rebuilds it
+    assert_same_table(load_truncated_packets(capture), rbot_packets)
+    assert load_packet_cache(capture) is not None
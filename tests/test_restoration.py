@@ -0,0 +1,191 @@
+import struct
+
+import numpy as np
+import pytest
+from scapy.all import IP, PcapReader, PcapWriter
+
+import src.utils.restoration as restoration
+from src.utils.restoration import (
+    PCAP_FILE_HEADER,
+    add_padding,
+    changed_packet_ids,
+    fragment_packet,
+    resequence_pcap,
+    restore_from_manifest,
+    write_delta_pcap,
+    write_restored_pcap,
+)
+from src.utils.pcap_parser import PcapFile
+from src.utils.truncated_packet import create_truncated_packets_from_pcap
+
+from conftest import RBOT, TESTING_SMALL
+
+
+def write_one_by_one(original_pcap, modified_pcap, truncated_packets):
+    # The scapy writer write_restored_pcap replaced: every record is dissected and synced on its own
+    writer = PcapWriter(modified_pcap, append=True, sync=True)
+    truncated_packets_dict = {tp.packet_id: tp for tp in truncated_packets}
+    with PcapReader(original_pcap) as reader:
+        for i, packet in enumerate(reader):
+            if IP in packet and i + 1 in truncated_packets_dict:
+                tp = truncated_packets_dict[i + 1]
+                packet.time = tp.timestamp
+                if len(packet) < tp.size:
+                    packet = add_padding(packet, tp.size - len(packet))
+                if tp.fragmented == 1:
+                    packet = fragment_packet(packet, int(tp.size / 2))
+                elif tp.fragmented == 2:
+                    packet = fragment_packet(packet, int(tp.size / 4))
+            writer.write(packet)
+    writer.close()
+
+
+@pytest.fixture
+def perturbed_table(monkeypatch):
+    monkeypatch.setattr(restoration.os, "urandom", lambda size: bytes(size))  # deterministic padding
+    table = create_truncated_packets_from_pcap(TESTING_SMALL)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(table), len(table) // 10, replace=False)
+    table.timestamp[rows] += rng.uniform(0, 5, len(rows))
+    rows = rng.choice(len(table), 20, replace=False)
+    table.size[rows] += rng.integers(1, 300, len(rows))
+    rows = rng.choice(len(table), 10, replace=False)
+    table.fragmented[rows] = rng.integers(1, 3, len(rows))
+    return table
+
+
+@pytest.mark.parametrize("as_packets", [False, True])
+def test_restored_pcap_matches_one_by_one_writer(perturbed_table, tmp_path, as_packets):
+    expected, actual = tmp_path / "one_by_one.pcap", tmp_path / "restored.pcap"
+    write_one_by_one(TESTING_SMALL, str(expected), perturbed_table.to_packets())
+    truncated_packets = perturbed_table.to_packets() if as_packets else perturbed_table
+    stats = write_restored_pcap(TESTING_SMALL, str(actual), truncated_packets, batch_size=64, buffer_size=4096)
+
+    assert actual.read_bytes() == expected.read_bytes()
+    assert stats.rebuilt > 0 and stats.raw + stats.rebuilt == stats.records
+    assert stats.max_shift > 0
+
+
+def test_unchanged_capture_is_copied_raw(tmp_path):
+    table = create_truncated_packets_from_pcap(TESTING_SMALL)
+    expected, actual = tmp_path / "one_by_one.pcap", tmp_path / "restored.pcap"
+    write_one_by_one(TESTING_SMALL, str(expected), table.to_packets())
+    stats = write_restored_pcap(TESTING_SMALL, str(actual), table)
+    assert actual.read_bytes() == expected.read_bytes()
+    assert stats.rebuilt == 0 and stats.max_shift == pytest.approx(0.0, abs=1e-6)
+
+
+def perturb(table, seed=0):
+    # Timing, padding and fragmentation changes of a few packets, like an optimized flow
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(table), 40, replace=False)
+    table.timestamp[rows] += rng.uniform(-2, 2, len(rows))
+    table.size[rows[:10]] += rng.integers(1, 300, 10)
+    table.fragmented[rows[10:15]] = rng.integers(1, 3, 5)
+    return table
+
+
+def test_delta_manifest_round_trip(rbot_packets, tmp_path, monkeypatch):
+    monkeypatch.setattr(restoration.os, "urandom", lambda size: bytes(size))
+    perturbed = perturb(rbot_packets.copy())
+    packet_ids = changed_packet_ids(rbot_packets, perturbed)
+    assert len(packet_ids) == 40
+
+    delta, restored = tmp_path / "delta.pcap", tmp_path / "restored.pcap"
+    manifest_path, replayed = tmp_path / "manifest.json", tmp_path / "replayed.pcap"
+    manifest = write_delta_pcap(RBOT, str(delta), perturbed, packet_ids, manifest_path=str(manifest_path))
+    assert manifest["records"]["number"] == packet_ids.tolist()
+    stats = restore_from_manifest(RBOT, str(manifest_path), str(replayed))
+    assert stats.records == 40 and stats.rebuilt > 0
+    assert replayed.read_bytes() == delta.read_bytes()
+
+    # The spliced capture keeps the original file header, its records equal a full restoration
+    write_restored_pcap(RBOT, str(restored), perturbed)
+    with open(RBOT, "rb") as file:
+        assert delta.read_bytes()[:PCAP_FILE_HEADER.size] == file.read(PCAP_FILE_HEADER.size)
+    assert delta.read_bytes()[PCAP_FILE_HEADER.size:] == restored.read_bytes()[PCAP_FILE_HEADER.size:]
+
+
+def test_manifest_of_another_capture_is_rejected(rbot_packets, tmp_path):
+    manifest_path = tmp_path / "manifest.json"
+    write_delta_pcap(RBOT, str(tmp_path / "delta.pcap"), rbot_packets, rbot_packets.packet_id[:1],
+                     manifest_path=str(manifest_path))
+    copy = tmp_path / "copy.pcap"
+    copy.write_bytes(open(RBOT, "rb").read() + bytes(16))
+    with pytest.raises(ValueError):
+        restore_from_manifest(str(copy), str(manifest_path), str(tmp_path / "replayed.pcap"))
+
+
+def pcap_records(pcap_file):
+    with PcapFile(pcap_file) as pcap:
+        return pcap.read(0, pcap.header_length), list(restoration._pcap_records(pcap, batch_size=100))
+
+
+@pytest.mark.parametrize("window, max_buffered, runs", [
+    (restoration.MAX_REORDER_WINDOW, restoration.DEFAULT_REORDER_BUFFER, 1),  # one run, moved into place
+    (0.5, restoration.DEFAULT_REORDER_BUFFER, None),  # records moved back past the window start new runs
+    (restoration.MAX_REORDER_WINDOW, 4096, None),  # the byte bound releases records early
+])
+def test_resequenced_pcap_equals_a_full_sort(rbot_packets, tmp_path, window, max_buffered, runs):
+    perturbed = rbot_packets.copy()
+    rng = np.random.default_rng(1)
+    rows = rng.choice(len(perturbed), len(perturbed) // 5, replace=False)
+    perturbed.timestamp[rows] += rng.uniform(-30, 30, len(rows))
+    perturbed.timestamp[rows[:10]] = perturbed.timestamp[rows[:10] - 1]  # equal timestamps keep their record order
+    unordered, ordered = tmp_path / "unordered.pcap", tmp_path / "ordered.pcap"
+    write_restored_pcap(RBOT, str(unordered), perturbed)
+
+    merged = resequence_pcap(str(unordered), str(ordered), window=window, max_buffered=max_buffered)
+    assert merged == runs if runs else merged > 1
+
+    header, records = pcap_records(unordered)
+    expected = sorted(records, key=lambda record: record[0])  # stable
+    assert expected != records
+    assert pcap_records(ordered) == (header, expected)
+
+
+def record_times(pcap_file):
+    # Seconds / microseconds fields as written, ticks would hide an out of range fraction
+    with PcapFile(pcap_file) as pcap:
+        batch = next(pcap.iter_record_batches(10**6))
+        fields = [struct.unpack_from(pcap.endian + "II", pcap.buffer, offset) for offset in batch.offset.tolist()]
+    return np.array(fields).T
+
+
+def test_fraction_rounding_up_to_a_second_is_carried(rbot_packets, tmp_path, monkeypatch):
+    monkeypatch.setattr(restoration.os, "urandom", lambda size: bytes(size))
+    perturbed = rbot_packets.copy()
+    second = perturbed.time_base + 100
+    # 0.99999976s, exact at this magnitude, rounds to 1000000 microseconds
+    perturbed.timestamp[[10, 20]] = second - perturbed.time_base + 1 - 2**-22
+    perturbed.size[20] += 100  # rebuilt by scapy
+
+    restored, delta = tmp_path / "restored.pcap", tmp_path / "delta.pcap"
+    write_restored_pcap(RBOT, str(restored), perturbed)
+    write_delta_pcap(RBOT, str(delta), perturbed, perturbed.packet_id[[10, 20]])
+    records = perturbed.packet_id[[10, 20]] - 1
+    for pcap_file in (restored, delta):
+        seconds, microseconds = record_times(str(pcap_file))
+        assert microseconds.max() < 10**6
+        assert seconds[records].tolist() == [second + 1] * 2 and microseconds[records].tolist() == [0, 0]
+
+
+def pcapng_block(block_type, body):
+    body += bytes(-len(body) % 4)
+    return struct.pack("<II", block_type, len(body) + 12) + body + struct.pack("<I", len(body) + 12)
+
+
+def test_mixed_linktypes_are_rejected(tmp_path):
+    # Ethernet and raw IP interfaces in one section, the second record uses the raw IP one
+    packet = bytes(IP())
+    capture = tmp_path / "mixed.pcapng"
+    capture.write_bytes(b"".join([
+        pcapng_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)),
+        pcapng_block(1, struct.pack("<HHI", 1, 0, 65535)),
+        pcapng_block(1, struct.pack("<HHI", 101, 0, 65535)),
+        pcapng_block(6, struct.pack("<5I", 0, 0, 0, 14 + len(packet), 14 + len(packet)) + bytes(12) + b"\x08\x00" + packet),
+        pcapng_block(6, struct.pack("<5I", 1, 0, 1, len(packet), len(packet)) + packet),
+    ]))
+    table = create_truncated_packets_from_pcap(str(capture))
+    with pytest.raises(ValueError, match="mixes linktypes 1 and 101"):
+        write_restored_pcap(str(capture), str(tmp_path / "restored.pcap"), table)
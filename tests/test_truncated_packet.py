@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from src.utils.flow import assign_flow_ids_to_packets
+from src.utils.truncated_packet import PACKET_TABLE_COLUMNS, create_truncated_packets_from_pcap
+
+from conftest import RBOT, TESTING_SMALL
+
+
+def assert_tables_equal(expected, actual):
+    assert expected.time_base == actual.time_base and len(expected) == len(actual)
+    for name in PACKET_TABLE_COLUMNS:
+        np.testing.assert_array_equal(expected.columns[name], actual.columns[name], err_msg=name)
+
+
+@pytest.fixture(scope="module")
+def raw_table():
+    return create_truncated_packets_from_pcap(TESTING_SMALL)
+
+
+def test_raw_parser_matches_scapy(raw_table):
+    assert_tables_equal(create_truncated_packets_from_pcap(TESTING_SMALL, parser="scapy"), raw_table)
+
+
+def test_small_chunks_match_one_chunk(raw_table):
+    assert_tables_equal(raw_table, create_truncated_packets_from_pcap(TESTING_SMALL, chunk_size=7))
+
+
+@pytest.mark.parametrize("pcap_file", [TESTING_SMALL, RBOT])
+@pytest.mark.parametrize("shards, processes", [(1, 1), (3, 1), (7, 2)])
+def test_sharded_read_matches_serial(pcap_file, shards, processes):
+    serial = create_truncated_packets_from_pcap(pcap_file)
+    sharded = create_truncated_packets_from_pcap(pcap_file, shards=shards, processes=processes)
+    assert_tables_equal(serial, sharded)
+    assert_tables_equal(assign_flow_ids_to_packets(serial), assign_flow_ids_to_packets(sharded))
+
+
+def test_sharded_read_needs_raw_parser():
+    with pytest.raises(ValueError):
+        create_truncated_packets_from_pcap(TESTING_SMALL, parser="scapy", shards=2)